@@ -1,39 +1,126 @@
+import asyncio
+import json
 import os
+import random
+import tempfile
+import time
 from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Any, Optional
 
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Query
 from sentence_transformers import SentenceTransformer
 from starlette.requests import Request
-from starlette.responses import FileResponse, JSONResponse
+from fastapi.responses import ORJSONResponse
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse
 
 import basic.func
-from basic import LogLevel
-from constants import APP_NAME, APP_VERSION
+from basic import LogLevel, LogFactory
+from constants import APP_NAME, APP_VERSION, ACCESS_LOG_SAMPLE_RATE, ACCESS_LOG_SLOW_MILLIS, COLLECTION_MEMORY_BUDGET_MB, SEARCH_ADAPTIVE, \
+    SEARCH_ENGINE, SEARCH_BUDGET_MILLIS, SEARCH_QUEUE_DEGRADE, SEARCH_QUEUE_REJECT, SERVER_OPTIONS_ENV, PROFILE_SLOWEST_REQUESTS, \
+    PROFILE_MAX_SECONDS, INDEX_JOB_WORKERS, INDEX_JOB_MAX_WORKERS
 from service import aiModel
+from service import dictCollection
 from service import dictWords
+from service import encoderService
+from service import indexJob
+from service import indexManifest
+from service import indexStats
+from service import profiler
 from service import vectorIndex
 
 # 初始化全局变量
 startTime = datetime.now()
-words : dict[str, dictWords.DictWord] = dictWords.load_dict_word_set()
-codes : list[set[str]] = dictWords.load_index_codes()
-model: Optional[SentenceTransformer] = aiModel.load_sentence_transformer_model()
-word_index, pinyin_index = vectorIndex.load_vector_indexes()
+# 所有字典共用一个模型；主进程启动了编码进程时，通过本地socket请求编码，不在服务进程中加载模型
+model: Optional[SentenceTransformer | encoderService.EncoderClient] = encoderService.connect_encoders() or aiModel.load_sentence_transformer_model()
+# 命名字典按需加载，只读的搜索数据以内存映射方式打开，多个服务进程共享同一份页缓存
+collections = dictCollection.CollectionCache(memory_budget=COLLECTION_MEMORY_BUDGET_MB * 1024 * 1024)
+collections.get(dictWords.DEFAULT_COLLECTION)
 info : dict[str, Any] = {
     "name": APP_NAME,
     "version": APP_VERSION,
     "loadTime": startTime.strftime("%Y-%m-%d %H:%M:%S"),
     "model": "sentence-transformers/distiluse-base-multilingual-cased-v1",
-    "dictWordSize": len(words),
-    "indexWordSize": len(codes),
+    "pid": os.getpid(),
+    "encoders": len(model.addresses) if isinstance(model, encoderService.EncoderClient) else 0,
 }
 
+def configure_collections(memory_budget_mb: int = COLLECTION_MEMORY_BUDGET_MB, refresh_seconds: float = 0):
+    """
+    :param memory_budget_mb: 已加载字典的内存预算(MB)，超出时淘汰最久未使用的字典，0表示不限制
+    :param refresh_seconds: 检查最新索引目录的间隔(秒)，0表示不检查
+    """
+    collections.set_memory_budget(memory_budget_mb * 1024 * 1024)
+    collections.set_refresh_seconds(refresh_seconds)
+
+def activate_index_job(job: indexJob.IndexJob):
+    # 索引任务完成后切换到新的索引目录
+    collections.activate(job.options.get('collection') or dictWords.DEFAULT_COLLECTION, job.batch_index_dir)
+
 # 初始化日志记录器
-access_logger = basic.log(name="access", file_name="access", level=LogLevel.ALL, line_number=False)
+# 访问日志由后台线程写入，每个请求一行JSON
+access_logger = basic.log(name="access", file_name="access", level=LogLevel.ALL, line_number=False, queued=True, json_format=True)
+access_sample_rate: float = ACCESS_LOG_SAMPLE_RATE
+access_slow_millis: float = ACCESS_LOG_SLOW_MILLIS
 error_logger = basic.log(name="error", file_name="error", level=LogLevel.ALL, line_number=False)
 
+def configure_access_log(sample_rate: float = ACCESS_LOG_SAMPLE_RATE, slow_millis: float = ACCESS_LOG_SLOW_MILLIS):
+    """
+    :param sample_rate: 访问日志采样率，0~1
+    :param slow_millis: 耗时超过该毫秒数的请求总是记录
+    """
+    global access_sample_rate, access_slow_millis
+    access_sample_rate = sample_rate
+    access_slow_millis = slow_millis
+
+# 搜索的延迟预算及排队降级阈值
+search_budget_millis: float = SEARCH_BUDGET_MILLIS
+search_queue_degrade: int = SEARCH_QUEUE_DEGRADE
+search_queue_reject: int = SEARCH_QUEUE_REJECT
+# 已到达尚未返回的搜索请求数，包括等待线程池的请求
+search_in_flight: int = 0
+
+def configure_search(budget_millis: float = SEARCH_BUDGET_MILLIS, queue_degrade: int = SEARCH_QUEUE_DEGRADE, queue_reject: int = SEARCH_QUEUE_REJECT):
+    """
+    :param budget_millis: 默认的单次搜索延迟预算(毫秒)，0表示不限制
+    :param queue_degrade: 排队的搜索请求数每超过一倍该值降一级，0表示不按排队数降级
+    :param queue_reject: 排队的搜索请求数超过该值时直接拒绝，0表示不拒绝
+    """
+    global search_budget_millis, search_queue_degrade, search_queue_reject
+    search_budget_millis = budget_millis
+    search_queue_degrade = queue_degrade
+    search_queue_reject = queue_reject
+
+def queue_degrade_level() -> int:
+    return vectorIndex.queue_degrade_level(search_in_flight, search_queue_degrade, search_queue_reject)
+
+# 开启性能分析时，记录搜索各阶段的耗时，并提供 /debug/profile 采样分析
+profile_enabled: bool = False
+slowest_requests = profiler.SlowestRequests(PROFILE_SLOWEST_REQUESTS)
+
+def configure_profile(enabled: bool = False, slowest: int = PROFILE_SLOWEST_REQUESTS):
+    """
+    :param enabled: 开启性能分析
+    :param slowest: 保留各阶段耗时的最慢请求数
+    """
+    global profile_enabled, slowest_requests
+    profile_enabled = enabled
+    slowest_requests = profiler.SlowestRequests(slowest)
+
+def configure_server(log_level: str = "info", access_sample: float = ACCESS_LOG_SAMPLE_RATE, slow_millis: float = ACCESS_LOG_SLOW_MILLIS,
+                     dict_memory: int = COLLECTION_MEMORY_BUDGET_MB, dict_refresh: float = 0, search_budget: float = SEARCH_BUDGET_MILLIS,
+                     queue_degrade: int = SEARCH_QUEUE_DEGRADE, queue_reject: int = SEARCH_QUEUE_REJECT, profile: bool = False,
+                     profile_slowest: int = PROFILE_SLOWEST_REQUESTS):
+    LogFactory.setDefaultLogLevel(LogFactory.getLogLevelValue(log_level))
+    configure_access_log(sample_rate=access_sample, slow_millis=slow_millis)
+    configure_collections(memory_budget_mb=dict_memory, refresh_seconds=dict_refresh)
+    configure_search(budget_millis=search_budget, queue_degrade=queue_degrade, queue_reject=queue_reject)
+    configure_profile(enabled=profile, slowest=profile_slowest)
+
+# 服务进程由主进程启动时，从环境变量读取服务配置
+if os.environ.get(SERVER_OPTIONS_ENV):
+    configure_server(**json.loads(os.environ[SERVER_OPTIONS_ENV]))
+
 # 使用 async contextmanager 创建 lifespan 事件处理器
 @asynccontextmanager
 async def lifespan(_: FastAPI):
@@ -52,7 +139,24 @@ app = FastAPI(lifespan=lifespan)
 # 使用 @app.middleware("http") 来实现中间件
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    start_time = datetime.now()
+    global search_in_flight
+    start_time = time.perf_counter()
+    # 搜索在线程池中执行，到达时计数，排队时间计入延迟预算
+    request.state.arrival = start_time
+    searching = request.url.path == "/search"
+    if searching:
+        search_in_flight += 1
+    try:
+        response = await call_next(request)
+    finally:
+        if searching:
+            search_in_flight -= 1
+    duration = (time.perf_counter() - start_time) * 1000
+
+    # 慢请求和错误总是记录，其它请求按采样率记录
+    slow = duration >= access_slow_millis
+    if not slow and response.status_code < 500 and random.random() >= access_sample_rate:
+        return response
 
     # 获取真实的客户端 IP
     forwarded_for = request.headers.get("X-Forwarded-For")
@@ -62,12 +166,15 @@ async def log_requests(request: Request, call_next):
     else:
         # 如果没有 X-Forwarded-For，直接使用 request.client.host
         client_ip = request.client.host
-    access_logger.info(f"Request: {client_ip} - {request.method} - {request.url}")
-    response = await call_next(request)
-    end_time = datetime.now()
-    duration = (end_time - start_time).microseconds / 1000
-    access_logger.info(
-        f"Response: {client_ip} - {response.status_code} - {request.method} - {request.url} - {duration:.3f}ms")
+    access_logger.info("access", extra={"fields": {
+        "ip": client_ip,
+        "method": request.method,
+        "path": request.url.path,
+        "query": request.url.query,
+        "status": response.status_code,
+        "millis": round(duration, 3),
+        "slow": slow,
+    }})
     return response
 
 
@@ -99,18 +206,45 @@ async def index_html():
     return FileResponse('static/index.html')
 
 @app.get("/info")
-async def get_service_info():
+async def get_service_info(detail : bool = False):
     micro_start = datetime.now()
     result = info.copy()
-    result["dictWordLastModifyTime"] = dictWords.get_dict_words_last_modify_time()
-    result["indexWordLastModifyTime"] = dictWords.get_index_words_last_modify_time()
-    result["wordIndexLastModifyTime"] = vectorIndex.get_word_index_last_modify_time()
-    result["pinyinIndexLastModifyTime"] = vectorIndex.get_pinyin_index_last_modify_time()
+    loaded = collections.loaded()
+    default = next((c for c in loaded if c.name == dictWords.DEFAULT_COLLECTION), None)
+    if default:
+        result.update({key: value for key, value in default.to_dict().items()
+                       if key in ("dictWordSize", "indexWordSize", "shardSize", "quantizer")})
+    result["collections"] = [c.to_dict() for c in loaded]
+    # 文件时间取自当前使用的索引清单，不再扫描索引目录
+    manifest = default.manifest if default else None
+    result["dictWordLastModifyTime"] = indexManifest.get_manifest_file_time(manifest, 'dict_words.csv')
+    result["indexWordLastModifyTime"] = indexManifest.get_manifest_file_time(manifest, 'index_words.csv')
+    result["wordIndexLastModifyTime"] = indexManifest.get_manifest_file_time(manifest, 'word_index.bin')
+    result["pinyinIndexLastModifyTime"] = indexManifest.get_manifest_file_time(manifest, 'pinyin_index.bin')
+    result["memory"] = basic.func.get_process_memory()
+    if detail:
+        # 按字典、分片统计字典、倒排表、向量索引及模型的内存占用
+        result["detail"] = indexStats.collect_stats(loaded, model)
     return {'code': 1, 'message': 'success', 'result': result, 'micro': basic.cost_macro(micro_start)}
 
 @app.post("/put")
-async def upload_dict_words(file: UploadFile = File(...)):
+async def upload_dict_words(file: UploadFile = File(...), index: bool = True, worker: int = INDEX_JOB_WORKERS, batch: int = 500,
+                            ngram_min: int = Query(3, alias="min"), ngram_max: int = Query(5, alias="max"), quantizer: str = "flat",
+                            shard_count: int = Query(1, alias="shards"), shard_by: str = "hash", prune: bool = False,
+                            max_df: int = 0, collection: str = Query(dictWords.DEFAULT_COLLECTION, alias="dict")):
     micro_start = datetime.now()
+    if not dictWords.is_valid_collection_name(collection):
+        return {'code': 102, 'msg': f"字典名称[{collection}]不合法", 'micro': basic.cost_macro(micro_start)}
+    # 索引参数不合法时不上传，避免索引任务在生成索引词之后才失败
+    # 向量化进程数不超过上限，0表示使用上限
+    options = {'process_worker': min(worker, INDEX_JOB_MAX_WORKERS) if worker > 0 else INDEX_JOB_MAX_WORKERS, 'batch_size': batch,
+               'ngram_min': ngram_min, 'ngram_max': ngram_max, 'quantizer': quantizer, 'shards': shard_count, 'shard_by': shard_by,
+               'prune': prune, 'max_df': max_df, 'collection': collection}
+    if index:
+        try:
+            indexJob.check_index_options(**options)
+        except ValueError as e:
+            return {'code': 110, 'msg': f"索引参数不合法: {e}", 'micro': basic.cost_macro(micro_start)}
     # 检查文件类型
     if not file.filename.endswith(".csv"):
         return {'code' : 100, 'msg' : f"上传的文件[{file.filename}]必须是 CSV 格式", 'micro': basic.cost_macro(micro_start)}
@@ -119,25 +253,111 @@ async def upload_dict_words(file: UploadFile = File(...)):
     if file.content_type != "text/csv":
         return {'code': 101, 'msg': f"文件MIME类型[{file.content_type}]不匹配，必须是 text/csv", 'micro': basic.cost_macro(micro_start)}
 
-    file_location = os.path.join(basic.func.get_executable_directory(), 'dict', 'dict_words.csv')
+    # 分块写入临时文件后原子替换，避免大文件占用内存，也不会让正在复制字典的索引任务读到半个文件
+    file_location = dictWords.get_dict_words_path(collection)
     basic.func.touch_dir(file_location)
-    if os.path.exists(file_location):
-        os.remove(file_location)
-    with open(file_location, "wb") as buffer:
-        buffer.write(await file.read())
-    return {'code': 1, 'message': 'success', 'result': basic.func.get_file_last_modify_time(file_location),
+    fd, temp_location = tempfile.mkstemp(prefix='dict_words.', suffix='.uploading', dir=os.path.dirname(file_location))
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            while chunk := await file.read(1024 * 1024):
+                buffer.write(chunk)
+        os.replace(temp_location, file_location)
+    except Exception:
+        os.remove(temp_location)
+        raise
+    result = {'lastModifyTime': basic.func.get_file_last_modify_time(file_location)}
+    if index:
+        job = indexJob.submit_index_job(options, on_finished=activate_index_job)
+        result['job'] = job.to_dict()
+    return {'code': 1, 'message': 'success', 'result': result, 'micro': basic.cost_macro(micro_start)}
+
+@app.get("/jobs")
+async def get_index_jobs():
+    micro_start = datetime.now()
+    return {'code': 1, 'message': 'success', 'result': [job.to_dict() for job in indexJob.list_index_jobs()],
             'micro': basic.cost_macro(micro_start)}
 
+@app.get("/jobs/{job_id}")
+async def get_index_job(job_id: str):
+    micro_start = datetime.now()
+    job = indexJob.get_index_job(job_id)
+    if not job:
+        return {'code': 106, 'msg': f"索引任务[{job_id}]不存在", 'micro': basic.cost_macro(micro_start)}
+    return {'code': 1, 'message': 'success', 'result': job.to_dict(), 'micro': basic.cost_macro(micro_start)}
+
 @app.get("/search")
-async def search_vector_index(word : str, top : int = 3, pinyin : bool = False):
+def search_vector_index(request: Request, word : str, top : int = 3, pinyin : bool = False, format : str = "object",
+                        collection : str = Query(dictWords.DEFAULT_COLLECTION, alias="dict"), adaptive : bool = SEARCH_ADAPTIVE,
+                        engine : str = SEARCH_ENGINE, budget : Optional[float] = None):
+    # 同步函数在线程池中执行，不阻塞事件循环，中间件才能统计排队的请求数
     micro_start = datetime.now()
+    search_budget = vectorIndex.SearchBudget(budget_millis=search_budget_millis if budget is None else budget,
+                                             start=request.state.arrival, level=queue_degrade_level())
+    timings = profiler.StageTimings() if profile_enabled else profiler.NO_TIMINGS
+    timings.add("queue", search_budget.elapsed_millis())
+    # 排队过多或排队已用完预算时直接拒绝
+    if search_budget.degrade("rejected", vectorIndex.DEGRADE_STOP):
+        return ORJSONResponse({'code': 108, 'msg': "服务繁忙，请稍后重试", 'degraded': True, 'degradeSteps': search_budget.steps,
+                               'micro': basic.cost_macro(micro_start)}, status_code=503)
     if not word:
         return {'code': 103, 'msg': "搜索词不能为空", 'micro': basic.cost_macro(micro_start)}
-    if not word_index or not pinyin_index:
-        return {'code': 104, 'msg': "索引尚未创建，请先reload", 'micro': basic.cost_macro(micro_start)}
-    if not model:
+    if not dictWords.is_valid_collection_name(collection):
+        return {'code': 102, 'msg': f"字典名称[{collection}]不合法", 'micro': basic.cost_macro(micro_start)}
+    if engine not in vectorIndex.SEARCH_ENGINES:
+        return {'code': 107, 'msg': f"搜索引擎[{engine}]不支持，必须是 {'/'.join(vectorIndex.SEARCH_ENGINES)}", 'micro': basic.cost_macro(micro_start)}
+    dict_collection = collections.get(collection)
+    if not dict_collection:
+        return {'code': 104, 'msg': f"字典[{collection}]索引尚未创建，请先reload", 'micro': basic.cost_macro(micro_start)}
+    # 字面索引不经过模型
+    if not model and engine != "lexical":
         return {'code': 105, 'msg': "模型尚未加载，请先reload", 'micro': basic.cost_macro(micro_start)}
-    results = vectorIndex.search_vector_indexes(word=word, model=model, word_index=word_index,
-                                                pinyin_index=pinyin_index, index_codes=codes, dict_words=words,
-                                                top_k=top, pinyin=pinyin)
-    return {'code': 1, 'message': 'success', 'result': results, 'micro': basic.cost_macro(micro_start)}
+    hits = vectorIndex.search_index_shards(word=word, model=model, shards=dict_collection.shards, top_k=top, pinyin=pinyin,
+                                           executor=dict_collection.executor, adaptive=adaptive, engine=engine, budget=search_budget,
+                                           timings=timings)
+    # format=array 时每个结果为 [index, code, word, score, distance]
+    with timings.stage("response"):
+        results = [list(hit) for hit in hits] if format == "array" else [hit._asdict() for hit in hits]
+    if profile_enabled:
+        millis = search_budget.elapsed_millis()
+        slowest_requests.record(millis, {"time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "word": word, "dict": collection,
+                                         "engine": engine, "pinyin": pinyin, "millis": round(millis, 3), "stages": timings.stages,
+                                         "degradeSteps": search_budget.steps})
+    return ORJSONResponse({'code': 1, 'message': 'success', 'result': results, 'degraded': search_budget.degraded,
+                           'degradeSteps': search_budget.steps, 'micro': basic.cost_macro(micro_start)})
+
+
+@app.get("/debug/profile")
+async def debug_profile(seconds : float = 10, interval : float = profiler.PROFILE_INTERVAL_MILLIS):
+    """
+    采样分析服务进程 seconds 秒，返回折叠栈，每行为 `线程;函数 (文件:行);... 采样数`，可直接用于 flamegraph.pl 或 speedscope
+    """
+    micro_start = datetime.now()
+    if not profile_enabled:
+        return {'code': 109, 'msg': "性能分析未开启，请使用 -profile 启动服务", 'micro': basic.cost_macro(micro_start)}
+    sampler = profiler.SamplingProfiler(interval_millis=max(interval, 1)).start()
+    try:
+        await asyncio.sleep(min(max(seconds, 0.1), PROFILE_MAX_SECONDS))
+    finally:
+        sampler.stop()
+    return PlainTextResponse(sampler.collapsed())
+
+@app.get("/debug/slowest")
+async def debug_slowest():
+    micro_start = datetime.now()
+    if not profile_enabled:
+        return {'code': 109, 'msg': "性能分析未开启，请使用 -profile 启动服务", 'micro': basic.cost_macro(micro_start)}
+    return {'code': 1, 'message': 'success', 'result': slowest_requests.list(), 'micro': basic.cost_macro(micro_start)}
+
+@app.get("/suggest")
+async def suggest_dict_words(prefix : str, top : int = 10, collection : str = Query(dictWords.DEFAULT_COLLECTION, alias="dict")):
+    micro_start = datetime.now()
+    if not prefix:
+        return {'code': 103, 'msg': "前缀不能为空", 'micro': basic.cost_macro(micro_start)}
+    if not dictWords.is_valid_collection_name(collection):
+        return {'code': 102, 'msg': f"字典名称[{collection}]不合法", 'micro': basic.cost_macro(micro_start)}
+    dict_collection = collections.get(collection)
+    if not dict_collection:
+        return {'code': 104, 'msg': f"字典[{collection}]索引尚未创建，请先reload", 'micro': basic.cost_macro(micro_start)}
+    hits = vectorIndex.suggest_index_shards(prefix=prefix, shards=dict_collection.shards, top_n=top)
+    return ORJSONResponse({'code': 1, 'message': 'success', 'result': [hit._asdict() for hit in hits],
+                           'micro': basic.cost_macro(micro_start)})
@@ -4,7 +4,8 @@ from datetime import datetime
 
 from .logger import LogLevel, LogFactory, set_global_log_level, get_logger
 
-def log(name : str = None, level: LogLevel = LogLevel.UNSET, file_name: str = 'app', line_number : bool = True) -> logging.Logger:
+def log(name : str = None, level: LogLevel = LogLevel.UNSET, file_name: str = 'app', line_number : bool = True,
+        queued: bool = False, json_format: bool = False) -> logging.Logger:
     # if name is None:
     #     # 获取当前函数的上一个栈帧
     #     caller_frame = inspect.currentframe().f_back
@@ -19,7 +20,7 @@ def log(name : str = None, level: LogLevel = LogLevel.UNSET, file_name: str = 'a
     #             name = ""
     #     else:
     #         name = ""
-    return get_logger(name=name, level=level, file_name=file_name, line_number=line_number)
+    return get_logger(name=name, level=level, file_name=file_name, line_number=line_number, queued=queued, json_format=json_format)
 
 def cost_macro(start_time: datetime) -> int:
     return (datetime.now() - start_time).microseconds
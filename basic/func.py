@@ -5,6 +5,8 @@ import time
 from datetime import datetime
 from typing import Any
 
+import psutil
+
 
 def get_executable_directory():
     if getattr(sys, 'frozen', False):  # 判断是否为打包后的可执行文件
@@ -134,4 +136,26 @@ def get_file_last_modify_time(filepath : str) -> str:
     # 获取最后修改时间
     modification_time = os.path.getmtime(filepath)
     # 将时间格式化为可读形式
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(modification_time))
\ No newline at end of file
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(modification_time))
+
+
+def get_process_memory() -> dict[str, int]:
+    """
+    获取当前进程的内存占用(字节)，unique为进程独占内存，shared为与其它进程共享的内存(如内存映射的索引文件)
+
+    :return: rss/unique/shared，Linux下额外返回按共享进程数均摊后的proportional
+    """
+    process = psutil.Process()
+    try:
+        memory = process.memory_full_info()
+    except psutil.AccessDenied:
+        memory = process.memory_info()
+    unique = getattr(memory, 'uss', memory.rss)
+    result = {
+        "rss": memory.rss,
+        "unique": unique,
+        "shared": max(memory.rss - unique, 0),
+    }
+    if hasattr(memory, 'pss'):
+        result["proportional"] = memory.pss
+    return result
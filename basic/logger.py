@@ -1,7 +1,10 @@
+import atexit
+import json
 import logging
 import os
+import queue
 from enum import Enum
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 
 from .func import get_executable_directory
 
@@ -17,6 +20,30 @@ class LogLevel(Enum):
 
 
 global_log_level: LogLevel = LogLevel.INFO
+queue_listeners: list[QueueListener] = []
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出为一行JSON，日志调用时通过 extra={"fields": {...}} 传入结构化字段
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        data = {"time": self.formatTime(record), "level": record.levelname}
+        fields = getattr(record, "fields", None)
+        if fields:
+            data.update(fields)
+        else:
+            data["message"] = record.getMessage()
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def stop_queue_listeners():
+    # 退出前写完队列中剩余的日志
+    while queue_listeners:
+        queue_listeners.pop().stop()
+
+
+atexit.register(stop_queue_listeners)
 
 
 def set_global_log_level(level: LogLevel):
@@ -44,7 +71,12 @@ def get_log_level(level: str) -> LogLevel:
     return global_log_level
 
 
-def get_logger(name: str, level: LogLevel = LogLevel.UNSET, file_name: str = 'app', line_number : bool = True) -> logging.Logger:
+def get_logger(name: str, level: LogLevel = LogLevel.UNSET, file_name: str = 'app', line_number : bool = True,
+               queued: bool = False, json_format: bool = False) -> logging.Logger:
+    """
+    :param queued: 调用线程只把日志放入队列，由后台线程写控制台和文件
+    :param json_format: 每条日志输出为一行JSON
+    """
     log = logging.getLogger(name)
     if log.handlers:
         return log
@@ -67,19 +99,28 @@ def get_logger(name: str, level: LogLevel = LogLevel.UNSET, file_name: str = 'ap
         log_format_str += " - [%(levelname)s]"
     log_format_str += " - %(message)s"
 
-    formatter = logging.Formatter(log_format_str)
+    formatter = JsonFormatter() if json_format else logging.Formatter(log_format_str)
 
     # 创建控制台处理器
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.DEBUG)
     console_handler.setFormatter(formatter)
-    log.addHandler(console_handler)
 
     info_handler = TimedRotatingFileHandler(log_file_path, when="midnight", interval=1)
     info_handler.setLevel(level=LogLevel.DEBUG.value if log_level == LogLevel.ALL else log_level.value)
     info_handler.suffix = "%Y%m%d"
     info_handler.setFormatter(formatter)
-    log.addHandler(info_handler)
+
+    if queued:
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, console_handler, info_handler, respect_handler_level=True)
+        listener.start()
+        queue_listeners.append(listener)
+        log.addHandler(QueueHandler(log_queue))
+        log.propagate = False  # 不再经过根日志记录器的同步处理器
+    else:
+        log.addHandler(console_handler)
+        log.addHandler(info_handler)
 
     log.setLevel(level=LogLevel.DEBUG.value if log_level == LogLevel.ALL else log_level.value)
 
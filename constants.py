@@ -1,3 +1,33 @@
 APP_NAME = "Vector Search"
 APP_VERSION = "1.0.2"
-SERVER_PORT = 8080
\ No newline at end of file
+SERVER_PORT = 8080
+# 访问日志采样率(0~1)，以及总是记录的慢请求阈值(毫秒)
+ACCESS_LOG_SAMPLE_RATE = 1.0
+ACCESS_LOG_SLOW_MILLIS = 500
+# 已加载字典的内存预算(MB)，超出时淘汰最久未使用的字典，0表示不限制
+COLLECTION_MEMORY_BUDGET_MB = 0
+# 默认是否使用自适应近邻深度
+SEARCH_ADAPTIVE = False
+# 默认搜索引擎：vector / lexical / hybrid
+SEARCH_ENGINE = "vector"
+# 默认的单次搜索延迟预算(毫秒，含排队时间)，接近预算时逐级降级，0表示不限制
+SEARCH_BUDGET_MILLIS = 0
+# 排队(含正在处理)的搜索请求数每超过一倍该值降一级，超过拒绝阈值时直接拒绝；默认0不开启，由 -queue-degrade / -queue-reject 开启
+SEARCH_QUEUE_DEGRADE = 0
+SEARCH_QUEUE_REJECT = 0
+# -profile 开启性能分析时保留各阶段耗时的最慢请求数，以及 /debug/profile 最长的采样秒数
+PROFILE_SLOWEST_REQUESTS = 20
+PROFILE_MAX_SECONDS = 300
+# /put 创建索引时默认的向量化进程数及上限，索引任务与服务在同一台机器上运行，不占满CPU
+INDEX_JOB_WORKERS = 1
+INDEX_JOB_MAX_WORKERS = 2
+# 服务进程数量；大于1时由编码进程统一加载模型，服务进程通过本地socket请求编码
+SERVER_WORKERS = 1
+# 编码进程数量，每批最多编码的句子数，以及收到请求后等待合并更多请求的毫秒数
+ENCODER_WORKERS = 1
+ENCODER_MAX_BATCH = 64
+ENCODER_BATCH_WAIT_MILLIS = 0
+# 多个服务进程时检查最新索引目录的间隔(秒)
+COLLECTION_REFRESH_SECONDS = 5
+# 主进程通过环境变量把服务配置传给各服务进程
+SERVER_OPTIONS_ENV = "VECTOR_SEARCH_SERVER_OPTIONS"
@@ -1,15 +1,28 @@
+import json
 import multiprocessing
-import os.path
+import os
+import time
+from contextlib import nullcontext
 from datetime import datetime
 
 import uvicorn
 
 import basic.func
 from basic import LogFactory
-from service import dictWords
 from service import aiModel
+from service import dictCollection
+from service import dictWords
+from service import encoderService
+from service import indexJob
+from service import indexManifest
+from service import indexStats
+from service import indexTuner
+from service import profiler
 from service import vectorIndex
-from constants import APP_VERSION, SERVER_PORT, APP_NAME
+from constants import APP_VERSION, SERVER_PORT, APP_NAME, ACCESS_LOG_SAMPLE_RATE, ACCESS_LOG_SLOW_MILLIS, \
+    COLLECTION_MEMORY_BUDGET_MB, SERVER_WORKERS, ENCODER_WORKERS, ENCODER_MAX_BATCH, ENCODER_BATCH_WAIT_MILLIS, \
+    COLLECTION_REFRESH_SECONDS, SERVER_OPTIONS_ENV, SEARCH_BUDGET_MILLIS, SEARCH_QUEUE_DEGRADE, SEARCH_QUEUE_REJECT, SEARCH_ADAPTIVE, \
+    SEARCH_ENGINE, PROFILE_SLOWEST_REQUESTS
 
 # 导入必要的依赖，防止pyinstaller打包时未能正确识别
 import sys
@@ -22,48 +35,192 @@ import scipy
 import sentence_transformers
 import faiss
 import numpy
+import orjson
 import pydantic
 import psutil
 import multipart
 
 
-def run_uvicorn(server_port : int, log_level : str = "info"):
-    from app import app
+def run_uvicorn(server_port : int, log_level : str = "info", access_sample : float = ACCESS_LOG_SAMPLE_RATE,
+                slow_millis : float = ACCESS_LOG_SLOW_MILLIS, dict_memory : int = COLLECTION_MEMORY_BUDGET_MB,
+                workers : int = SERVER_WORKERS, encoders : int = ENCODER_WORKERS, encoder_batch : int = ENCODER_MAX_BATCH,
+                encoder_wait : float = ENCODER_BATCH_WAIT_MILLIS, search_budget : float = SEARCH_BUDGET_MILLIS,
+                queue_degrade : int = SEARCH_QUEUE_DEGRADE, queue_reject : int = SEARCH_QUEUE_REJECT, profile : bool = False,
+                profile_slowest : int = PROFILE_SLOWEST_REQUESTS):
     server_log_level = LogFactory.getLogLevelValue(log_level)
     LogFactory.setDefaultLogLevel(server_log_level)
+    # 服务配置通过环境变量传给服务进程，单进程时也由 app 导入时读取
+    os.environ[SERVER_OPTIONS_ENV] = json.dumps({
+        "log_level": log_level, "access_sample": access_sample, "slow_millis": slow_millis, "dict_memory": dict_memory,
+        "dict_refresh": COLLECTION_REFRESH_SECONDS if workers > 1 else 0,
+        "search_budget": search_budget, "queue_degrade": queue_degrade, "queue_reject": queue_reject,
+        "profile": profile, "profile_slowest": profile_slowest,
+    })
+    if workers <= 1:
+        from app import app
+        uvicorn.run(
+            app = app,  # 这里是你的 FastAPI 实例的位置
+            host = "0.0.0.0",         # 监听所有网络接口
+            port = server_port,              # 端口号
+            workers = 1,
+            log_level = server_log_level.value,  # 日志级别
+        )
+        return
+    # 多个服务进程：模型只在编码进程中加载一份，服务进程各自以内存映射方式打开索引
+    print(f"Starting {encoders} encoder processes")
+    encoderService.start_encoders(count=encoders, max_batch=encoder_batch, batch_wait_millis=encoder_wait)
     uvicorn.run(
-        app = app,  # 这里是你的 FastAPI 实例的位置
-        host = "0.0.0.0",         # 监听所有网络接口
-        port = server_port,              # 端口号
-        workers = 1,  # Windows下，只开一个进程
-        log_level = server_log_level.value,  # 日志级别
+        app = "app:app",  # 多进程时必须使用导入字符串
+        host = "0.0.0.0",
+        port = server_port,
+        workers = workers,
+        log_level = server_log_level.value,
     )
 
-def run_index(process_worker : int = 0, ngram_min : int = 3, ngram_max : int = 5, batch_size : int = 500):
+def run_index(process_worker : int = 0, ngram_min : int = 3, ngram_max : int = 5, batch_size : int = 500, quantizer : str = "flat",
+              shards : int = 1, shard_by : str = "hash", collection : str | None = None, prune : bool = False, max_df : int = 0,
+              prune_sample : int = indexTuner.PRUNE_RECALL_SAMPLE, profile : str | None = None):
     start_time = datetime.now()
     model = aiModel.load_sentence_transformer_model()
     if model is None:
         print("Failed to load sentence transformer model")
         return
-    batch_index_dir = os.path.join(basic.func.get_executable_directory(), 'index', datetime.now().strftime("%Y%m%d%H%M%S"))
-    print(f"Prepare index words to {batch_index_dir}")
-    words = dictWords.prepare_index_words(batch_index_dir, ngram_min=ngram_min, ngram_max=ngram_max)
-    print(f"Index words count: {len(words)}")
-    vectorIndex.create_vector_indexes(batch_index_dir=batch_index_dir, index_words=words, model=model, worker=process_worker, batch_size=batch_size)
+    if profile and process_worker != 1:
+        print("Embedding runs in worker processes and is not profiled, use -worker=1 to include it")
+    with profiler.profiling("index", profile) if profile else nullcontext():
+        indexJob.build_index(model, process_worker=process_worker, ngram_min=ngram_min, ngram_max=ngram_max, batch_size=batch_size,
+                             quantizer=quantizer, shards=shards, shard_by=shard_by, collection=collection, prune=prune, max_df=max_df,
+                             prune_sample=prune_sample)
     print(f"Indexing completed in {basic.func.get_duration(start_time)}")
 
+def run_query(word : str, collection : str | None = None, top_k : int = 3, pinyin : bool = False, engine : str = SEARCH_ENGINE,
+              adaptive : bool = SEARCH_ADAPTIVE, repeat : int = 1, profile : str | None = None):
+    if engine not in vectorIndex.SEARCH_ENGINES:
+        print(f"Unknown engine: {engine}, must be one of {'/'.join(vectorIndex.SEARCH_ENGINES)}")
+        return
+    dict_collection = dictCollection.load_collection(collection or dictWords.DEFAULT_COLLECTION)
+    if dict_collection is None:
+        print(f"Index not found for dict: {collection or dictWords.DEFAULT_COLLECTION}")
+        return
+    model = aiModel.load_sentence_transformer_model() if engine != "lexical" else None
+    if model is None and engine != "lexical":
+        print("Failed to load sentence transformer model")
+        return
+    latencies = []
+    stages = {}
+    hits = []
+    with profiler.profiling("query", profile) if profile else nullcontext():
+        for _ in range(repeat):
+            timings = profiler.StageTimings()
+            start = time.perf_counter()
+            hits = vectorIndex.search_index_shards(word, model, dict_collection.shards, top_k=top_k, pinyin=pinyin,
+                                                   executor=dict_collection.executor, adaptive=adaptive, engine=engine, timings=timings)
+            latencies.append((time.perf_counter() - start) * 1000)
+            for name, millis in timings.stages.items():
+                stages[name] = stages.get(name, 0.0) + millis
+    dict_collection.close()
+    for hit in hits:
+        print(f"\t{hit.index} {hit.code} {hit.word} score={hit.score} distance={hit.distance:.4f}")
+    latencies.sort()
+    print(f"{repeat} queries, mean {sum(latencies) / repeat:.3f}ms, p95 {latencies[int(0.95 * (repeat - 1))]:.3f}ms, max {latencies[-1]:.3f}ms")
+    print("Mean stage timings: " + ", ".join(f"{name}={millis / repeat:.3f}ms" for name, millis in stages.items()))
+
+def run_prepare(chunk_size : int = dictWords.DICT_SORT_CHUNK_SIZE):
+    stats = dictWords.prepare_dict_words(chunk_size=chunk_size)
+    print(f"Prepared {stats['words']} dict words ({stats['newWords']} new, {stats['retiredWords']} retired) from {stats['lines']} lines "
+          f"in {stats['seconds']}s, {stats['linesPerSecond']} lines/s")
+
+def run_gc(keep : int = 3, collection : str | None = None):
+    removed = indexManifest.gc_generations(keep=keep, collection=collection)
+    for directory in removed:
+        print(f"Removed {directory}")
+    print(f"Removed {len(removed)} index directories")
+
+def run_stats(collection : str | None = None, top_k : int = 3, with_model : bool = True):
+    dict_collection = dictCollection.load_collection(collection or dictWords.DEFAULT_COLLECTION)
+    if dict_collection is None:
+        print(f"Index not found for dict: {collection or dictWords.DEFAULT_COLLECTION}")
+        return
+    model = aiModel.load_sentence_transformer_model() if with_model else None
+    print(json.dumps(indexStats.collect_stats([dict_collection], model, top_k), ensure_ascii=False, indent=2))
+
+def run_tune(collection : str | None = None, sample : int = 500, top_k : int = 3, recall : float = 0.95,
+             factories : list[str] | None = None, apply : bool = True, allow_larger : bool = False):
+    start_time = datetime.now()
+    model = aiModel.load_sentence_transformer_model()
+    if model is None:
+        print("Failed to load sentence transformer model")
+        return
+    tuning = indexTuner.tune_index(model, collection=collection, sample_size=sample, top_k=top_k, recall_target=recall,
+                                   factories=factories, apply=apply, allow_larger=allow_larger)
+    print("Pareto optimal settings:")
+    for item in tuning["pareto"]:
+        print(f"\t{item['factory']} {item['params']} recall={item['recall']} latency={item['latencyMillis']}ms bytes={item['bytes']}")
+    selected = tuning["selected"]
+    if selected is None:
+        print(f"No setting fits within the current index size {tuning['currentBytes']} bytes, keep the current index, use -allow-larger to lift the limit")
+    else:
+        print(f"Selected {selected['factory']} {selected['params']}, {'applied' if apply else 'not applied'}")
+    print(f"Tuning completed in {basic.func.get_duration(start_time)}")
+
 def run_usage():
     print(f"Usage: vector-search version")
     print("")
-    print(f"Usage: vector-search server [-port=8080] [-log-level=info]")
+    print(f"Usage: vector-search server [-port=8080] [-log-level=info] [-access-sample=1.0] [-slow-ms=500] [-dict-memory=0] [-workers=1] [-encoders=1] [-encoder-batch=64] [-encoder-wait=0] [-search-budget=0] [-queue-degrade=0] [-queue-reject=0] [-profile] [-profile-slowest=20]")
     print(f"\t port: server port, default 8080")
     print(f"\t log-level: log level, default info")
+    print(f"\t access-sample: access log sample rate 0~1, default {ACCESS_LOG_SAMPLE_RATE}")
+    print(f"\t slow-ms: requests slower than this are always logged, default {ACCESS_LOG_SLOW_MILLIS}")
+    print(f"\t dict-memory: memory budget(MB) of loaded dicts, least recently used dicts are evicted, default 0 means unlimited")
+    print(f"\t workers: http worker processes, more than 1 shares the model in encoder processes, default {SERVER_WORKERS}")
+    print(f"\t encoders: encoder processes when workers > 1, each loads one model, default {ENCODER_WORKERS}")
+    print(f"\t encoder-batch: max sentences encoded in one batch, default {ENCODER_MAX_BATCH}")
+    print(f"\t encoder-wait: milliseconds to wait for more requests to batch, default {ENCODER_BATCH_WAIT_MILLIS} means only batch queued requests")
+    print(f"\t search-budget: default latency budget(ms) of one search including queueing, searches degrade near the budget, default {SEARCH_BUDGET_MILLIS} means unlimited")
+    print(f"\t queue-degrade: searches degrade one level per multiple of this many queued searches, default {SEARCH_QUEUE_DEGRADE} means never, e.g. 16")
+    print(f"\t queue-reject: searches are rejected when more than this many are queued, default {SEARCH_QUEUE_REJECT} means never, e.g. 64")
+    print(f"\t profile: record search stage timings and enable /debug/profile?seconds=N (collapsed stacks) and /debug/slowest")
+    print(f"\t profile-slowest: slowest searches kept with their stage timings, default {PROFILE_SLOWEST_REQUESTS}")
     print("")
-    print(f"Usage: vector-search index [-worker=0] [-min=3] [-max=5] [-batch=500]")
+    print(f"Usage: vector-search index [-worker=0] [-min=3] [-max=5] [-batch=500] [-quantizer=flat] [-shards=1] [-shard-by=hash] [-dict=default] [-prune] [-max-df=0] [-prune-sample=500] [-profile[=cprofile]]")
     print(f"\t worker: process worker count, default 0 means cpu count")
     print(f"\t min: ngram min length, default 3")
     print(f"\t max: ngram max length, default 5")
     print(f"\t batch: batch size for embeddings , default 500")
+    print(f"\t quantizer: vector storage, flat(float32) / fp16 / int8, default flat")
+    print(f"\t shards: split dict words into shards, each with its own indexes, default 1")
+    print(f"\t shard-by: shard method, hash(dict code hash) / range(dict code range), default hash")
+    print(f"\t dict: dict name, index dict/dict_words_<dict>.csv into index/<dict>, default dict/dict_words.csv into index")
+    print(f"\t prune: drop index words whose codes equal those of their shorter sub word, report saved to index_prune.json")
+    print(f"\t max-df: drop index words matching more than this many dict words, default 0 means unlimited")
+    print(f"\t prune-sample: validate keywords used to compare search recall with the unpruned flat index, default {indexTuner.PRUNE_RECALL_SAMPLE}, 0 skips it")
+    print(f"\t profile: sample the build and save collapsed stacks to logs/profile_index_*.txt, -profile=cprofile saves a .prof file")
+    print("")
+    print(f"Usage: vector-search query -word=xxx [-dict=default] [-top=3] [-pinyin] [-engine={SEARCH_ENGINE}] [-adaptive] [-repeat=1] [-profile[=cprofile]]")
+    print(f"\t word: search word")
+    print(f"\t repeat: run the search this many times and report mean/p95 latency and mean stage timings")
+    print(f"\t profile: sample the searches and save collapsed stacks to logs/profile_query_*.txt, -profile=cprofile saves a .prof file")
+    print("")
+    print(f"Usage: vector-search prepare [-chunk={dictWords.DICT_SORT_CHUNK_SIZE}]")
+    print(f"\t chunk: lines sorted in memory per chunk when merging dict/*.txt into dict/dict_words.csv, codes of existing words are kept")
+    print("")
+    print(f"Usage: vector-search gc [-keep=3] [-dict=default]")
+    print(f"\t keep: keep the newest complete index directories, default 3")
+    print(f"\t dict: dict name, default the default dict")
+    print("")
+    print(f"Usage: vector-search stats [-dict=default] [-top=3] [-no-model]")
+    print(f"\t dict: dict name, default the default dict")
+    print(f"\t top: neighbours per query used to estimate the rerank cost, default 3")
+    print(f"\t no-model: skip loading the model, model bytes are not reported")
+    print("")
+    print(f"Usage: vector-search tune [-dict=default] [-sample=500] [-top=3] [-recall=0.95] [-factories=HNSW32;IVF1024,Flat] [-dry-run] [-allow-larger]")
+    print(f"\t dict: dict name, tune the latest index directory of the dict")
+    print(f"\t sample: queries sampled from validate_keywords.txt, default 500")
+    print(f"\t top: recall@top of the final search results against the flat index, default 3")
+    print(f"\t recall: recall target, the fastest pareto optimal setting reaching it is used by the server, default 0.95")
+    print(f"\t factories: faiss index factory strings separated by ';', default generated from the vector count")
+    print(f"\t dry-run: only write the results into manifest.json, keep using the current indexes")
+    print(f"\t allow-larger: allow settings larger than the current indexes, by default the index never grows, e.g. on -quantizer=int8")
 
 if __name__ == "__main__":
     multiprocessing.freeze_support()
@@ -81,12 +238,62 @@ if __name__ == "__main__":
         min_gram = int(args.get("min", 3))
         max_gram = int(args.get("max", 5))
         batch = int(args.get("batch", 500))
-        run_index(process_worker=worker, ngram_min=min_gram, ngram_max=max_gram, batch_size=batch)
+        quantizer = args.get("quantizer", "flat")
+        shard_count = int(args.get("shards", 1))
+        shard_method = args.get("shard-by", "hash")
+        collection = args.get("dict")
+        prune = 'prune' in args
+        max_df = int(args.get("max-df", 0))
+        prune_sample = int(args.get("prune-sample", indexTuner.PRUNE_RECALL_SAMPLE))
+        run_index(process_worker=worker, ngram_min=min_gram, ngram_max=max_gram, batch_size=batch, quantizer=quantizer,
+                  shards=shard_count, shard_by=shard_method, collection=collection, prune=prune, max_df=max_df, prune_sample=prune_sample,
+                  profile=(args.get("profile") or "sample") if 'profile' in args else None)
+        sys.exit(0)
+
+    if 'query' in args or 'Query' in args:
+        if not args.get("word"):
+            run_usage()
+            sys.exit(1)
+        run_query(word=args.get("word"), collection=args.get("dict"), top_k=int(args.get("top", 3)), pinyin='pinyin' in args,
+                  engine=args.get("engine", SEARCH_ENGINE), adaptive='adaptive' in args or SEARCH_ADAPTIVE,
+                  repeat=max(int(args.get("repeat", 1)), 1), profile=(args.get("profile") or "sample") if 'profile' in args else None)
+        sys.exit(0)
+
+    if 'prepare' in args or 'Prepare' in args:
+        run_prepare(chunk_size=int(args.get("chunk", dictWords.DICT_SORT_CHUNK_SIZE)))
+        sys.exit(0)
+
+    if 'gc' in args or 'GC' in args:
+        run_gc(keep=int(args.get("keep", 3)), collection=args.get("dict"))
+        sys.exit(0)
+
+    if 'stats' in args or 'Stats' in args:
+        run_stats(collection=args.get("dict"), top_k=int(args.get("top", 3)), with_model='no-model' not in args)
+        sys.exit(0)
+
+    if 'tune' in args or 'Tune' in args:
+        factories = args.get("factories")
+        run_tune(collection=args.get("dict"), sample=int(args.get("sample", 500)), top_k=int(args.get("top", 3)),
+                 recall=float(args.get("recall", 0.95)), factories=factories.split(';') if factories else None,
+                 apply='dry-run' not in args, allow_larger='allow-larger' in args)
         sys.exit(0)
 
     if 'server' in args or 'Server' in args:
         port = int(args.get("port", SERVER_PORT))
         level = args.get("log-level", "info")
-        run_uvicorn(server_port=port, log_level=level)
+        sample = float(args.get("access-sample", ACCESS_LOG_SAMPLE_RATE))
+        slow = float(args.get("slow-ms", ACCESS_LOG_SLOW_MILLIS))
+        memory = int(args.get("dict-memory", COLLECTION_MEMORY_BUDGET_MB))
+        workers = int(args.get("workers", SERVER_WORKERS))
+        encoders = int(args.get("encoders", ENCODER_WORKERS))
+        encoder_batch = int(args.get("encoder-batch", ENCODER_MAX_BATCH))
+        encoder_wait = float(args.get("encoder-wait", ENCODER_BATCH_WAIT_MILLIS))
+        search_budget = float(args.get("search-budget", SEARCH_BUDGET_MILLIS))
+        queue_degrade = int(args.get("queue-degrade", SEARCH_QUEUE_DEGRADE))
+        queue_reject = int(args.get("queue-reject", SEARCH_QUEUE_REJECT))
+        run_uvicorn(server_port=port, log_level=level, access_sample=sample, slow_millis=slow, dict_memory=memory,
+                    workers=workers, encoders=encoders, encoder_batch=encoder_batch, encoder_wait=encoder_wait,
+                    search_budget=search_budget, queue_degrade=queue_degrade, queue_reject=queue_reject, profile='profile' in args,
+                    profile_slowest=int(args.get("profile-slowest", PROFILE_SLOWEST_REQUESTS)))
     else:
         run_usage()
\ No newline at end of file
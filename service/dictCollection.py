@@ -0,0 +1,185 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Any
+
+import basic
+from . import indexManifest
+from . import vectorIndex
+from .dictWords import DEFAULT_COLLECTION, get_latest_directory
+
+
+def _shard_memory(shard_dir: str, shard: vectorIndex.IndexShard) -> int:
+    """
+    估算一个分片占用的内存：只统计实际加载或映射的数据，加载调优索引时不计入原始索引，不计入服务不读取的文件；
+    旧索引目录没有映射文件时，字典及倒排表从CSV解析，以CSV文件大小估算
+    """
+    size = sum(os.path.getsize(vector_index.filepath) for vector_index in (shard.word_index, shard.pinyin_index) if vector_index.filepath)
+    for part, filename in ((shard.dict_words, 'dict_words.csv'), (shard.index_codes, 'index_words.csv'),
+                           (shard.suggest_index, None), (shard.lexical_index, None)):
+        if hasattr(part, 'nbytes'):
+            size += part.nbytes
+        elif part is not None and filename:
+            size += os.path.getsize(os.path.join(shard_dir, filename))
+    return size
+
+
+class DictCollection:
+    """
+    一个命名字典当前使用的索引目录、清单及其分片
+    """
+    def __init__(self, name: str, batch_index_dir: str, shards: list[vectorIndex.IndexShard], manifest: dict[str, Any] | None = None):
+        self.name = name
+        self.batch_index_dir = batch_index_dir
+        self.shards = shards
+        self.manifest = manifest
+        # 多个分片时并行搜索
+        self.executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix=f"{name}-shard") if len(shards) > 1 else None
+        # 索引文件以内存映射方式打开，以映射的数据大小估算占用的内存
+        self.memory = sum(_shard_memory(shard_dir, shard) for shard_dir, shard in zip(vectorIndex.get_shard_directories(batch_index_dir), shards))
+        self.load_time = datetime.now()
+        self.last_used = self.load_time
+        self.last_checked = time.monotonic()
+
+    def close(self):
+        # 不关闭线程池：正在执行的搜索可能还持有它，只释放引用，其它引用都释放后线程池被回收，空闲线程随之退出；
+        # 之后取到这个字典的搜索串行搜索各分片
+        self.executor = None
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "batchIndexDir": self.batch_index_dir,
+            "dictWordSize": sum(len(shard.dict_words) for shard in self.shards),
+            "indexWordSize": sum(len(shard.index_codes) for shard in self.shards),
+            "shardSize": len(self.shards),
+            "quantizer": self.shards[0].word_index.quantizer,
+            "options": self.manifest["options"] if self.manifest else None,
+            "timings": self.manifest["timings"] if self.manifest else None,
+            "memory": self.memory,
+            "loadTime": self.load_time.strftime("%Y-%m-%d %H:%M:%S"),
+            "lastUsedTime": self.last_used.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+def load_collection(name: str, batch_index_dir: str | None = None) -> DictCollection | None:
+    batch_index_dir = batch_index_dir or get_latest_directory(name)
+    if not batch_index_dir:
+        return None
+    shards = vectorIndex.load_index_shards(mmap=True, batch_index_dir=batch_index_dir)
+    if not shards:
+        return None
+    return DictCollection(name, batch_index_dir, shards, indexManifest.load_manifest(batch_index_dir))
+
+
+class CollectionCache:
+    """
+    按需加载命名字典，总内存超过预算时淘汰最久未使用的字典
+    """
+    def __init__(self, memory_budget: int = 0, refresh_seconds: float = 0):
+        self.memory_budget = memory_budget  # 字节，0表示不限制
+        # 多个服务进程时，索引任务只在接收请求的进程中切换索引目录，其它进程定期检查最新的索引目录，0表示不检查
+        self.refresh_seconds = refresh_seconds
+        self._collections: OrderedDict[str, DictCollection] = OrderedDict()
+        # 正在加载的字典，同一字典只加载一次；锁只保护字典表，加载期间不持有锁，不阻塞其它字典的搜索
+        self._loading: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str = DEFAULT_COLLECTION) -> DictCollection | None:
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is not None:
+                self._collections.move_to_end(name)
+                collection.last_used = datetime.now()
+        if collection is None:
+            # 首次加载，同时到达的请求等待同一个加载结果
+            collection = self._load(name, None, current=None, wait=True)
+            if collection is not None:
+                collection.last_used = datetime.now()
+            return collection
+        return self._refresh(collection)
+
+    def activate(self, name: str, batch_index_dir: str) -> DictCollection:
+        # 切换到新的索引目录，正在执行的搜索继续使用旧的分片
+        collection = load_collection(name, batch_index_dir)
+        if collection is None:
+            raise RuntimeError(f"Failed to load index shards from {batch_index_dir}")
+        with self._lock:
+            self._put(collection)
+        basic.log().info(f"Activated collection {name}: {batch_index_dir}")
+        return collection
+
+    def set_memory_budget(self, memory_budget: int):
+        with self._lock:
+            self.memory_budget = memory_budget
+            self._evict()
+
+    def set_refresh_seconds(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+
+    def loaded(self) -> list[DictCollection]:
+        with self._lock:
+            return list(self._collections.values())
+
+    def _refresh(self, collection: DictCollection) -> DictCollection:
+        if self.refresh_seconds <= 0 or time.monotonic() - collection.last_checked < self.refresh_seconds:
+            return collection
+        collection.last_checked = time.monotonic()
+        latest = get_latest_directory(collection.name)
+        if not latest or latest == collection.batch_index_dir:
+            return collection
+        # 刷新期间其它请求继续使用当前的字典，不等待
+        refreshed = self._load(collection.name, latest, current=collection, wait=False)
+        if refreshed is None:
+            return collection
+        basic.log().info(f"Refreshed collection {collection.name}: {refreshed.batch_index_dir}")
+        return refreshed
+
+    def _load(self, name: str, batch_index_dir: str | None, current: DictCollection | None, wait: bool) -> DictCollection | None:
+        """
+        在锁外加载字典，只在替换字典表中的项时持有锁；字典表中的项已不是 current 时(被 activate 或其它请求替换)，不覆盖它
+
+        :param wait: 其它请求正在加载同一字典时，True等待其结果，False直接返回None
+        """
+        with self._lock:
+            future = self._loading.get(name)
+            owner = future is None
+            if owner:
+                future = self._loading[name] = Future()
+        if not owner:
+            return future.result() if wait else None
+        try:
+            collection = load_collection(name, batch_index_dir)
+            if collection is not None:
+                with self._lock:
+                    existing = self._collections.get(name)
+                    if existing is current:
+                        self._put(collection)
+                    else:
+                        collection = existing
+            future.set_result(collection)
+            return collection
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(name, None)
+
+    def _put(self, collection: DictCollection):
+        old = self._collections.pop(collection.name, None)
+        if old:
+            old.close()
+        self._collections[collection.name] = collection
+        self._evict()
+
+    def _evict(self):
+        # 最近使用的字典总是保留
+        while self.memory_budget > 0 and len(self._collections) > 1 and \
+                sum(c.memory for c in self._collections.values()) > self.memory_budget:
+            name, collection = self._collections.popitem(last=False)
+            collection.close()
+            basic.log().info(f"Evicted collection {name}, memory={collection.memory}")
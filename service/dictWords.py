@@ -1,18 +1,27 @@
 import csv
+import heapq
+import json
 import os
 import re
 import shutil
+import tempfile
+import time
+import zlib
+from typing import Iterable, Iterator
 
 import jieba
+import numpy as np
 from pypinyin import pinyin, Style
+from scipy import sparse
 
 import basic
 
 
 class DictWord:
-    def __init__(self, code: str, word: str):
+    def __init__(self, code: str, word: str, weight: float = 0.0):
         self.code = code
         self.word = word
+        self.weight = weight  # 输入提示的排序权重，字典文件可选的第三列
 
     def __str__(self):
         return f"code={self.code}, word={self.word}"
@@ -21,6 +30,207 @@ class DictWord:
         return self.__str__()
 
 
+# 未指定字典名称时使用的默认字典
+DEFAULT_COLLECTION = "default"
+
+# 索引创建成功后写入的清单文件，没有清单的索引目录视为未完成
+MANIFEST_FILE = 'manifest.json'
+
+# 创建索引时在索引目录中写入的标记文件，写入清单后删除；创建中断的目录保留标记，不会被当作旧版本的索引目录
+BUILDING_FILE = 'building.flag'
+
+# 旧版本创建的索引目录没有清单，每个分片目录都有这些文件时才可能是完整的
+LEGACY_INDEX_FILES = ['dict_words.csv', 'index_words.csv', 'word_index.bin', 'pinyin_index.bin']
+
+# 剪枝报告文件，记录剪枝前后的索引词数量及召回率
+PRUNE_REPORT_FILE = 'index_prune.json'
+
+# 字典词条到代码的映射，按词条排序；保留出现过的全部词条，已有词条的代码保持不变，新词条分配新代码
+DICT_CODES_FILE = 'dict_codes.csv'
+
+# 分片方式：hash按词条代码的crc32取模，range按字典顺序连续切分
+SHARD_METHODS = ("hash", "range")
+
+# 整理字典时外部排序每个分块的行数
+DICT_SORT_CHUNK_SIZE = 1000000
+
+# 输入提示的前缀区间超过该键数时预先排序，预先保存的键数为 /suggest 不扫描区间时的最大top
+SUGGEST_SCAN_LIMIT = 256
+SUGGEST_TOP_N = 50
+
+# 内存映射格式的字典及倒排文件，多进程共享同一份页缓存
+MAPPED_FILES = ['dict_words_blob.npy', 'dict_words_offsets.npy', 'index_codes.npy', 'index_codes_offsets.npy']
+
+
+class MappedDictWords:
+    """
+    内存映射的字典词条，按行号访问，offsets[2i]~offsets[2i+1]为词条代码，offsets[2i+1]~offsets[2i+2]为词条内容
+    """
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return (len(self.offsets) - 1) // 2
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.blob.nbytes + self.offsets.nbytes)
+
+    def __getitem__(self, row) -> DictWord:
+        i = int(row) * 2
+        start, middle, end = int(self.offsets[i]), int(self.offsets[i + 1]), int(self.offsets[i + 2])
+        data = self.blob[start:end].tobytes()
+        return DictWord(data[:middle - start].decode('utf-8'), data[middle - start:].decode('utf-8'))
+
+
+class MappedIndexCodes:
+    """
+    内存映射的倒排表，第i个索引词对应的字典行号为codes[offsets[i]:offsets[i+1]]
+    """
+    def __init__(self, codes: np.ndarray, offsets: np.ndarray):
+        self.codes = codes
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codes.nbytes + self.offsets.nbytes)
+
+    def __getitem__(self, index) -> np.ndarray:
+        return self.codes[int(self.offsets[index]):int(self.offsets[index + 1])]
+
+
+def _lower_bound(blob: np.ndarray, offsets: np.ndarray, key: bytes) -> int:
+    # 按UTF-8字节序排序的键表中第一个不小于key的位置，第i个键为blob[offsets[i]:offsets[i+1]]
+    lo, hi = 0, len(offsets) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if blob[int(offsets[mid]):int(offsets[mid + 1])].tobytes() < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class SuggestIndex:
+    """
+    输入提示的前缀索引：词条、全拼、拼音首字母按UTF-8字节序排序后内存映射，
+    二分查找前缀所在区间，再按 权重降序、词长升序 取前N个词条；
+    区间超过 SUGGEST_SCAN_LIMIT 个键的热门前缀在创建索引时预先排好前 SUGGEST_TOP_N 个键，查询时不扫描区间
+    """
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, rows: np.ndarray, weights: np.ndarray, lengths: np.ndarray,
+                 hot_blob: np.ndarray | None = None, hot_offsets: np.ndarray | None = None, hot_top: np.ndarray | None = None):
+        self.blob = blob
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self.lengths = lengths
+        # 热门前缀同样按字节序排序，hot_top[i]为第i个前缀排序后的键位置，不足时以-1补齐；旧版本的索引目录没有
+        self.hot_blob = hot_blob
+        self.hot_offsets = hot_offsets
+        self.hot_top = hot_top
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = (self.blob, self.offsets, self.rows, self.weights, self.lengths, self.hot_blob, self.hot_offsets, self.hot_top)
+        return int(sum(array.nbytes for array in arrays if array is not None))
+
+    def _hot_positions(self, key: bytes, top_n: int) -> np.ndarray | None:
+        if self.hot_top is None or top_n > self.hot_top.shape[1]:
+            return None
+        i = _lower_bound(self.hot_blob, self.hot_offsets, key)
+        if i >= len(self.hot_top) or self.hot_blob[int(self.hot_offsets[i]):int(self.hot_offsets[i + 1])].tobytes() != key:
+            return None
+        positions = self.hot_top[i]
+        return positions[positions >= 0]
+
+    def suggest(self, prefix: str, top_n: int = 10) -> list[tuple[int, float]]:
+        """
+        :return: [(字典行号, 权重)]
+        """
+        key = suggest_key(prefix).encode('utf-8')
+        if not key:
+            return []
+        # 0xFF不会出现在UTF-8编码中，以前缀开头的键都小于 prefix + 0xFF
+        lo, hi = _lower_bound(self.blob, self.offsets, key), _lower_bound(self.blob, self.offsets, key + b'\xff')
+        if lo >= hi:
+            return []
+        positions = self._hot_positions(key, top_n) if hi - lo > SUGGEST_SCAN_LIMIT else None
+        if positions is None:
+            positions = lo + np.lexsort((self.lengths[lo:hi], -self.weights[lo:hi]))
+        results = []
+        exist_rows = set()
+        for i in positions:
+            row = int(self.rows[i])
+            if row in exist_rows:
+                continue
+            exist_rows.add(row)
+            results.append((row, float(self.weights[i])))
+            if len(results) >= top_n:
+                break
+        return results
+
+
+class LexicalIndex:
+    """
+    字符 1~3-gram 的TF-IDF稀疏矩阵(行为字典词条，按列压缩后内存映射)，
+    查询词转为稀疏向量，稀疏矩阵乘向量得到余弦相似度最高的词条，不经过模型；
+    词表按UTF-8字节序排序后内存映射，列号即排序后的位置，二分查找n-gram所在的列
+    """
+    def __init__(self, matrix: sparse.csc_matrix, vocabulary: np.ndarray, idf: np.ndarray):
+        self.matrix = matrix
+        self.vocabulary = vocabulary
+        self.idf = idf
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return int(sum(array.nbytes for array in (self.matrix.data, self.matrix.indices, self.matrix.indptr, self.vocabulary, self.idf)))
+
+    def columns(self, grams: list[str]) -> np.ndarray:
+        """
+        :return: 每个n-gram所在的列，不在词表中的为-1
+        """
+        encoded = [gram.encode('utf-8') for gram in grams]
+        # 比词表最长的键还长的n-gram不在词表中，转为定长字节串时会被截断，单独排除
+        fits = np.array([len(key) <= self.vocabulary.itemsize for key in encoded], dtype=bool)
+        keys = np.array(encoded, dtype=self.vocabulary.dtype)
+        if not len(self.vocabulary):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.vocabulary, keys), len(self.vocabulary) - 1)
+        return np.where(fits & (self.vocabulary[positions] == keys), positions, -1)
+
+    def search(self, word: str, top_n: int = 10) -> list[tuple[int, float]]:
+        """
+        :return: [(字典行号, 余弦相似度)]，按相似度降序
+        """
+        grams = char_ngrams(suggest_key(word))
+        if not grams:
+            return []
+        found = self.columns(grams)
+        columns, counts = np.unique(found[found >= 0], return_counts=True)
+        if not len(columns):
+            return []
+        weights = counts.astype(np.float32) * self.idf[columns]
+        weights /= np.linalg.norm(weights)
+        # 只取查询中出现的列，稀疏矩阵乘稀疏向量，结果只包含有重叠的词条
+        scores = (self.matrix[:, columns] @ sparse.csc_matrix(weights.reshape(-1, 1))).tocsc()
+        rows, similarities = scores.indices, scores.data
+        if len(rows) > top_n:
+            top = np.argpartition(-similarities, top_n)[:top_n]
+            rows, similarities = rows[top], similarities[top]
+        order = np.argsort(-similarities, kind='stable')
+        return [(int(rows[i]), float(similarities[i])) for i in order]
+
+
 def trim_word(word):
     # 使用正则表达式匹配所有非字母数字的字符
     cleaned_word = re.sub(r'\W', '', word)
@@ -33,6 +243,22 @@ def pinyin_word(word: str) -> str:
         pinyin_str += item[0] + ' '
     return pinyin_str.strip()
 
+def suggest_key(word: str) -> str:
+    return trim_word(word).lower()
+
+def suggest_keys(word: str) -> set[str]:
+    """
+    词条的输入提示键：词条本身、全拼、拼音首字母，如 注射液 -> 注射液、zhusheye、zsy
+    """
+    keys = {suggest_key(word),
+            suggest_key(''.join(item[0] for item in pinyin(word, style=Style.NORMAL))),
+            suggest_key(''.join(item[0] for item in pinyin(word, style=Style.FIRST_LETTER)))}
+    keys.discard('')
+    return keys
+
+def char_ngrams(word: str, ngram_min: int = 1, ngram_max: int = 3) -> list[str]:
+    return [word[i:i + length] for length in range(ngram_min, ngram_max + 1) for i in range(len(word) - length + 1)]
+
 def split_word(word: str, ngram_min : int = 3, ngram_max : int = 5) -> set[str]:
     sub_words = set()
 
@@ -47,11 +273,32 @@ def split_word(word: str, ngram_min : int = 3, ngram_max : int = 5) -> set[str]:
             sub_words.add(w)
     return sub_words
 
-def get_latest_directory() -> str | None:
-    # 定义时间格式的正则表达式
+def is_default_collection(collection: str | None) -> bool:
+    return not collection or collection == DEFAULT_COLLECTION
+
+def is_valid_collection_name(collection: str) -> bool:
+    return bool(re.match(r'^[A-Za-z][A-Za-z0-9_-]{0,63}$', collection))
+
+def get_index_base_directory(collection: str | None = None) -> str:
+    """
+    默认字典的索引目录为 index/，命名字典为 index/<collection>/
+    """
     base_path = os.path.join(basic.func.get_executable_directory(), 'index')
+    return base_path if is_default_collection(collection) else os.path.join(base_path, collection)
+
+def get_dict_words_path(collection: str | None = None) -> str:
+    """
+    默认字典文件为 dict/dict_words.csv，命名字典为 dict/dict_words_<collection>.csv
+    """
+    filename = 'dict_words.csv' if is_default_collection(collection) else f'dict_words_{collection}.csv'
+    return os.path.join(basic.func.get_executable_directory(), 'dict', filename)
+
+def get_latest_directory(collection: str | None = None) -> str | None:
+    # 定义时间格式的正则表达式
+    base_path = get_index_base_directory(collection)
     if not os.path.exists(base_path):
-        os.mkdir(base_path)
+        if is_default_collection(collection):
+            os.mkdir(base_path)
         return None
 
     time_pattern = re.compile(r'^\d{14}$')  # 匹配 14 位数字 (yyyyMMddHHmmss)
@@ -59,52 +306,163 @@ def get_latest_directory() -> str | None:
     # 获取 base_path 下的所有子目录，并且目录名符合时间格式
     valid_dirs = [d for d in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, d)) and time_pattern.match(d)]
 
-    # 如果没有符合条件的目录，返回 None
-    if not valid_dirs:
-        return None
+    # 返回名称最大的、已写入清单的目录；旧版本创建的完整目录补写清单后使用
+    from . import indexManifest  # indexManifest 依赖本模块，在使用时导入
+    for d in sorted(valid_dirs, reverse=True):
+        batch_index_dir = os.path.join(base_path, d)
+        if os.path.exists(os.path.join(batch_index_dir, MANIFEST_FILE)) or indexManifest.migrate_legacy_generation(batch_index_dir):
+            return batch_index_dir
+    return None
+
+def _write_sorted_run(rows: list[list[str]], directory: str, index: int) -> str:
+    rows.sort()
+    filepath = os.path.join(directory, f"run_{index:05d}.csv")
+    with open(filepath, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        previous = None
+        for row in rows:
+            if row[0] != previous:
+                previous = row[0]
+                writer.writerow(row)
+    return filepath
+
+def _read_csv_rows(filepath: str) -> Iterator[list[str]]:
+    with open(filepath, 'r', newline='', encoding='utf-8') as file:
+        yield from csv.reader(file)
+
+def external_sort(rows: Iterable[list[str]], temp_dir: str, chunk_size: int = DICT_SORT_CHUNK_SIZE) -> Iterator[list[str]]:
+    """
+    外部归并排序：每 chunk_size 行排序后写入临时文件，最后多路归并；按第一列去重，保留排序最前的行
 
-    # 返回名称最大的目录
-    return os.path.join(base_path, max(valid_dirs))
+    :param temp_dir: 临时文件目录，由调用方在迭代结束后删除
+    """
+    runs = []
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            runs.append(_write_sorted_run(chunk, temp_dir, len(runs)))
+            chunk = []
+    chunk.sort()
+    previous = None
+    for row in heapq.merge(*(_read_csv_rows(run) for run in runs), chunk):
+        if row[0] != previous:
+            previous = row[0]
+            yield row
 
-def prepare_dict_words():
+def _read_txt_words(directory: str, stats: dict[str, int]) -> Iterator[list[str]]:
     log = basic.log()
+    for filename in sorted(os.listdir(directory)):
+        # 只处理 .txt 文件
+        if not filename.endswith(".txt"):
+            continue
+        lines = 0
+        with open(os.path.join(directory, filename), 'r', encoding='utf-8') as file:
+            for line in file:
+                lines += 1
+                # 移除行尾的换行符并去除多余空白
+                word = trim_word(line.strip())
+                if word:  # 确保行不为空
+                    yield [word]
+        stats["lines"] += lines
+        log.info(f">>read {lines} lines from {filename}")
+
+def _read_dict_codes(codes_path: str, dict_words_path: str, temp_dir: str, chunk_size: int) -> Iterator[list[str]]:
+    # 没有映射文件时，从现有的字典文件生成，保持上次整理(或上传)的代码
+    if os.path.exists(codes_path):
+        return _read_csv_rows(codes_path)
+    if os.path.exists(dict_words_path):
+        return external_sort(([row[1], row[0]] for row in _read_csv_rows(dict_words_path)), temp_dir, chunk_size)
+    return iter([])
+
+def _read_dict_weights(dict_words_path: str, temp_dir: str, chunk_size: int) -> Iterator[list[str]]:
+    # 当前字典文件可选的第三列权重，按词条排序；整理后的字典沿用每个词条的权重
+    if not os.path.exists(dict_words_path):
+        return iter([])
+    rows = ([row[1], row[2].strip()] for row in _read_csv_rows(dict_words_path) if len(row) > 2 and row[2].strip())
+    return external_sort(rows, temp_dir, chunk_size)
+
+def _next_dict_code(codes_path: str, dict_words_path: str) -> int:
+    # 新代码从已有的最大数字代码之后分配，不重复使用已删除词条的代码
+    filepath = codes_path if os.path.exists(codes_path) else dict_words_path
+    if not os.path.exists(filepath):
+        return 0
+    column = 1 if filepath == codes_path else 0
+    codes = (row[column] for row in _read_csv_rows(filepath))
+    return max((int(code) for code in codes if code.isdigit()), default=-1) + 1
+
+def prepare_dict_words(chunk_size: int = DICT_SORT_CHUNK_SIZE) -> dict[str, float]:
+    """
+    把 dict/ 下全部 .txt 文件(每行一个词条)整理为 dict/dict_words.csv：外部归并排序并去重，内存占用只与 chunk_size 有关；
+    按 dict/dict_codes.csv 保持已有词条的代码，只为新词条分配代码；保留当前字典文件中词条的权重(可选的第三列)
+
+    :param chunk_size: 外部排序每个分块的行数
+    :return: 读取行数、词条数、新词条数、耗时及吞吐量
+    """
+    log = basic.log()
+    start = time.perf_counter()
     directory = os.path.join(basic.func.get_executable_directory(), 'dict')
     basic.func.touch_dir(directory)
-    words_set = set()
-    # 遍历指定目录下的所有文件
-    for filename in os.listdir(directory):
-        # 只处理 .txt 文件
-        if filename.endswith(".txt"):
-            filepath = os.path.join(directory, filename)
-            # 打开文件，读取每一行并将其添加到 set 中
-            with open(filepath, 'r', encoding='utf-8') as file:
-                for line in file:
-                    # 移除行尾的换行符并去除多余空白
-                    word = trim_word(line.strip())
-                    if word:  # 确保行不为空
-                        words_set.add(word)
-            log.info(f">>loaded {len(words_set)} words from {filename}")
-    log.info(f">>total {len(words_set)} words loaded")
-    word_list = list(words_set)
-    word_list.sort()
-    filepath = os.path.join(basic.func.get_executable_directory(), 'dict', 'dict_words.csv')
-    if os.path.exists(filepath):
-        os.remove(filepath)
-    row_index = 0
-    with open(filepath, 'w', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        # 逐行写入数据
-        for word in word_list:
-            dw = DictWord(row_index, word)
-            writer.writerow([dw.code, dw.word])
-            row_index = row_index + 1
-    log.info(f">>saved {len(word_list)} words to {filepath}")
+    dict_words_path = get_dict_words_path()
+    codes_path = os.path.join(directory, DICT_CODES_FILE)
+    stats = {"lines": 0, "words": 0, "newWords": 0, "retiredWords": 0}
+    next_code = _next_dict_code(codes_path, dict_words_path)
+
+    with tempfile.TemporaryDirectory(prefix='dict_sort.', dir=directory) as temp_dir:
+        os.mkdir(os.path.join(temp_dir, 'words'))
+        os.mkdir(os.path.join(temp_dir, 'codes'))
+        os.mkdir(os.path.join(temp_dir, 'weights'))
+        words = external_sort(_read_txt_words(directory, stats), os.path.join(temp_dir, 'words'), chunk_size)
+        codes = _read_dict_codes(codes_path, dict_words_path, os.path.join(temp_dir, 'codes'), chunk_size)
+        weights = _read_dict_weights(dict_words_path, os.path.join(temp_dir, 'weights'), chunk_size)
+        words_temp = os.path.join(temp_dir, 'dict_words.csv')
+        codes_temp = os.path.join(temp_dir, DICT_CODES_FILE)
+        # 两个按词条排序的流合并：两边都有的词条沿用代码，只在映射中的词条已从字典删除，只在字典中的是新词条
+        with open(words_temp, 'w', newline='', encoding='utf-8') as words_file, \
+                open(codes_temp, 'w', newline='', encoding='utf-8') as codes_file:
+            words_writer = csv.writer(words_file)
+            codes_writer = csv.writer(codes_file)
+            word = next(words, None)
+            code_row = next(codes, None)
+            weight_row = next(weights, None)
+            while word is not None or code_row is not None:
+                if code_row is not None and (word is None or code_row[0] < word[0]):
+                    # 已从字典删除的词条保留在映射中，代码不再分配
+                    stats["retiredWords"] += 1
+                    codes_writer.writerow(code_row)
+                    code_row = next(codes, None)
+                    continue
+                if code_row is not None and code_row[0] == word[0]:
+                    code = code_row[1]
+                    code_row = next(codes, None)
+                else:
+                    code = str(next_code)
+                    next_code += 1
+                    stats["newWords"] += 1
+                # 权重流同样按词条排序，跳过已删除的词条
+                while weight_row is not None and weight_row[0] < word[0]:
+                    weight_row = next(weights, None)
+                codes_writer.writerow([word[0], code])
+                if weight_row is not None and weight_row[0] == word[0]:
+                    words_writer.writerow([code, word[0], weight_row[1]])
+                else:
+                    words_writer.writerow([code, word[0]])
+                stats["words"] += 1
+                word = next(words, None)
+        os.replace(codes_temp, codes_path)
+        os.replace(words_temp, dict_words_path)
 
+    seconds = time.perf_counter() - start
+    stats["seconds"] = round(seconds, 3)
+    stats["linesPerSecond"] = round(stats["lines"] / seconds, 1) if seconds > 0 else 0.0
+    log.info(f">>saved {stats['words']} words ({stats['newWords']} new, {stats['retiredWords']} retired) from {stats['lines']} lines "
+             f"to {dict_words_path} in {stats['seconds']}s, {stats['linesPerSecond']} lines/s")
+    return stats
 
-def _copy_and_read_dict_words(batch_index_dir : str) -> list[DictWord]:
-    if not os.path.exists(batch_index_dir):
-        os.mkdir(batch_index_dir)
-    src_path = os.path.join(basic.func.get_executable_directory(), 'dict', 'dict_words.csv')
+
+def _copy_and_read_dict_words(batch_index_dir : str, collection : str | None = None) -> list[DictWord]:
+    os.makedirs(batch_index_dir, exist_ok=True)
+    src_path = get_dict_words_path(collection)
     if not os.path.exists(src_path):
         print(f"File not found: {src_path}")
         return []
@@ -115,16 +473,161 @@ def _copy_and_read_dict_words(batch_index_dir : str) -> list[DictWord]:
         words = []
         # 逐行读取数据
         for row in reader:
-            dw = DictWord(row[0], row[1])
+            dw = DictWord(row[0], row[1], float(row[2]) if len(row) > 2 and row[2].strip() else 0.0)
             words.append(dw)
     return words
 
-def load_dict_word_set() -> dict[str, DictWord]:
+def _has_mapped_files(batch_index_dir: str) -> bool:
+    return all(os.path.exists(os.path.join(batch_index_dir, filename)) for filename in MAPPED_FILES)
+
+def _save_offsets(filepath: str, lengths: list[int]):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(filepath, offsets)
+
+def _save_mapped_dict_words(batch_index_dir: str, words: list[DictWord]):
+    chunks = []
+    for word in words:
+        chunks.append(str(word.code).encode('utf-8'))
+        chunks.append(word.word.encode('utf-8'))
+    np.save(os.path.join(batch_index_dir, 'dict_words_blob.npy'), np.frombuffer(b''.join(chunks), dtype=np.uint8))
+    _save_offsets(os.path.join(batch_index_dir, 'dict_words_offsets.npy'), [len(chunk) for chunk in chunks])
+
+def _save_mapped_index_codes(batch_index_dir: str, index_rows: list[list[int]]):
+    codes = np.fromiter((row for rows in index_rows for row in rows), dtype=np.int32)
+    np.save(os.path.join(batch_index_dir, 'index_codes.npy'), codes)
+    _save_offsets(os.path.join(batch_index_dir, 'index_codes_offsets.npy'), [len(rows) for rows in index_rows])
+
+def _suggest_hot_prefixes(keys: list[str], rows: np.ndarray, ranks: np.ndarray) -> Iterator[tuple[str, list[int]]]:
+    """
+    键区间超过 SUGGEST_SCAN_LIMIT 的前缀及其排序后的前 SUGGEST_TOP_N 个键位置(按词条去重)，
+    逐字加长前缀，只在上一层的热门区间内继续切分
+    """
+    ranges = [(0, len(keys))]
+    depth = 1
+    while ranges:
+        next_ranges = []
+        for start, end in ranges:
+            lo = start
+            while lo < end:
+                # 键已按字节序排序，相同前缀的键连续
+                prefix = keys[lo][:depth]
+                hi = lo + 1
+                while hi < end and keys[hi][:depth] == prefix:
+                    hi += 1
+                if hi - lo > SUGGEST_SCAN_LIMIT and len(prefix) == depth:
+                    positions, exist_rows = [], set()
+                    for i in lo + np.argsort(ranks[lo:hi], kind='stable'):
+                        if int(rows[i]) not in exist_rows:
+                            exist_rows.add(int(rows[i]))
+                            positions.append(int(i))
+                            if len(positions) >= SUGGEST_TOP_N:
+                                break
+                    yield prefix, positions
+                    next_ranges.append((lo, hi))
+                lo = hi
+        ranges = next_ranges
+        depth += 1
+
+def _save_suggest_index(batch_index_dir: str, words: list[DictWord]):
+    entries = sorted((key.encode('utf-8'), row) for row, word in enumerate(words) for key in suggest_keys(word.word))
+    rows = np.array([row for _, row in entries], dtype=np.int32)
+    weights = np.array([words[row].weight for _, row in entries], dtype=np.float32)
+    lengths = np.array([len(words[row].word) for _, row in entries], dtype=np.int32)
+    np.save(os.path.join(batch_index_dir, 'suggest_keys_blob.npy'), np.frombuffer(b''.join(key for key, _ in entries), dtype=np.uint8))
+    _save_offsets(os.path.join(batch_index_dir, 'suggest_keys_offsets.npy'), [len(key) for key, _ in entries])
+    np.save(os.path.join(batch_index_dir, 'suggest_rows.npy'), rows)
+    np.save(os.path.join(batch_index_dir, 'suggest_weights.npy'), weights)
+    np.save(os.path.join(batch_index_dir, 'suggest_lengths.npy'), lengths)
+    # 全部键按 权重降序、词长升序 的名次，同名次保持字节序，与查询时排序区间的结果相同
+    ranks = np.empty(len(entries), dtype=np.int64)
+    ranks[np.lexsort((lengths, -weights))] = np.arange(len(entries))
+    hot = list(_suggest_hot_prefixes([key.decode('utf-8') for key, _ in entries], rows, ranks))
+    hot.sort(key=lambda item: item[0].encode('utf-8'))
+    hot_keys = [prefix.encode('utf-8') for prefix, _ in hot]
+    hot_top = np.full((len(hot), SUGGEST_TOP_N), -1, dtype=np.int64)
+    for i, (_, positions) in enumerate(hot):
+        hot_top[i, :len(positions)] = positions
+    np.save(os.path.join(batch_index_dir, 'suggest_hot_blob.npy'), np.frombuffer(b''.join(hot_keys), dtype=np.uint8))
+    _save_offsets(os.path.join(batch_index_dir, 'suggest_hot_offsets.npy'), [len(key) for key in hot_keys])
+    np.save(os.path.join(batch_index_dir, 'suggest_hot_top.npy'), hot_top)
+    print(f"saved {len(entries)} suggest keys, {len(hot)} hot prefixes to {batch_index_dir}")
+
+def load_suggest_index(batch_index_dir: str | None = None) -> SuggestIndex | None:
+    batch_index_dir = batch_index_dir or get_latest_directory()
+    if not batch_index_dir:
+        return None
+    filenames = ['suggest_keys_blob.npy', 'suggest_keys_offsets.npy', 'suggest_rows.npy', 'suggest_weights.npy', 'suggest_lengths.npy']
+    filepaths = [os.path.join(batch_index_dir, filename) for filename in filenames]
+    if not all(os.path.exists(filepath) for filepath in filepaths):
+        basic.log().warning(f"Suggest index not found in {batch_index_dir}")
+        return None
+    # 旧版本的索引目录没有热门前缀，查询时扫描前缀区间
+    hot_filepaths = [os.path.join(batch_index_dir, filename) for filename in ['suggest_hot_blob.npy', 'suggest_hot_offsets.npy', 'suggest_hot_top.npy']]
+    if all(os.path.exists(filepath) for filepath in hot_filepaths):
+        filepaths += hot_filepaths
+    return SuggestIndex(*(np.load(filepath, mmap_mode='r') for filepath in filepaths))
+
+def _save_lexical_index(batch_index_dir: str, words: list[DictWord]):
+    # 词条与输入提示键同样规范化(去掉符号、小写)，统计字符 1~3-gram 的词频和文档频率
+    word_grams = []
+    for word in words:
+        grams = {}
+        for gram in char_ngrams(suggest_key(word.word)):
+            grams[gram] = grams.get(gram, 0) + 1
+        word_grams.append(grams)
+    # 列号为n-gram按UTF-8字节序排序后的位置，加载时二分查找
+    vocabulary = sorted({gram.encode('utf-8') for grams in word_grams for gram in grams})
+    columns_of = {gram.decode('utf-8'): column for column, gram in enumerate(vocabulary)}
+    rows, columns, counts = [], [], []
+    for row, grams in enumerate(word_grams):
+        rows.extend([row] * len(grams))
+        columns.extend(columns_of[gram] for gram in grams)
+        counts.extend(grams.values())
+    matrix = sparse.csr_matrix((np.array(counts, dtype=np.float32), (np.array(rows, dtype=np.int64), np.array(columns, dtype=np.int64))),
+                               shape=(len(words), len(vocabulary)))
+    document_frequency = np.bincount(matrix.indices, minlength=len(vocabulary))
+    idf = (np.log((1 + len(words)) / (1 + document_frequency)) + 1).astype(np.float32)
+    matrix = matrix.multiply(idf.reshape(1, -1)).tocsr()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.diags(1 / norms).dot(matrix).astype(np.float32).tocsc()
+    index_dtype = np.int32 if matrix.nnz < np.iinfo(np.int32).max else np.int64
+    np.save(os.path.join(batch_index_dir, 'lexical_data.npy'), matrix.data)
+    np.save(os.path.join(batch_index_dir, 'lexical_indices.npy'), matrix.indices.astype(index_dtype))
+    np.save(os.path.join(batch_index_dir, 'lexical_indptr.npy'), matrix.indptr.astype(index_dtype))
+    np.save(os.path.join(batch_index_dir, 'lexical_idf.npy'), idf)
+    # 定长字节串数组，可以内存映射并直接用 searchsorted 查找
+    np.save(os.path.join(batch_index_dir, 'lexical_vocab.npy'), np.array(vocabulary, dtype=f"S{max(map(len, vocabulary), default=1)}"))
+    # 末尾的词条可能没有n-gram，行数不能由非零元素推出，与矩阵一起保存
+    with open(os.path.join(batch_index_dir, 'lexical_meta.json'), 'w', encoding='utf-8') as file:
+        json.dump({"shape": list(matrix.shape)}, file)
+    print(f"saved lexical index {matrix.shape}, nnz={matrix.nnz} to {batch_index_dir}")
+
+def load_lexical_index(batch_index_dir: str | None = None) -> LexicalIndex | None:
+    batch_index_dir = batch_index_dir or get_latest_directory()
+    if not batch_index_dir:
+        return None
+    filenames = ['lexical_data.npy', 'lexical_indices.npy', 'lexical_indptr.npy', 'lexical_idf.npy', 'lexical_vocab.npy', 'lexical_meta.json']
+    filepaths = [os.path.join(batch_index_dir, filename) for filename in filenames]
+    if not all(os.path.exists(filepath) for filepath in filepaths):
+        basic.log().warning(f"Lexical index not found in {batch_index_dir}")
+        return None
+    data, indices, indptr, idf, vocabulary = (np.load(filepath, mmap_mode='r') for filepath in filepaths[:5])
+    with open(filepaths[5], 'r', encoding='utf-8') as file:
+        shape = tuple(json.load(file)["shape"])
+    matrix = sparse.csc_matrix((data, indices, indptr), shape=shape, copy=False)
+    return LexicalIndex(matrix, vocabulary, idf)
+
+def load_dict_word_set(mmap: bool = False, batch_index_dir: str | None = None) -> dict[str, DictWord] | MappedDictWords:
     log = basic.log()
-    batch_index_dir = get_latest_directory()
+    batch_index_dir = batch_index_dir or get_latest_directory()
     if not batch_index_dir:
         log.error(f"Batch index directory not found")
         return dict()
+    if mmap and _has_mapped_files(batch_index_dir):
+        return MappedDictWords(np.load(os.path.join(batch_index_dir, 'dict_words_blob.npy'), mmap_mode='r'),
+                               np.load(os.path.join(batch_index_dir, 'dict_words_offsets.npy'), mmap_mode='r'))
     filepath = os.path.join(batch_index_dir, 'dict_words.csv')
     if not os.path.exists(filepath):
         log.error(f"File not found: {filepath}")
@@ -138,9 +641,103 @@ def load_dict_word_set() -> dict[str, DictWord]:
             words[dw.code] = dw
     return words
 
-def prepare_index_words(batch_index_dir : str, ngram_min : int = 3, ngram_max : int = 5) -> list[str]:
-    words = _copy_and_read_dict_words(batch_index_dir)
-    keys = []
+def _write_dict_words(batch_index_dir: str, words: list[DictWord]):
+    filepath = os.path.join(batch_index_dir, 'dict_words.csv')
+    with open(filepath, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        for word in words:
+            writer.writerow([word.code, word.word, word.weight] if word.weight else [word.code, word.word])
+
+def split_dict_words(words: list[DictWord], shards: int, shard_by: str = "hash") -> list[list[DictWord]]:
+    """
+    将字典词条拆分为多个分片
+
+    :param words: 字典词条
+    :param shards: 分片数量
+    :param shard_by: hash按词条代码的crc32取模，range按字典顺序连续切分
+    :return: 每个分片的词条列表
+    """
+    if shard_by == "hash":
+        parts = [[] for _ in range(shards)]
+        for word in words:
+            parts[zlib.crc32(str(word.code).encode('utf-8')) % shards].append(word)
+        return parts
+    if shard_by == "range":
+        size = -(-len(words) // shards)
+        return [words[i * size:(i + 1) * size] for i in range(shards)]
+    raise ValueError(f"Unknown shard method: {shard_by}, must be one of {'/'.join(SHARD_METHODS)}")
+
+def prune_index_words(index_words: dict[str, set[str]], keep: set[str], redundant: bool = True,
+                      max_df: int = 0) -> tuple[dict[str, set[str]], dict[str, int]]:
+    """
+    剪枝索引词：
+    1. 冗余：去掉首字或尾字后的子串也是索引词且倒排表完全相同，包含长串的查询必然包含子串，去掉长串不影响字面召回；
+       只比较倒排表的大小不够，短于ngram_min的子串来自jieba分词，倒排表与长串无关
+    2. 高频：对应词条数超过max_df的索引词几乎不能区分词条，却要逐个重排，直接去掉
+
+    :param keep: 不剪枝的索引词，即字典中的完整词条
+    :param redundant: 是否去掉冗余的索引词
+    :param max_df: 索引词对应词条数的上限，0表示不限制
+    :return: 剪枝后的索引词，剪枝统计
+    """
+    pruned = {}
+    redundant_count = 0
+    frequent_count = 0
+    for key, codes in index_words.items():
+        if key not in keep:
+            if max_df > 0 and len(codes) > max_df:
+                frequent_count += 1
+                continue
+            if redundant and any(index_words.get(sub_key) == codes for sub_key in (key[1:], key[:-1])):
+                redundant_count += 1
+                continue
+        pruned[key] = codes
+    return pruned, {"before": len(index_words), "after": len(pruned), "redundant": redundant_count, "frequent": frequent_count}
+
+def save_prune_report(batch_index_dir: str, report: dict) -> dict:
+    # 合并到已有的剪枝报告：剪枝统计在生成索引词时写入，搜索召回率在创建向量索引之后写入
+    filepath = os.path.join(batch_index_dir, PRUNE_REPORT_FILE)
+    if os.path.exists(filepath):
+        with open(filepath, 'r', encoding='utf-8') as file:
+            report = {**json.load(file), **report}
+    with open(filepath, 'w', encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    return report
+
+def read_validate_keywords() -> list[str]:
+    filepath = os.path.join(basic.func.get_executable_directory(), 'validate_keywords.txt')
+    if not os.path.exists(filepath):
+        return []
+    with open(filepath, 'r', encoding='utf-8-sig') as file:
+        return [line.strip() for line in file if line.strip()]
+
+def prepare_index_words(batch_index_dir : str, ngram_min : int = 3, ngram_max : int = 5, collection : str | None = None,
+                        prune : bool = False, max_df : int = 0) -> list[str]:
+    words = _copy_and_read_dict_words(batch_index_dir, collection)
+    return _prepare_index_words(batch_index_dir, words, ngram_min, ngram_max, prune, max_df)
+
+def prepare_sharded_index_words(batch_index_dir : str, ngram_min : int = 3, ngram_max : int = 5, shards : int = 2,
+                                shard_by : str = "hash", collection : str | None = None, prune : bool = False,
+                                max_df : int = 0) -> list[tuple[str, list[str]]]:
+    """
+    按分片生成索引词，每个分片目录(shard_00, shard_01...)拥有独立的字典、倒排表，之后分别创建向量索引
+
+    :return: [(分片目录, 索引词列表)]
+    """
+    words = _copy_and_read_dict_words(batch_index_dir, collection)
+    results = []
+    for shard, shard_words in enumerate(split_dict_words(words, shards, shard_by)):
+        shard_dir = os.path.join(batch_index_dir, f"shard_{shard:02d}")
+        basic.func.touch_dir(shard_dir)
+        _write_dict_words(shard_dir, shard_words)
+        print(f"Shard[{shard}] {len(shard_words)} dict words")
+        results.append((shard_dir, _prepare_index_words(shard_dir, shard_words, ngram_min, ngram_max, prune, max_df)))
+    return results
+
+def build_index_words(words : list[DictWord], ngram_min : int = 3, ngram_max : int = 5) -> dict[str, set[str]]:
+    """
+    :return: 索引词 -> 包含该索引词的词条代码
+    """
     index_words = dict()
     for word in words:
         sub_words = split_word(word.word, ngram_min, ngram_max)
@@ -148,6 +745,19 @@ def prepare_index_words(batch_index_dir : str, ngram_min : int = 3, ngram_max :
             if sub_word not in index_words:
                 index_words[sub_word] = set()
             index_words[sub_word].add(word.code)
+    return index_words
+
+def _prepare_index_words(batch_index_dir : str, words : list[DictWord], ngram_min : int = 3, ngram_max : int = 5,
+                         prune : bool = False, max_df : int = 0) -> list[str]:
+    keys = []
+    index_words = build_index_words(words, ngram_min, ngram_max)
+
+    if prune or max_df > 0:
+        pruned, report = prune_index_words(index_words, {word.word for word in words}, redundant=prune, max_df=max_df)
+        save_prune_report(batch_index_dir, report)
+        print(f"pruned index words {report['before']} -> {report['after']}, redundant={report['redundant']}, "
+              f"frequent={report['frequent']}")
+        index_words = pruned
 
     filepath = os.path.join(batch_index_dir, 'index_words.csv')
     basic.func.touch_dir(os.path.dirname(filepath))
@@ -161,14 +771,25 @@ def prepare_index_words(batch_index_dir : str, ngram_min : int = 3, ngram_max :
             codes = ', '.join(str(num) for num in value)
             writer.writerow([key, codes])
     print(f"saved {len(index_words)} index words to {filepath}")
+
+    # 同时保存内存映射格式，倒排表中使用字典行号代替词条代码
+    code_rows = {word.code: row for row, word in enumerate(words)}
+    _save_mapped_dict_words(batch_index_dir, words)
+    _save_mapped_index_codes(batch_index_dir, [sorted(code_rows[code] for code in index_words[key]) for key in keys])
+    print(f"saved mapped dict words and index codes to {batch_index_dir}")
+    _save_suggest_index(batch_index_dir, words)
+    _save_lexical_index(batch_index_dir, words)
     return keys
 
-def load_index_codes() -> list[set[str]]:
+def load_index_codes(mmap: bool = False, batch_index_dir: str | None = None) -> list[set[str]] | MappedIndexCodes:
     log = basic.log()
-    batch_index_dir = get_latest_directory()
+    batch_index_dir = batch_index_dir or get_latest_directory()
     if not batch_index_dir:
         log.error(f"Batch index directory not found")
         return []
+    if mmap and _has_mapped_files(batch_index_dir):
+        return MappedIndexCodes(np.load(os.path.join(batch_index_dir, 'index_codes.npy'), mmap_mode='r'),
+                                np.load(os.path.join(batch_index_dir, 'index_codes_offsets.npy'), mmap_mode='r'))
     filepath = os.path.join(batch_index_dir, 'index_words.csv')
     if not os.path.exists(filepath):
         log.error(f"File not found: {filepath}")
@@ -184,9 +805,9 @@ def load_index_codes() -> list[set[str]]:
             codeList.append(codes)
     return codeList
 
-def load_index_word_codes() -> (list[str], list[set[str]]):
+def load_index_word_codes(batch_index_dir: str | None = None) -> (list[str], list[set[str]]):
     log = basic.log()
-    batch_index_dir = get_latest_directory()
+    batch_index_dir = batch_index_dir or get_latest_directory()
     if not batch_index_dir:
         log.error(f"Batch index directory not found")
         return [], []
@@ -204,21 +825,3 @@ def load_index_word_codes() -> (list[str], list[set[str]]):
             wordList.append(row[0])
             codeList.append(codes)
     return wordList, codeList
-
-def get_dict_words_last_modify_time() -> str:
-    log = basic.log()
-    batch_index_dir = get_latest_directory()
-    if not batch_index_dir:
-        log.error(f"Batch index directory not found")
-        return '1900-01-01 00:00:00'
-    filepath = os.path.join(batch_index_dir, 'dict_words.csv')
-    return basic.func.get_file_last_modify_time(filepath)
-
-def get_index_words_last_modify_time() -> str:
-    log = basic.log()
-    batch_index_dir = get_latest_directory()
-    if not batch_index_dir:
-        log.error(f"Batch index directory not found")
-        return '1900-01-01 00:00:00'
-    filepath = os.path.join(batch_index_dir, 'index_words.csv')
-    return basic.func.get_file_last_modify_time(filepath)
\ No newline at end of file
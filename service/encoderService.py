@@ -0,0 +1,261 @@
+import atexit
+import itertools
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+
+import numpy as np
+
+import basic
+from . import aiModel
+
+# 主进程通过环境变量把编码进程的地址和认证密钥传给各服务进程
+ENCODER_ADDRESSES_ENV = "VECTOR_SEARCH_ENCODERS"
+ENCODER_AUTHKEY_ENV = "VECTOR_SEARCH_ENCODER_KEY"
+# 检查编码进程是否退出的间隔(秒)
+ENCODER_CHECK_SECONDS = 1.0
+# 编码进程重启失败后，再次重启前最多等待的秒数
+ENCODER_RESTART_MAX_SECONDS = 60
+
+
+def _encoder_address(index: int) -> str:
+    # Linux/macOS 使用 Unix socket，Windows 使用命名管道
+    name = f"vector-search-{os.getpid()}-{index}"
+    if os.name == 'nt':
+        return rf"\\.\pipe\{name}"
+    return os.path.join(tempfile.gettempdir(), f"{name}.sock")
+
+
+def _remove_socket(address: str):
+    # 命名管道随进程退出释放，Unix socket文件需要删除
+    if os.name != 'nt' and os.path.exists(address):
+        os.remove(address)
+
+
+def _serve_connection(conn: Connection, requests: queue.SimpleQueue):
+    # 每个连接同一时间只有一个未完成的请求，按顺序返回结果
+    try:
+        while True:
+            requests.put((conn.recv(), conn))
+    except (EOFError, OSError):
+        conn.close()
+
+
+def _encode_batches(model, requests: queue.SimpleQueue, max_batch: int, batch_wait_millis: float):
+    """
+    合并所有服务进程的编码请求：取出第一个请求后，收集已排队(或在等待时间内到达)的请求，凑成一批一起编码
+    """
+    while True:
+        batch = [requests.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + batch_wait_millis / 1000
+        while size < max_batch:
+            try:
+                timeout = deadline - time.perf_counter()
+                item = requests.get(timeout=timeout) if timeout > 0 else requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        try:
+            embeddings = model.encode([sentence for sentences, _ in batch for sentence in sentences])
+            error = None
+        except Exception as e:
+            embeddings = None
+            error = f"{type(e).__name__}: {e}"
+        offset = 0
+        for sentences, conn in batch:
+            result = embeddings[offset:offset + len(sentences)] if error is None else None
+            offset += len(sentences)
+            try:
+                conn.send((result, error))
+            except OSError:
+                pass  # 服务进程已退出
+
+
+def run_encoder_server(address: str, authkey: bytes, max_batch: int, batch_wait_millis: float, ready):
+    """
+    编码进程入口：加载一份模型，为所有服务进程编码
+    """
+    log = basic.log()
+    model = aiModel.load_sentence_transformer_model()
+    if model is None:
+        log.error("Failed to load sentence transformer model")
+        return
+    _remove_socket(address)
+    listener = Listener(address, authkey=authkey)
+    requests = queue.SimpleQueue()
+    threading.Thread(target=_encode_batches, args=(model, requests, max_batch, batch_wait_millis), name="encoder-batch", daemon=True).start()
+    log.info(f"Encoder listening on {address}, max_batch={max_batch}, batch_wait_millis={batch_wait_millis}")
+    ready.set()
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            log.warning(f"Encoder accept failed: {e}")
+            continue
+        threading.Thread(target=_serve_connection, args=(conn, requests), name="encoder-connection", daemon=True).start()
+
+
+class EncoderPool:
+    """
+    编码进程池：启动时等待各编码进程加载模型，进程提前退出时立即报错；
+    之后由后台线程重启意外退出的编码进程(地址和密钥不变，服务进程自动重连)，主进程退出时结束编码进程并删除socket文件
+    """
+    def __init__(self, count: int, max_batch: int, batch_wait_millis: float, timeout: float):
+        self.context = multiprocessing.get_context("spawn")
+        self.authkey = os.urandom(16)
+        self.addresses = [_encoder_address(i) for i in range(count)]
+        self.max_batch = max_batch
+        self.batch_wait_millis = batch_wait_millis
+        self.timeout = timeout
+        self.processes: list[multiprocessing.Process] = []
+        self._stop = threading.Event()
+        self._monitor: threading.Thread | None = None
+
+    def _spawn(self, i: int):
+        ready = self.context.Event()
+        process = self.context.Process(target=run_encoder_server,
+                                       args=(self.addresses[i], self.authkey, self.max_batch, self.batch_wait_millis, ready),
+                                       name=f"encoder-{i}", daemon=True)
+        process.start()
+        if i < len(self.processes):
+            self.processes[i] = process
+        else:
+            self.processes.append(process)
+        return ready
+
+    def _wait_ready(self, process: multiprocessing.Process, ready):
+        # 同时检查进程是否已退出，模型加载失败等情况不必等到超时
+        deadline = time.monotonic() + self.timeout
+        while not ready.wait(ENCODER_CHECK_SECONDS):
+            if self._stop.is_set():
+                return
+            if not process.is_alive():
+                raise RuntimeError(f"Encoder process {process.name} exited during startup, exit code {process.exitcode}")
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"Encoder process {process.name} failed to start in {self.timeout} seconds")
+
+    def start(self) -> 'EncoderPool':
+        readies = [self._spawn(i) for i in range(len(self.addresses))]
+        try:
+            for process, ready in zip(self.processes, readies):
+                self._wait_ready(process, ready)
+        except RuntimeError:
+            self.stop()
+            raise
+        self._monitor = threading.Thread(target=self._supervise, name="encoder-monitor", daemon=True)
+        self._monitor.start()
+        atexit.register(self.stop)
+        return self
+
+    def _supervise(self):
+        log = basic.log()
+        failures = [0] * len(self.processes)
+        retry_time = [0.0] * len(self.processes)
+        while not self._stop.wait(ENCODER_CHECK_SECONDS):
+            for i, process in enumerate(self.processes):
+                if process.is_alive() or self._stop.is_set() or time.monotonic() < retry_time[i]:
+                    continue
+                log.warning(f"Encoder process {process.name} exited with code {process.exitcode}, restarting")
+                _remove_socket(self.addresses[i])
+                try:
+                    self._wait_ready(self.processes[i], self._spawn(i))
+                    failures[i] = 0
+                except RuntimeError as e:
+                    # 重启失败时逐次加倍等待时间，避免模型缺失时反复重启
+                    failures[i] += 1
+                    retry_time[i] = time.monotonic() + min(2 ** failures[i], ENCODER_RESTART_MAX_SECONDS)
+                    log.error(f"{e}, retry in {retry_time[i] - time.monotonic():.0f} seconds")
+
+    def stop(self):
+        self._stop.set()
+        if self._monitor is not None and self._monitor is not threading.current_thread():
+            self._monitor.join(self.timeout)
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join(ENCODER_CHECK_SECONDS * 5)
+        for address in self.addresses:
+            _remove_socket(address)
+
+
+def start_encoders(count: int = 1, max_batch: int = 64, batch_wait_millis: float = 0, timeout: float = 600) -> EncoderPool:
+    """
+    启动编码进程，并把地址和密钥写入环境变量，之后启动的服务进程通过 connect_encoders 连接
+
+    :param count: 编码进程数量
+    :param max_batch: 每批最多编码的句子数
+    :param batch_wait_millis: 收到第一个请求后等待更多请求的时间，0表示只合并已排队的请求
+    :param timeout: 等待模型加载的秒数
+    """
+    pool = EncoderPool(count, max_batch, batch_wait_millis, timeout).start()
+    os.environ[ENCODER_ADDRESSES_ENV] = ','.join(pool.addresses)
+    os.environ[ENCODER_AUTHKEY_ENV] = pool.authkey.hex()
+    return pool
+
+
+class EncoderClient:
+    """
+    编码进程的客户端，与 SentenceTransformer.encode 用法相同；每个线程使用独立的连接
+    """
+    def __init__(self, addresses: list[str], authkey: bytes):
+        self.addresses = addresses
+        self.authkey = authkey
+        self._local = threading.local()
+        self._next = itertools.count(os.getpid())
+
+    def _connection(self) -> Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # 服务进程分散连接到不同的编码进程，连接失败时尝试下一个
+            start = next(self._next)
+            for i in range(len(self.addresses)):
+                address = self.addresses[(start + i) % len(self.addresses)]
+                try:
+                    conn = Client(address, authkey=self.authkey)
+                    break
+                except OSError:
+                    continue
+            if conn is None:
+                raise ConnectionError(f"No encoder available: {self.addresses}")
+            self._local.conn = conn
+        return conn
+
+    def _reset(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def encode(self, sentences: list[str], **kwargs) -> np.ndarray:
+        sentences = list(sentences)
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.send(sentences)
+                embeddings, error = conn.recv()
+                break
+            except (EOFError, OSError):
+                # 编码进程重启或连接断开时重连一次
+                self._reset()
+                if attempt > 0:
+                    raise
+        if error:
+            raise RuntimeError(f"Encoder failed: {error}")
+        return embeddings
+
+
+def connect_encoders() -> EncoderClient | None:
+    """
+    :return: 主进程启动了编码进程时返回客户端，否则返回 None，由服务进程自己加载模型
+    """
+    addresses = os.environ.get(ENCODER_ADDRESSES_ENV)
+    authkey = os.environ.get(ENCODER_AUTHKEY_ENV)
+    if not addresses or not authkey:
+        return None
+    return EncoderClient(addresses.split(','), bytes.fromhex(authkey))
@@ -0,0 +1,322 @@
+import json
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Callable
+
+import psutil
+from sentence_transformers import SentenceTransformer
+
+import basic
+from . import aiModel
+from . import dictWords
+from . import indexManifest
+from . import indexTuner
+from . import vectorIndex
+
+
+def check_index_options(process_worker: int = 0, ngram_min: int = 3, ngram_max: int = 5, batch_size: int = 500, quantizer: str = "flat",
+                        shards: int = 1, shard_by: str = "hash", collection: str | None = None, max_df: int = 0, **_):
+    """
+    创建索引之前检查参数，不合法时抛出 ValueError，避免在生成索引词之后才失败并留下未完成的索引目录
+    """
+    if collection and not dictWords.is_valid_collection_name(collection):
+        raise ValueError(f"Invalid dict name: {collection}")
+    if quantizer not in vectorIndex.QUANTIZER_TYPES:
+        raise ValueError(f"Unknown quantizer: {quantizer}, must be one of {'/'.join(vectorIndex.QUANTIZER_TYPES)}")
+    if shard_by not in dictWords.SHARD_METHODS:
+        raise ValueError(f"Unknown shard method: {shard_by}, must be one of {'/'.join(dictWords.SHARD_METHODS)}")
+    if shards < 1:
+        raise ValueError(f"Shards must be at least 1: {shards}")
+    if ngram_min < 1 or ngram_max < ngram_min:
+        raise ValueError(f"Invalid ngram range: min={ngram_min}, max={ngram_max}")
+    if batch_size < 1 or process_worker < 0 or max_df < 0:
+        raise ValueError(f"Invalid batch={batch_size}, worker={process_worker} or max_df={max_df}")
+
+
+def build_index(model: SentenceTransformer, process_worker: int = 0, ngram_min: int = 3, ngram_max: int = 5, batch_size: int = 500,
+                quantizer: str = "flat", shards: int = 1, shard_by: str = "hash", collection: str | None = None,
+                prune: bool = False, max_df: int = 0, prune_sample: int = indexTuner.PRUNE_RECALL_SAMPLE,
+                progress: Callable[[str, int, int], None] | None = None) -> str:
+    """
+    根据 dict/dict_words.csv (命名字典为 dict/dict_words_<collection>.csv) 创建一个新的索引目录
+
+    :param prune: 去掉冗余的索引词
+    :param max_df: 去掉对应词条数超过此值的索引词，0表示不限制
+    :param prune_sample: 剪枝后与未剪枝的flat索引比较搜索召回率的查询数，0表示不测量(需要向量化剪掉的索引词)
+    :param progress: 进度回调，参数为 阶段、已完成数量、总数量
+    :return: 新的索引目录
+    """
+    check_index_options(process_worker=process_worker, ngram_min=ngram_min, ngram_max=ngram_max, batch_size=batch_size, quantizer=quantizer,
+                        shards=shards, shard_by=shard_by, collection=collection, max_df=max_df)
+    report = progress or (lambda stage, done, total: None)
+    options = {"ngramMin": ngram_min, "ngramMax": ngram_max, "batchSize": batch_size, "quantizer": quantizer,
+               "shards": shards, "shardBy": shard_by, "prune": prune, "maxDf": max_df, "collection": collection or dictWords.DEFAULT_COLLECTION}
+    timings = {}
+    batch_index_dir = os.path.join(dictWords.get_index_base_directory(collection), datetime.now().strftime("%Y%m%d%H%M%S"))
+    # 写入清单之前目录中保留标记文件，创建中断的目录不会被当作旧版本的完整索引目录
+    os.makedirs(batch_index_dir, exist_ok=True)
+    building_file = os.path.join(batch_index_dir, dictWords.BUILDING_FILE)
+    open(building_file, 'w').close()
+    print(f"Prepare index words to {batch_index_dir}")
+    report("prepare", 0, 0)
+    stage_start = time.perf_counter()
+    if shards > 1:
+        shard_words = dictWords.prepare_sharded_index_words(batch_index_dir, ngram_min=ngram_min, ngram_max=ngram_max, shards=shards,
+                                                            shard_by=shard_by, collection=collection, prune=prune, max_df=max_df)
+    else:
+        words = dictWords.prepare_index_words(batch_index_dir, ngram_min=ngram_min, ngram_max=ngram_max, collection=collection,
+                                              prune=prune, max_df=max_df)
+        shard_words = [(batch_index_dir, words)]
+    timings["prepare"] = time.perf_counter() - stage_start
+
+    total = sum(len(words) for _, words in shard_words)
+    finished = 0
+    report("embedding", 0, total)
+    stage_start = time.perf_counter()
+    for shard_dir, words in shard_words:
+        print(f"Index words count: {len(words)}")
+        vectorIndex.create_vector_indexes(batch_index_dir=shard_dir, index_words=words, model=model, worker=process_worker, batch_size=batch_size,
+                                          quantizer=quantizer, progress=lambda count, offset=finished: report("embedding", offset + count, total))
+        finished += len(words)
+    timings["embedding"] = time.perf_counter() - stage_start
+
+    if (prune or max_df > 0) and prune_sample > 0:
+        report("pruneRecall", 0, 0)
+        stage_start = time.perf_counter()
+        recall = indexTuner.evaluate_prune_recall(model, batch_index_dir, ngram_min=ngram_min, ngram_max=ngram_max, sample_size=prune_sample)
+        if recall:
+            dictWords.save_prune_report(batch_index_dir, {"searchRecall": recall})
+            print(f"pruned search recall@{recall['topK']}={recall['recall']} on {recall['queries']} queries")
+        timings["pruneRecall"] = time.perf_counter() - stage_start
+
+    report("manifest", total, total)
+    indexManifest.write_manifest(batch_index_dir, options, timings, [shard_dir for shard_dir, _ in shard_words])
+    os.remove(building_file)
+    report("done", total, total)
+    return batch_index_dir
+
+
+# 任务状态保存在 index/_jobs/<id>.json，多个服务进程时任一进程都能查询(字典名称以字母开头，不会与命名字典的目录冲突)
+JOBS_DIRECTORY = '_jobs'
+# 运行中的任务最多每隔该秒数保存一次进度
+JOB_SAVE_SECONDS = 1.0
+_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class IndexJob:
+    def __init__(self, job_id: str, options: dict[str, Any]):
+        self.id = job_id
+        self.pid = os.getpid()  # 执行任务的服务进程
+        self.options = options
+        self.status = "queued"  # queued / running / finished / failed
+        self.stage = "queued"
+        self.done = 0
+        self.total = 0
+        self.create_time = datetime.now()
+        self.stage_time = self.create_time
+        self.finish_time: datetime | None = None
+        self.batch_index_dir: str | None = None
+        self.error: str | None = None
+
+    def update(self, stage: str, done: int, total: int):
+        if stage != self.stage:
+            self.stage = stage
+            self.stage_time = datetime.now()
+        self.status = "running"
+        self.done = done
+        self.total = total
+
+    def finish(self, batch_index_dir: str):
+        self.status = "finished"
+        self.stage = "done"
+        self.batch_index_dir = batch_index_dir
+        self.finish_time = datetime.now()
+
+    def fail(self, error: str):
+        self.status = "failed"
+        self.error = error
+        self.finish_time = datetime.now()
+
+    def to_dict(self) -> dict[str, Any]:
+        seconds = (datetime.now() - self.stage_time).total_seconds()
+        throughput = self.done / seconds if self.status == "running" and seconds > 0 else 0.0
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "done": self.done,
+            "total": self.total,
+            "progress": round(self.done * 100 / self.total, 2) if self.total else (100.0 if self.status == "finished" else 0.0),
+            "throughput": round(throughput, 2),
+            "eta": round((self.total - self.done) / throughput, 1) if throughput > 0 else None,
+            "options": self.options,
+            "batchIndexDir": self.batch_index_dir,
+            "error": self.error,
+            "createTime": self.create_time.strftime(_TIME_FORMAT),
+            "finishTime": self.finish_time.strftime(_TIME_FORMAT) if self.finish_time else None,
+        }
+
+    def to_state(self) -> dict[str, Any]:
+        return {
+            "id": self.id, "pid": self.pid, "options": self.options, "status": self.status, "stage": self.stage,
+            "done": self.done, "total": self.total, "createTime": self.create_time.strftime(_TIME_FORMAT),
+            "stageTime": self.stage_time.strftime(_TIME_FORMAT),
+            "finishTime": self.finish_time.strftime(_TIME_FORMAT) if self.finish_time else None,
+            "batchIndexDir": self.batch_index_dir, "error": self.error,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict[str, Any]) -> 'IndexJob':
+        job = cls(state["id"], state["options"])
+        job.pid = state["pid"]
+        job.status = state["status"]
+        job.stage = state["stage"]
+        job.done = state["done"]
+        job.total = state["total"]
+        job.create_time = datetime.strptime(state["createTime"], _TIME_FORMAT)
+        job.stage_time = datetime.strptime(state["stageTime"], _TIME_FORMAT)
+        job.finish_time = datetime.strptime(state["finishTime"], _TIME_FORMAT) if state["finishTime"] else None
+        job.batch_index_dir = state["batchIndexDir"]
+        job.error = state["error"]
+        # 执行任务的服务进程已退出，任务不会再完成
+        if job.status in ("queued", "running") and not psutil.pid_exists(job.pid):
+            job.fail(f"Server process {job.pid} exited")
+        return job
+
+
+def _get_jobs_directory() -> str:
+    return os.path.join(dictWords.get_index_base_directory(), JOBS_DIRECTORY)
+
+
+def _save_index_job(job: IndexJob):
+    # 先写临时文件再原子替换，其它服务进程不会读到半个文件
+    directory = _get_jobs_directory()
+    os.makedirs(directory, exist_ok=True)
+    filepath = os.path.join(directory, f"{job.id}.json")
+    temp_path = f"{filepath}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(job.to_state(), file, ensure_ascii=False, indent=2)
+    os.replace(temp_path, filepath)
+
+
+def _load_index_job(filepath: str) -> IndexJob | None:
+    try:
+        with open(filepath, 'r', encoding='utf-8') as file:
+            return IndexJob.from_state(json.load(file))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+_jobs: dict[str, IndexJob] = {}
+_pending_jobs: queue.Queue = queue.Queue()
+_runner_lock = threading.Lock()
+_runner: threading.Thread | None = None
+
+
+def _run_index_job(options: dict[str, Any], events: multiprocessing.Queue):
+    # 在独立进程中运行，不占用服务进程的CPU和内存
+    model = aiModel.load_sentence_transformer_model()
+    if model is None:
+        events.put(("failed", "Failed to load sentence transformer model"))
+        return
+    try:
+        batch_index_dir = build_index(model, progress=lambda stage, done, total: events.put(("progress", stage, done, total)), **options)
+        events.put(("finished", batch_index_dir))
+    except Exception as e:
+        events.put(("failed", f"{type(e).__name__}: {e}"))
+
+
+def _wait_index_job(job: IndexJob, process: multiprocessing.Process, events: multiprocessing.Queue):
+    saved_time = time.monotonic()
+    while True:
+        try:
+            event = events.get(timeout=1)
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                job.fail(f"Index process exited with code {process.exitcode}")
+                return
+        if event[0] == "progress":
+            stage = job.stage
+            job.update(*event[1:])
+            if job.stage != stage or time.monotonic() - saved_time >= JOB_SAVE_SECONDS:
+                _save_index_job(job)
+                saved_time = time.monotonic()
+        elif event[0] == "finished":
+            job.finish(event[1])
+            return
+        elif event[0] == "failed":
+            job.fail(event[1])
+            return
+
+
+def _run_pending_jobs():
+    log = basic.log()
+    context = multiprocessing.get_context("spawn")
+    while True:
+        job, on_finished = _pending_jobs.get()
+        events = context.Queue()
+        process = context.Process(target=_run_index_job, args=(job.options, events), name=f"index-job-{job.id}")
+        job.update("starting", 0, 0)
+        _save_index_job(job)
+        process.start()
+        log.info(f"Index job {job.id} started, pid={process.pid}, options={job.options}")
+        _wait_index_job(job, process, events)
+        _save_index_job(job)
+        process.join()
+        log.info(f"Index job {job.id} {job.status}: {job.batch_index_dir or job.error}")
+        if job.status == "finished" and on_finished:
+            try:
+                on_finished(job)
+            except Exception as e:
+                log.error(f"Index job {job.id} activate failed: {e}")
+
+
+def submit_index_job(options: dict[str, Any], on_finished: Callable[[IndexJob], None] | None = None) -> IndexJob:
+    """
+    提交索引创建任务，任务按提交顺序逐个在独立进程中执行
+
+    :param options: build_index 的参数
+    :param on_finished: 任务成功后在服务进程中的回调，用于切换到新的索引目录
+    """
+    global _runner
+    job = IndexJob(uuid.uuid4().hex[:12], options)
+    _jobs[job.id] = job
+    _save_index_job(job)
+    _pending_jobs.put((job, on_finished))
+    with _runner_lock:
+        if _runner is None:
+            _runner = threading.Thread(target=_run_pending_jobs, name="index-job-runner", daemon=True)
+            _runner.start()
+    return job
+
+
+def get_index_job(job_id: str) -> IndexJob | None:
+    # 本进程执行的任务直接返回，其它服务进程执行的任务从状态文件读取
+    if job_id in _jobs:
+        return _jobs[job_id]
+    if not re.match(r'^[0-9a-f]{12}$', job_id):
+        return None
+    return _load_index_job(os.path.join(_get_jobs_directory(), f"{job_id}.json"))
+
+
+def list_index_jobs() -> list[IndexJob]:
+    jobs = {}
+    directory = _get_jobs_directory()
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith(".json"):
+                job = _load_index_job(os.path.join(directory, filename))
+                if job:
+                    jobs[job.id] = job
+    jobs.update(_jobs)
+    return sorted(jobs.values(), key=lambda job: job.create_time)
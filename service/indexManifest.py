@@ -0,0 +1,181 @@
+import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+from datetime import datetime
+from typing import Any
+
+import faiss
+import numpy as np
+
+import basic
+from .dictWords import BUILDING_FILE, LEGACY_INDEX_FILES, MANIFEST_FILE, get_index_base_directory
+from .vectorIndex import _mmap_io_flags, get_shard_directories
+
+
+def _file_checksum(filepath: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        while chunk := file.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _count_rows(filepath: str) -> int:
+    with open(filepath, 'r', newline='', encoding='utf-8') as file:
+        return sum(1 for _ in csv.reader(file))
+
+
+def _shard_counts(shard_dir: str) -> dict[str, int]:
+    # 旧版本创建的索引目录没有内存映射文件，从CSV统计
+    if not os.path.exists(os.path.join(shard_dir, 'dict_words_offsets.npy')):
+        return {
+            "dictWordSize": _count_rows(os.path.join(shard_dir, 'dict_words.csv')),
+            "vectorSize": _count_rows(os.path.join(shard_dir, 'index_words.csv')),
+        }
+    dict_offsets = np.load(os.path.join(shard_dir, 'dict_words_offsets.npy'), mmap_mode='r')
+    index_offsets = np.load(os.path.join(shard_dir, 'index_codes_offsets.npy'), mmap_mode='r')
+    return {
+        "dictWordSize": (len(dict_offsets) - 1) // 2,
+        "vectorSize": len(index_offsets) - 1,  # 词索引和拼音索引的向量数都等于索引词数
+    }
+
+
+def _list_files(batch_index_dir: str) -> list[dict[str, Any]]:
+    files = []
+    for root, _, filenames in os.walk(batch_index_dir):
+        for filename in sorted(filenames):
+            if root == batch_index_dir and (filename.startswith(MANIFEST_FILE) or filename == BUILDING_FILE):
+                continue
+            filepath = os.path.join(root, filename)
+            files.append({
+                "path": os.path.relpath(filepath, batch_index_dir).replace(os.sep, '/'),
+                "size": os.path.getsize(filepath),
+                "sha256": _file_checksum(filepath),
+                "modifyTime": basic.func.get_file_last_modify_time(filepath),
+            })
+    return files
+
+
+def _save_manifest(batch_index_dir: str, manifest: dict[str, Any]):
+    filepath = os.path.join(batch_index_dir, MANIFEST_FILE)
+    temp_filepath = f"{filepath}.{os.getpid()}.tmp"  # 多个服务进程可能同时为旧版本的索引目录补写清单
+    with open(temp_filepath, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    os.replace(temp_filepath, filepath)
+    print(f"Manifest saved to {filepath}")
+
+
+def write_manifest(batch_index_dir: str, options: dict[str, Any], timings: dict[str, float], shard_dirs: list[str]) -> dict[str, Any]:
+    """
+    索引创建成功后写入清单，先写临时文件再原子替换；没有清单的目录不会被当作可用的索引目录
+
+    :param options: 创建索引的参数
+    :param timings: 各阶段耗时(秒)
+    :param shard_dirs: 分片目录，未分片时为索引目录本身
+    """
+    files = _list_files(batch_index_dir)
+    manifest = {
+        "name": os.path.basename(batch_index_dir),
+        "createTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "options": options,
+        "shards": [{"name": os.path.relpath(shard_dir, batch_index_dir).replace(os.sep, '/'), **_shard_counts(shard_dir)}
+                   for shard_dir in shard_dirs],
+        "timings": {stage: round(seconds, 3) for stage, seconds in timings.items()},
+        "files": files,
+    }
+    _save_manifest(batch_index_dir, manifest)
+    return manifest
+
+
+def update_manifest(batch_index_dir: str, **sections: Any) -> dict[str, Any]:
+    """
+    索引目录中的文件变化后(如 tune 命令生成调优索引)，更新清单中的文件列表及指定的内容
+    """
+    manifest = load_manifest(batch_index_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"Manifest not found in {batch_index_dir}")
+    manifest.update(sections)
+    manifest["files"] = _list_files(batch_index_dir)
+    _save_manifest(batch_index_dir, manifest)
+    return manifest
+
+
+def is_legacy_generation(batch_index_dir: str) -> bool:
+    """
+    没有清单的索引目录是否为旧版本创建的完整目录：不是正在创建或创建中断的目录(没有标记文件)，
+    每个分片目录都有字典、索引词及两个向量索引，且向量索引可以读取、向量数等于索引词数(排除写了一半的索引文件)
+    """
+    if os.path.exists(os.path.join(batch_index_dir, MANIFEST_FILE)) or os.path.exists(os.path.join(batch_index_dir, BUILDING_FILE)):
+        return False
+    for shard_dir in get_shard_directories(batch_index_dir):
+        if not all(os.path.isfile(os.path.join(shard_dir, filename)) for filename in LEGACY_INDEX_FILES):
+            return False
+        vectors = _count_rows(os.path.join(shard_dir, 'index_words.csv'))
+        for filename in ('word_index.bin', 'pinyin_index.bin'):
+            try:
+                ntotal = faiss.read_index(os.path.join(shard_dir, filename), _mmap_io_flags()).ntotal
+            except RuntimeError:
+                return False
+            if ntotal != vectors:
+                return False
+    return True
+
+
+def migrate_legacy_generation(batch_index_dir: str) -> bool:
+    """
+    为旧版本创建的完整索引目录补写清单，之后与新创建的索引目录一样加载和清理
+
+    :return: 是否已补写清单
+    """
+    if not is_legacy_generation(batch_index_dir):
+        return False
+    write_manifest(batch_index_dir, {"legacy": True}, {}, get_shard_directories(batch_index_dir))
+    basic.log().info(f"Wrote manifest for legacy index directory {batch_index_dir}")
+    return True
+
+
+def load_manifest(batch_index_dir: str) -> dict[str, Any] | None:
+    filepath = os.path.join(batch_index_dir, MANIFEST_FILE)
+    if not os.path.exists(filepath):
+        return None
+    with open(filepath, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def get_manifest_file_time(manifest: dict[str, Any] | None, filename: str) -> str:
+    # 分片的索引目录返回第一个分片中的文件时间
+    if not manifest:
+        return '1900-01-01 00:00:00'
+    for item in manifest["files"]:
+        if item["path"].split('/')[-1] == filename:
+            return item["modifyTime"]
+    return '1900-01-01 00:00:00'
+
+
+def gc_generations(keep: int = 3, collection: str | None = None) -> list[str]:
+    """
+    保留最新的keep个完整索引目录，删除更早的索引目录；比最新完整目录更新的未完成目录可能正在创建，不删除
+
+    :return: 删除的目录
+    """
+    base_path = get_index_base_directory(collection)
+    if not os.path.exists(base_path):
+        return []
+    time_pattern = re.compile(r'^\d{14}$')
+    generations = sorted((d for d in os.listdir(base_path) if os.path.isdir(os.path.join(base_path, d)) and time_pattern.match(d)),
+                         reverse=True)
+    complete = [d for d in generations if os.path.exists(os.path.join(base_path, d, MANIFEST_FILE))
+                or migrate_legacy_generation(os.path.join(base_path, d))]
+    if not complete:
+        return []
+    kept = set(complete[:max(keep, 1)])
+    removed = []
+    for d in generations:
+        if d in kept or d > complete[0]:
+            continue
+        shutil.rmtree(os.path.join(base_path, d))
+        removed.append(os.path.join(base_path, d))
+    return removed
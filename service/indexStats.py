@@ -0,0 +1,213 @@
+import csv
+import os
+import sys
+from typing import Any
+
+import faiss
+import numpy as np
+
+import basic
+from . import dictCollection
+from . import encoderService
+from .dictWords import MappedDictWords, MappedIndexCodes, SuggestIndex, LexicalIndex
+from .vectorIndex import ADAPTIVE_MAX_DEPTH_FACTOR, IndexShard, VectorIndex, get_shard_directories, search_depth
+
+
+def _length_distribution(lengths: np.ndarray) -> dict[str, Any]:
+    # 按2的幂分桶：1, 2, 3-4, 5-8, ...
+    if len(lengths) == 0:
+        return {"count": 0}
+    histogram = {}
+    upper = 1
+    lower = 1
+    while lower <= lengths.max():
+        count = int(np.count_nonzero((lengths >= lower) & (lengths <= upper)))
+        if count:
+            histogram[str(lower) if lower == upper else f"{lower}-{upper}"] = count
+        lower = upper + 1
+        upper *= 2
+    return {
+        "count": int(len(lengths)),
+        "min": int(lengths.min()),
+        "max": int(lengths.max()),
+        "mean": round(float(lengths.mean()), 2),
+        "p50": int(np.percentile(lengths, 50)),
+        "p90": int(np.percentile(lengths, 90)),
+        "p99": int(np.percentile(lengths, 99)),
+        "histogram": histogram,
+    }
+
+
+def _dict_words_stats(dict_words) -> dict[str, Any]:
+    if isinstance(dict_words, MappedDictWords):
+        return {"count": len(dict_words), "mapped": True, "bytes": dict_words.nbytes}
+    # CSV加载的字典按对象大小估算
+    size = sys.getsizeof(dict_words) + sum(sys.getsizeof(code) + sys.getsizeof(word) + sys.getsizeof(word.word)
+                                           for code, word in dict_words.items())
+    return {"count": len(dict_words), "mapped": False, "bytes": size}
+
+
+def _postings_stats(index_codes) -> (dict[str, Any], np.ndarray):
+    if isinstance(index_codes, MappedIndexCodes):
+        lengths = np.diff(index_codes.offsets)
+        size = index_codes.nbytes
+        mapped = True
+    else:
+        lengths = np.array([len(codes) for codes in index_codes], dtype=np.int64)
+        size = sys.getsizeof(index_codes) + sum(sys.getsizeof(codes) + sum(sys.getsizeof(code) for code in codes) for codes in index_codes)
+        mapped = False
+    return {"count": len(index_codes), "mapped": mapped, "bytes": size, "lengths": _length_distribution(lengths)}, lengths
+
+
+def _distance_computations(index: faiss.Index) -> int:
+    """
+    估算单次搜索的距离计算次数：flat/标量量化索引扫描全部向量；IVF扫描聚类中心及 nprobe 个聚类；
+    HNSW按第0层展开 efSearch 个节点，每个节点计算其全部邻居，为上限估计
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        return int(index.hnsw.efSearch * index.hnsw.nb_neighbors(0))
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return int(ivf.nlist + index.ntotal * min(ivf.nprobe, ivf.nlist) / ivf.nlist)
+    return int(index.ntotal)
+
+
+def _vector_index_stats(vector_index: VectorIndex) -> dict[str, Any]:
+    index = vector_index.index
+    storage = index
+    graph_bytes = 0
+    if isinstance(index, faiss.IndexHNSW):
+        # HNSW的向量保存在storage中，另加邻接表
+        graph_bytes = int(index.hnsw.neighbors.size() * 4)
+        storage = faiss.downcast_index(index.storage)
+    code_size = int(getattr(storage, 'code_size', storage.d * 4))
+    computations = _distance_computations(index)
+    return {
+        "quantizer": vector_index.quantizer,
+        "type": type(faiss.downcast_index(index)).__name__,
+        "vectors": int(index.ntotal),
+        "dimension": int(index.d),
+        "codeSize": code_size,
+        "bytes": int(index.ntotal * code_size) + graph_bytes,
+        "distanceComputations": computations,
+        "scanBytes": computations * code_size,
+    }
+
+
+def _suggest_stats(suggest_index: SuggestIndex | None) -> dict[str, Any] | None:
+    if suggest_index is None:
+        return None
+    return {"count": len(suggest_index), "bytes": suggest_index.nbytes}
+
+
+def _lexical_stats(lexical_index: LexicalIndex | None) -> dict[str, Any] | None:
+    if lexical_index is None:
+        return None
+    matrix = lexical_index.matrix
+    return {
+        "rows": int(matrix.shape[0]),
+        "grams": int(matrix.shape[1]),
+        "nonZeros": int(matrix.nnz),
+        "bytes": lexical_index.nbytes,
+    }
+
+
+def _ngram_lengths(shard_dir: str) -> dict[str, int]:
+    # 服务不加载索引词文本，从 index_words.csv 统计
+    filepath = os.path.join(shard_dir, 'index_words.csv')
+    if not os.path.exists(filepath):
+        return {}
+    counts = {}
+    with open(filepath, 'r', newline='', encoding='utf-8') as file:
+        for row in csv.reader(file):
+            counts[len(row[0])] = counts.get(len(row[0]), 0) + 1
+    return {str(length): counts[length] for length in sorted(counts)}
+
+
+def _query_cost(word_index: dict[str, Any], pinyin_index: dict[str, Any], lengths: np.ndarray, top_k: int) -> dict[str, Any]:
+    """
+    估算单次搜索的开销：与 search_index_shards 相同，每个向量索引取出 top_n 个近邻，近邻的倒排表中的词条逐个计算匹配分数；
+    词索引和拼音索引共用倒排表，pinyin=1 时重排的词条数加倍
+    """
+    top_n = search_depth(top_k)
+    mean_postings = float(lengths.mean()) if len(lengths) else 0.0
+    p90_postings = float(np.percentile(lengths, 90)) if len(lengths) else 0.0
+    return {
+        "topK": top_k,
+        "topN": top_n,
+        "wordScanBytes": word_index["scanBytes"],
+        "pinyinScanBytes": pinyin_index["scanBytes"],
+        "wordDistanceComputations": word_index["distanceComputations"],
+        "pinyinDistanceComputations": pinyin_index["distanceComputations"],
+        "rerankedCodes": round(top_n * mean_postings, 1),
+        "rerankedCodesP90": round(top_n * p90_postings, 1),
+        "rerankedCodesWithPinyin": round(2 * top_n * mean_postings, 1),
+        "adaptiveMaxRerankedCodes": round(top_n * ADAPTIVE_MAX_DEPTH_FACTOR * mean_postings, 1),
+    }
+
+
+def shard_stats(shard: IndexShard, shard_dir: str, top_k: int = 3) -> dict[str, Any]:
+    postings, lengths = _postings_stats(shard.index_codes)
+    word_index = _vector_index_stats(shard.word_index)
+    pinyin_index = _vector_index_stats(shard.pinyin_index)
+    suggest = _suggest_stats(shard.suggest_index)
+    lexical = _lexical_stats(shard.lexical_index)
+    dict_words = _dict_words_stats(shard.dict_words)
+    return {
+        "name": shard.name,
+        "bytes": dict_words["bytes"] + postings["bytes"] + word_index["bytes"] + pinyin_index["bytes"] + (suggest["bytes"] if suggest else 0)
+                 + (lexical["bytes"] if lexical else 0),
+        "dictWords": dict_words,
+        "postings": postings,
+        "ngramLengths": _ngram_lengths(shard_dir),
+        "wordIndex": word_index,
+        "pinyinIndex": pinyin_index,
+        "suggest": suggest,
+        "lexical": lexical,
+        "queryCost": _query_cost(word_index, pinyin_index, lengths, top_k),
+    }
+
+
+def collection_stats(collection: dictCollection.DictCollection, top_k: int = 3) -> dict[str, Any]:
+    shards = [shard_stats(shard, shard_dir, top_k)
+              for shard, shard_dir in zip(collection.shards, get_shard_directories(collection.batch_index_dir))]
+    return {
+        "name": collection.name,
+        "batchIndexDir": collection.batch_index_dir,
+        "bytes": sum(shard["bytes"] for shard in shards),
+        "shards": shards,
+    }
+
+
+def model_stats(model) -> dict[str, Any] | None:
+    if model is None:
+        return None
+    if isinstance(model, encoderService.EncoderClient):
+        # 模型在编码进程中，不占用服务进程的内存
+        return {"type": "encoder", "encoders": len(model.addresses)}
+    parameters = list(model.parameters())
+    return {
+        "type": "local",
+        "parameters": sum(p.numel() for p in parameters),
+        "bytes": sum(p.numel() * p.element_size() for p in parameters),
+    }
+
+
+def collect_stats(collections: list[dictCollection.DictCollection], model=None, top_k: int = 3) -> dict[str, Any]:
+    """
+    统计服务进程的内存和索引占用，用于扩充字典前的容量规划
+
+    :param collections: 已加载的字典
+    :param top_k: 估算单次搜索开销使用的近邻数
+    """
+    items = [collection_stats(collection, top_k) for collection in collections]
+    model_info = model_stats(model)
+    return {
+        "process": basic.func.get_process_memory(),
+        "model": model_info,
+        "collections": items,
+        "total": {
+            "indexBytes": sum(item["bytes"] for item in items),
+            "modelBytes": model_info.get("bytes", 0) if model_info else 0,
+        },
+    }
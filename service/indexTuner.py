@@ -0,0 +1,322 @@
+import json
+import math
+import os
+import random
+import re
+import time
+from datetime import datetime
+from typing import Any
+
+import faiss
+import numpy as np
+
+from . import dictCollection
+from . import indexManifest
+from .dictWords import DEFAULT_COLLECTION, build_index_words, load_dict_word_set, load_index_word_codes, read_validate_keywords, \
+    trim_word, pinyin_word
+from .vectorIndex import TUNED_INDEX_FILES, IndexShard, VectorIndex, _calibrate_distance_offset, _vector_words_with_model, \
+    get_shard_directories, load_vector_indexes, search_index_shards
+
+# 创建索引时的量化方式对应的索引，调优选中它且没有搜索参数时沿用原索引
+QUANTIZER_FACTORIES = {"flat": "Flat", "fp16": "SQfp16", "int8": "SQ8"}
+
+# 测量剪枝召回率时从 validate_keywords.txt 抽取的查询数
+PRUNE_RECALL_SAMPLE = 500
+
+# 每种索引扫描的搜索参数
+NPROBE_VALUES = [1, 2, 4, 8, 16, 32, 64, 128]
+EF_SEARCH_VALUES = [16, 32, 64, 128, 256]
+
+
+class _CachedEncoder:
+    """
+    调优时查询向量只计算一次，搜索延迟只包含向量索引和重排
+    """
+    def __init__(self, vectors: dict[str, np.ndarray]):
+        self.vectors = vectors
+
+    def encode(self, sentences: list[str], **kwargs) -> np.ndarray:
+        return np.vstack([self.vectors[sentence] for sentence in sentences])
+
+
+def _sample_queries(sample_size: int, seed: int = 0) -> list[str]:
+    # 与 test_valid_search.py 相同，按非中英文数字字符切分验证关键词
+    queries = set()
+    for keyword in read_validate_keywords():
+        for sub_word in re.sub(r"[^\u4e00-\u9fffA-Za-z0-9]", " ", keyword).split():
+            if trim_word(sub_word):
+                queries.add(sub_word)
+    queries = sorted(queries)
+    if len(queries) > sample_size:
+        queries = random.Random(seed).sample(queries, sample_size)
+    return queries
+
+
+def _encode_queries(model, queries: list[str], batch_size: int = 500) -> _CachedEncoder:
+    texts = sorted({trim_word(q) for q in queries} | {pinyin_word(trim_word(q)) for q in queries})
+    vectors = {}
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i + batch_size]
+        for text, vector in zip(batch, model.encode(batch)):
+            vectors[text] = vector
+    return _CachedEncoder(vectors)
+
+
+def candidate_factories(min_total: int, max_total: int, dimension: int) -> list[str]:
+    """
+    按分片的向量数生成候选索引：IVF的聚类数约为 4*sqrt(n)，且每个聚类至少有39个训练样本
+    """
+    factories = ["Flat", "SQfp16", "SQ8", "HNSW32"]
+    nlist = 2 ** round(math.log2(4 * math.sqrt(max_total)))
+    nlist = min(nlist, 2 ** int(math.log2(max(min_total // 39, 1))))
+    if nlist >= 16:
+        factories += [f"IVF{nlist},Flat", f"IVF{nlist},SQ8"]
+        # PQ每个子空间256个中心，训练样本不足时跳过
+        if dimension % 8 == 0 and min_total >= 256 * 39:
+            factories.append(f"IVF{nlist},PQ{dimension // 8}")
+    return factories
+
+
+def _search_param_values(factory: str) -> list[str]:
+    if factory.startswith("IVF"):
+        nlist = int(re.match(r"IVF(\d+)", factory).group(1))
+        return [f"nprobe={n}" for n in NPROBE_VALUES if n <= nlist]
+    if factory.startswith("HNSW"):
+        return [f"efSearch={n}" for n in EF_SEARCH_VALUES]
+    return [""]
+
+
+def _build_index(factory: str, embeddings: np.ndarray) -> (faiss.Index, float):
+    index = faiss.index_factory(embeddings.shape[1], factory, faiss.METRIC_L2)
+    index.train(embeddings)
+    index.add(embeddings)
+    offset = _calibrate_distance_offset(index, embeddings) if factory != "Flat" else 0.0
+    return index, offset
+
+
+def _build_shards(factory: str, shards: list[IndexShard], embeddings: list[tuple[np.ndarray, np.ndarray]]) -> list[IndexShard]:
+    built = []
+    for shard, (word_embeddings, pinyin_embeddings) in zip(shards, embeddings):
+        word_index, word_offset = _build_index(factory, word_embeddings)
+        pinyin_index, pinyin_offset = _build_index(factory, pinyin_embeddings)
+        built.append(IndexShard(shard.name, shard.dict_words, shard.index_codes, VectorIndex(word_index, factory, word_offset),
+                                VectorIndex(pinyin_index, factory, pinyin_offset), shard.suggest_index))
+    return built
+
+
+def _evaluate(shards: list[IndexShard], encoder: _CachedEncoder, queries: list[str], truth: list[set[str]], top_k: int) -> dict[str, float]:
+    recalls = []
+    latencies = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        hits = search_index_shards(query, encoder, shards, top_k=top_k, pinyin=True)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if expected:
+            recalls.append(len({hit.word for hit in hits} & expected) / len(expected))
+    return {
+        "recall": round(float(np.mean(recalls)), 4) if recalls else 1.0,
+        "latencyMillis": round(float(np.mean(latencies)), 3),
+        "p95Millis": round(float(np.percentile(latencies, 95)), 3),
+    }
+
+
+def _dominates(a: dict[str, Any], b: dict[str, Any]) -> bool:
+    return a["recall"] >= b["recall"] and a["latencyMillis"] <= b["latencyMillis"] and a["bytes"] <= b["bytes"] and \
+        (a["recall"] > b["recall"] or a["latencyMillis"] < b["latencyMillis"] or a["bytes"] < b["bytes"])
+
+
+def pareto_front(results: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    # 不存在召回率不低、不更慢、不更大且至少一项更优的其它设置
+    front = [item for item in results if not any(_dominates(other, item) for other in results if other is not item)]
+    return sorted(front, key=lambda x: (x["latencyMillis"], -x["recall"]))
+
+
+def select_setting(front: list[dict[str, Any]], recall_target: float, max_bytes: int) -> dict[str, Any] | None:
+    """
+    在不超过 max_bytes 的设置中，选择满足召回率目标且最快的，都不满足时选择召回率最高的；没有可选设置时返回 None
+
+    :param max_bytes: 索引大小上限，0表示不限制
+    """
+    eligible = [item for item in front if max_bytes <= 0 or item["bytes"] <= max_bytes]
+    qualified = [item for item in eligible if item["recall"] >= recall_target]
+    if qualified:
+        return min(qualified, key=lambda x: x["latencyMillis"])
+    return max(eligible, key=lambda x: x["recall"]) if eligible else None
+
+
+def _write_index_atomic(index: faiss.Index, filepath: str):
+    temp_filepath = filepath + '.tmp'
+    faiss.write_index(index, temp_filepath)
+    os.replace(temp_filepath, filepath)
+
+
+def _write_meta_atomic(meta: dict[str, Any], filepath: str):
+    temp_filepath = filepath + '.tmp'
+    with open(temp_filepath, 'w', encoding='utf-8') as file:
+        json.dump(meta, file, ensure_ascii=False, indent=2)
+    os.replace(temp_filepath, filepath)
+
+
+def _save_tuned_indexes(shards: list[IndexShard], shard_dirs: list[str], selected: dict[str, Any] | None):
+    # 索引目录可能正在被服务使用：文件先写临时文件再原子替换；应用时先写索引再写元数据，恢复时先写元数据再删除索引
+    for shard, shard_dir in zip(shards, shard_dirs):
+        meta_file_path = os.path.join(shard_dir, 'index_meta.json')
+        with open(meta_file_path, 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        if selected is None:
+            meta.pop("tuned", None)
+            _write_meta_atomic(meta, meta_file_path)
+            for filename in TUNED_INDEX_FILES:
+                if os.path.exists(os.path.join(shard_dir, filename)):
+                    os.remove(os.path.join(shard_dir, filename))
+        else:
+            _write_index_atomic(shard.word_index.index, os.path.join(shard_dir, TUNED_INDEX_FILES[0]))
+            _write_index_atomic(shard.pinyin_index.index, os.path.join(shard_dir, TUNED_INDEX_FILES[1]))
+            meta["tuned"] = {
+                "factory": selected["factory"],
+                "params": selected["params"],
+                "wordDistanceOffset": shard.word_index.distance_offset,
+                "pinyinDistanceOffset": shard.pinyin_index.distance_offset,
+            }
+            _write_meta_atomic(meta, meta_file_path)
+
+
+def tune_index(model, collection: str | None = None, sample_size: int = 500, top_k: int = 3, recall_target: float = 0.95,
+               factories: list[str] | None = None, apply: bool = True, allow_larger: bool = False) -> dict[str, Any]:
+    """
+    以flat索引的最终搜索结果(重排、合并后的词条)为基准，扫描索引类型及搜索参数，测量 recall@top_k 和延迟，
+    把(召回率、延迟、大小)帕累托最优的设置写入清单；apply时保存满足召回率目标且最快的索引，服务加载该索引目录时默认使用；
+    默认只选择不大于当前索引的设置，不会抵消 -quantizer 节省的内存
+
+    :param sample_size: 从 validate_keywords.txt 抽取的查询数
+    :param recall_target: 召回率目标
+    :param factories: FAISS index_factory 字符串，默认按向量数生成候选
+    :param allow_larger: 允许选择比当前索引更大的设置
+    """
+    name = collection or DEFAULT_COLLECTION
+    loaded = dictCollection.load_collection(name)
+    if loaded is None:
+        raise FileNotFoundError(f"Index not found for dict: {name}")
+    shard_dirs = get_shard_directories(loaded.batch_index_dir)
+    queries = _sample_queries(sample_size)
+    if not queries:
+        raise FileNotFoundError("validate_keywords.txt not found or empty")
+    print(f"Tuning {loaded.batch_index_dir} with {len(queries)} queries, top_k={top_k}, recall_target={recall_target}")
+    encoder = _encode_queries(model, queries)
+
+    # 从创建索引时的向量索引还原向量，量化索引还原的是近似向量
+    embeddings = []
+    quantizer = "flat"
+    current_bytes = 0
+    for shard_dir in shard_dirs:
+        word_index, pinyin_index = load_vector_indexes(mmap=True, batch_index_dir=shard_dir, tuned=False)
+        quantizer = word_index.quantizer
+        current_bytes += faiss.serialize_index(word_index.index).nbytes + faiss.serialize_index(pinyin_index.index).nbytes
+        embeddings.append((word_index.index.reconstruct_n(0, word_index.ntotal), pinyin_index.index.reconstruct_n(0, pinyin_index.ntotal)))
+    totals = [len(word_embeddings) for word_embeddings, _ in embeddings]
+    factories = factories or candidate_factories(min(totals), max(totals), embeddings[0][0].shape[1])
+
+    truth_shards = _build_shards("Flat", loaded.shards, embeddings)
+    truth = [{hit.word for hit in search_index_shards(query, encoder, truth_shards, top_k=top_k, pinyin=True)} for query in queries]
+
+    results = []
+    for factory in factories:
+        start = time.perf_counter()
+        try:
+            shards = _build_shards(factory, loaded.shards, embeddings)
+        except RuntimeError as e:
+            print(f"Skip {factory}: {e}")
+            continue
+        build_seconds = round(time.perf_counter() - start, 3)
+        size = sum(faiss.serialize_index(shard.word_index.index).nbytes + faiss.serialize_index(shard.pinyin_index.index).nbytes
+                   for shard in shards)
+        for params in _search_param_values(factory):
+            for shard in shards:
+                if params:
+                    faiss.ParameterSpace().set_index_parameters(shard.word_index.index, params)
+                    faiss.ParameterSpace().set_index_parameters(shard.pinyin_index.index, params)
+            item = {"factory": factory, "params": params, "buildSeconds": build_seconds, "bytes": size,
+                    **_evaluate(shards, encoder, queries, truth, top_k)}
+            print(f"{factory:>20} {params:>14} recall={item['recall']:.4f} latency={item['latencyMillis']:.3f}ms "
+                  f"p95={item['p95Millis']:.3f}ms bytes={item['bytes']}")
+            results.append(item)
+
+    front = pareto_front(results)
+    max_bytes = 0 if allow_larger else current_bytes
+    selected = select_setting(front, recall_target, max_bytes)
+    tuning = {
+        "createTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "groundTruth": "Flat" if quantizer == "flat" else f"Flat(reconstructed from {quantizer})",
+        "queries": len(queries),
+        "topK": top_k,
+        "recallTarget": recall_target,
+        "quantizer": quantizer,
+        "currentBytes": current_bytes,
+        "allowLarger": allow_larger,
+        "selected": selected,
+        "applied": apply,
+        "pareto": front,
+        "results": results,
+    }
+    if apply:
+        # 没有不超过当前大小的设置，或选中与原索引相同的设置时，不需要调优索引
+        if selected is None or (selected["factory"] == QUANTIZER_FACTORIES.get(quantizer) and not selected["params"]):
+            _save_tuned_indexes(loaded.shards, shard_dirs, None)
+        else:
+            shards = _build_shards(selected["factory"], loaded.shards, embeddings)
+            _save_tuned_indexes(shards, shard_dirs, selected)
+    indexManifest.update_manifest(loaded.batch_index_dir, tuning=tuning)
+    loaded.close()
+    return tuning
+
+
+def evaluate_prune_recall(model, batch_index_dir: str, ngram_min: int = 3, ngram_max: int = 5, sample_size: int = PRUNE_RECALL_SAMPLE,
+                          top_k: int = 3) -> dict[str, Any] | None:
+    """
+    测量剪枝对搜索的影响：与 tune 相同，以未剪枝的flat索引的最终搜索结果(重排、合并后的词条)为基准，测量剪枝后flat索引的 recall@top_k；
+    剪枝改变了近邻及其距离，可信阈值下的结果可能不同，字面覆盖不能反映这一点。
+    剪枝保留的索引词从刚创建的向量索引还原向量，只对剪掉的索引词重新向量化
+
+    :return: 召回率报告，validate_keywords.txt 不存在时返回None
+    """
+    queries = _sample_queries(sample_size)
+    if not queries:
+        return None
+    start = time.perf_counter()
+    encoder = _encode_queries(model, queries)
+    quantizer = "flat"
+    removed_count = 0
+    full_shards = []
+    pruned_shards = []
+    for shard_dir in get_shard_directories(batch_index_dir):
+        dict_words = load_dict_word_set(mmap=False, batch_index_dir=shard_dir)
+        index_words = build_index_words(list(dict_words.values()), ngram_min, ngram_max)
+        kept, kept_codes = load_index_word_codes(shard_dir)
+        removed = sorted(index_words.keys() - set(kept))
+        removed_count += len(removed)
+        word_index, pinyin_index = load_vector_indexes(mmap=True, batch_index_dir=shard_dir, tuned=False)
+        quantizer = word_index.quantizer
+        kept_embeddings = (word_index.index.reconstruct_n(0, word_index.ntotal), pinyin_index.index.reconstruct_n(0, pinyin_index.ntotal))
+        if removed:
+            removed_embeddings = _vector_words_with_model(0, removed, model)
+        else:
+            removed_embeddings = tuple(np.empty((0, embeddings.shape[1]), dtype=np.float32) for embeddings in kept_embeddings)
+        full_embeddings = [np.vstack([k, r]) for k, r in zip(kept_embeddings, removed_embeddings)]
+        full_codes = kept_codes + [index_words[key] for key in removed]
+        name = os.path.basename(shard_dir)
+        full_shards.append(IndexShard(name, dict_words, full_codes, *(VectorIndex(_build_index("Flat", e)[0]) for e in full_embeddings)))
+        pruned_shards.append(IndexShard(name, dict_words, kept_codes, *(VectorIndex(_build_index("Flat", e)[0]) for e in kept_embeddings)))
+
+    truth = [{hit.word for hit in search_index_shards(query, encoder, full_shards, top_k=top_k, pinyin=True)} for query in queries]
+    full = _evaluate(full_shards, encoder, queries, truth, top_k)
+    pruned = _evaluate(pruned_shards, encoder, queries, truth, top_k)
+    return {
+        "groundTruth": "Flat(unpruned)" if quantizer == "flat" else f"Flat(unpruned, kept vectors reconstructed from {quantizer})",
+        "queries": len(queries),
+        "topK": top_k,
+        "removed": removed_count,
+        "recall": pruned["recall"],
+        "latencyMillis": pruned["latencyMillis"],
+        "unprunedLatencyMillis": full["latencyMillis"],
+        "seconds": round(time.perf_counter() - start, 3),
+    }
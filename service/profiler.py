@@ -0,0 +1,180 @@
+import cProfile
+import heapq
+import io
+import itertools
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Any
+
+import basic
+
+# 采样间隔(毫秒)
+PROFILE_INTERVAL_MILLIS = 5
+# 分析方式：sample为采样分析，开销低，适合服务及耗时长的索引创建；cprofile统计每个函数的调用次数，适合短时间运行
+PROFILE_MODES = ("sample", "cprofile")
+# 栈顶位于这些文件或函数中的线程处于空闲等待，不计入采样
+_IDLE_FILES = ("threading.py", "selectors.py", "queue.py")
+_IDLE_FUNCTIONS = {("handlers.py", "dequeue")}  # 后台写日志的线程等待日志记录
+
+
+def _collapse(frame, thread_name: str) -> str | None:
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    if filename in _IDLE_FILES or (filename, code.co_name) in _IDLE_FUNCTIONS:
+        return None
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ';'.join(reversed(stack))
+
+
+class SamplingProfiler:
+    """
+    采样分析器：后台线程按固定间隔读取所有线程的调用栈并计数，输出折叠栈(collapsed stacks)，
+    可直接用于 flamegraph.pl 或 speedscope；torch、FAISS等C扩展的耗时计入调用它们的Python函数
+    """
+    def __init__(self, interval_millis: float = PROFILE_INTERVAL_MILLIS):
+        self.interval = interval_millis / 1000
+        self.counts: Counter[str] = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> 'SamplingProfiler':
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == ident:
+                    continue
+                stack = _collapse(frame, names.get(thread_id, str(thread_id)))
+                if stack:
+                    self.counts[stack] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return '\n'.join(f"{stack} {count}" for stack, count in self.counts.most_common())
+
+    def top_functions(self, n: int = 15) -> list[tuple[str, int]]:
+        # 按栈顶函数(自身耗时)汇总
+        leaves = Counter()
+        for stack, count in self.counts.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(n)
+
+
+@contextmanager
+def profiling(name: str, mode: str = "sample"):
+    """
+    分析代码块，结束后把结果写入 logs/profile_<name>_<时间>：采样分析为折叠栈(.txt)，cProfile为pstats文件(.prof)，并打印耗时最多的函数
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode: {mode}, must be one of {list(PROFILE_MODES)}")
+    log_dir = os.path.join(basic.func.get_executable_directory(), 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    filepath = os.path.join(log_dir, f"profile_{name}_{datetime.now().strftime('%Y%m%d%H%M%S')}")
+    if mode == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(f"{filepath}.prof")
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(20)
+            print(output.getvalue())
+            print(f"Profile saved to {filepath}.prof")
+        return
+    profiler = SamplingProfiler().start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        with open(f"{filepath}.txt", 'w', encoding='utf-8') as file:
+            file.write(profiler.collapsed())
+        print(f"Top functions of {profiler.samples} samples:")
+        for function, count in profiler.top_functions():
+            print(f"\t{count * 100 / max(profiler.samples, 1):6.2f}% {function}")
+        print(f"Collapsed stacks saved to {filepath}.txt")
+
+
+class StageTimings:
+    """
+    记录一次请求各阶段的耗时(毫秒)；分片并行搜索时同名阶段的耗时累加
+    """
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name: str):
+        return self._timed(name)
+
+    def add(self, name: str, millis: float):
+        with self._lock:
+            self.stages[name] = round(self.stages.get(name, 0.0) + millis, 3)
+
+    @contextmanager
+    def _timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+
+class _NoTimings(StageTimings):
+    # 未开启分析时不计时
+    def stage(self, name: str):
+        return nullcontext()
+
+    def add(self, name: str, millis: float):
+        pass
+
+
+NO_TIMINGS = _NoTimings()
+
+
+class SlowestRequests:
+    """
+    保留耗时最长的N个请求及其各阶段耗时
+    """
+    def __init__(self, size: int = 20):
+        self.size = size
+        self._heap: list[tuple[float, int, dict[str, Any]]] = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def record(self, millis: float, item: dict[str, Any]):
+        if self.size <= 0:
+            return
+        entry = (millis, next(self._counter), item)
+        with self._lock:
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, entry)
+            elif millis > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+
+    def list(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [item for _, _, item in sorted(self._heap, key=lambda x: -x[0])]
@@ -1,17 +1,174 @@
+import functools
+import itertools
+import json
 import math
 import multiprocessing
 import os
+import queue
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, NamedTuple
 
 import faiss
 import numpy as np
 import psutil
-from faiss import IndexFlatL2
 from pydantic import BaseModel
 from sentence_transformers import SentenceTransformer
 
 import basic
-from .dictWords import DictWord, trim_word, pinyin_word, get_latest_directory
+from .dictWords import DictWord, MappedDictWords, MappedIndexCodes, SuggestIndex, LexicalIndex, trim_word, pinyin_word, \
+    get_latest_directory, load_dict_word_set, load_index_codes, load_suggest_index, load_lexical_index
+from .profiler import NO_TIMINGS, StageTimings
+
+
+# 向量存储方式：flat为原始float32，fp16/int8为FAISS标量量化
+QUANTIZER_TYPES = {
+    "flat": None,
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "int8": faiss.ScalarQuantizer.QT_8bit,
+}
+
+# 搜索引擎：vector为向量索引，lexical为字符n-gram的TF-IDF索引，hybrid为两者合并
+SEARCH_ENGINES = ("vector", "lexical", "hybrid")
+
+# tune 命令生成的词索引、拼音索引文件
+TUNED_INDEX_FILES = ['word_index_tuned.bin', 'pinyin_index_tuned.bin']
+
+
+class VectorIndex:
+    """
+    FAISS索引的包装，对量化索引返回的距离做校准，使IndexWord.isCredible的阈值与flat索引保持一致
+    """
+    def __init__(self, index: faiss.Index, quantizer: str = "flat", distance_offset: float = 0.0, filepath: str | None = None):
+        self.index = index
+        self.quantizer = quantizer
+        self.distance_offset = distance_offset
+        self.filepath = filepath  # 加载的索引文件，内存中创建的索引为None
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def search(self, vectors: np.ndarray, k: int) -> (np.ndarray, np.ndarray):
+        distances, indices = self.index.search(vectors, k)
+        if self.distance_offset > 0:
+            distances = np.maximum(distances - self.distance_offset, 0)
+        return distances, indices
+
+
+class IndexShard:
+    """
+    一个分片的全部只读搜索数据：字典、倒排表、词向量索引、拼音向量索引、输入提示索引、字面索引
+    """
+    def __init__(self, name: str, dict_words: dict[str, DictWord] | MappedDictWords, index_codes: list[set[str]] | MappedIndexCodes,
+                 word_index: VectorIndex, pinyin_index: VectorIndex, suggest_index: SuggestIndex | None = None,
+                 lexical_index: LexicalIndex | None = None):
+        self.name = name
+        self.dict_words = dict_words
+        self.index_codes = index_codes
+        self.word_index = word_index
+        self.pinyin_index = pinyin_index
+        self.suggest_index = suggest_index
+        self.lexical_index = lexical_index
+
+    def __str__(self):
+        return f"shard={self.name}, words={len(self.dict_words)}, index={len(self.index_codes)}"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# 分数小于2的词索引结果，距离超过该值一定不可信
+MAX_CREDIBLE_DISTANCE = 0.5
+# 字面索引的距离为 1 - 余弦相似度(0~1)，与词索引的L2平方距离不可比；分数小于2的字面结果，距离超过该值不可信
+LEXICAL_MAX_CREDIBLE_DISTANCE = 0.5
+# 自适应搜索最多取 top_n 的倍数个近邻
+ADAPTIVE_MAX_DEPTH_FACTOR = 4
+
+# 降级级别：跳过拼音索引、top_n缩小为top_k、限制候选扩展(关闭自适应加深、每个近邻最多重排的词条数)、停止搜索
+DEGRADE_SKIP_PINYIN = 1
+DEGRADE_SHRINK_TOP_N = 2
+DEGRADE_CAP_CANDIDATES = 3
+DEGRADE_STOP = 4
+# 已用时间达到预算的比例时升到对应的降级级别
+DEGRADE_BUDGET_RATIOS = (0.5, 0.7, 0.85, 1.0)
+# 限制候选扩展后每个近邻最多重排的词条数
+DEGRADED_MAX_CODES = 20
+
+
+class SearchBudget:
+    """
+    单次搜索的延迟预算，在搜索阶段之间检查：已用时间越接近预算，降级级别越高；
+    级别只升不降，记录实际执行的降级步骤
+    """
+    def __init__(self, budget_millis: float = 0, start: float | None = None, level: int = 0):
+        self.budget_millis = budget_millis  # 0表示不限制
+        self.start = start if start is not None else time.perf_counter()  # 请求到达的时间，排队时间也计入预算
+        self.level = level
+        self._steps: dict[str, None] = {}  # 各分片线程并行记录，保持顺序
+
+    def elapsed_millis(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def check(self) -> int:
+        if self.budget_millis > 0:
+            used = self.elapsed_millis() / self.budget_millis
+            level = sum(1 for ratio in DEGRADE_BUDGET_RATIOS if used >= ratio)
+            self.level = max(self.level, level)
+        return self.level
+
+    def degrade(self, step: str, level: int) -> bool:
+        """
+        :return: 达到降级级别时记录降级步骤并返回True
+        """
+        if self.check() < level:
+            return False
+        self._steps.setdefault(step)
+        return True
+
+    @property
+    def steps(self) -> list[str]:
+        return list(self._steps)
+
+    @property
+    def degraded(self) -> bool:
+        return bool(self._steps)
+
+
+def queue_degrade_level(in_flight: int, queue_degrade: int = 0, queue_reject: int = 0) -> int:
+    """
+    按排队(含正在处理)的搜索请求数得到初始降级级别
+
+    :param queue_degrade: 请求数每超过一倍该值降一级，最多降到限制候选扩展，0表示不按排队数降级
+    :param queue_reject: 请求数超过该值时直接停止搜索，0表示不拒绝
+    """
+    if queue_reject > 0 and in_flight > queue_reject:
+        return DEGRADE_STOP
+    if queue_degrade <= 0 or in_flight <= queue_degrade:
+        return 0
+    return min(in_flight // queue_degrade, DEGRADE_CAP_CANDIDATES)
+
+
+def search_depth(top_k: int) -> int:
+    # 每个向量索引取出并重排的近邻数 top_n
+    return max(top_k + 5, top_k * 2)
+
+
+def is_credible(index: str, word: str, score: int, distance: float) -> bool:
+    if index == "PINYIN":
+        return True
+    if index == "LEXICAL":
+        return score >= 2 or distance < LEXICAL_MAX_CREDIBLE_DISTANCE
+    if score < 1:
+        return distance < 0.4
+    elif score == 1:
+        if len(word) > 3:
+            return distance < 0.3
+        else:
+            return distance < MAX_CREDIBLE_DISTANCE
+    else:
+        return True
 
 
 class IndexWord(BaseModel):
@@ -22,20 +179,25 @@ class IndexWord(BaseModel):
     distance: float
 
     def isCredible(self) -> bool:
-        if self.index == "PINYIN":
-            return True
-        if self.score < 1:
-            return self.distance < 0.4
-        elif self.score == 1:
-            if len(self.word) > 3:
-                return self.distance < 0.3
-            else:
-                return self.distance < 0.5
-        else:
-            return True
+        return is_credible(self.index, self.word, self.score, self.distance)
+
+
+class SearchHit(NamedTuple):
+    """
+    搜索过程中使用的轻量结果，只有最终返回的top_k才转换为IndexWord或JSON
+    """
+    index: str
+    code: str
+    word: str
+    score: int
+    distance: float
+
+    def to_index_word(self) -> IndexWord:
+        return IndexWord.model_construct(**self._asdict())
 
 
-def _vector_words_with_model(process_index : int, index_words: list[str], model: SentenceTransformer, batch_size : int = 500,) -> (list[np.ndarray], list[np.ndarray]):
+def _vector_words_with_model(process_index : int, index_words: list[str], model: SentenceTransformer, batch_size : int = 500,
+                             progress: Callable[[int], None] | None = None) -> (list[np.ndarray], list[np.ndarray]):
     word_embeddings = []
     pinyin_embeddings = []
     count = 0
@@ -50,56 +212,143 @@ def _vector_words_with_model(process_index : int, index_words: list[str], model:
         word_embeddings.append(model.encode(original_words))
         pinyin_embeddings.append(model.encode(pinyin_words))
         print(f"Process[{process_index}] Indexing {count}/{len(index_words)} index words")
+        if progress:
+            progress(len(original_words))
     word_embeddings = np.vstack(word_embeddings)
     pinyin_embeddings = np.vstack(pinyin_embeddings)
     return word_embeddings, pinyin_embeddings
 
 
-def create_vector_indexes(batch_index_dir : str, index_words : list[str], model : SentenceTransformer, worker : int = 0, batch_size : int = 500):
+def _calibrate_distance_offset(index: faiss.Index, embeddings: np.ndarray, sample_size: int = 10000) -> float:
+    """
+    量化后的平方L2距离约等于原始距离加上向量的平均重建误差，取样本的平均重建误差作为距离校准偏移量
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)  # HNSW不支持编解码，由存储向量的索引计算
+    sample = embeddings[:sample_size]
+    reconstructed = index.sa_decode(index.sa_encode(sample))
+    return float(np.mean(np.sum((sample - reconstructed) ** 2, axis=1)))
+
+
+def _create_faiss_index(embeddings: np.ndarray, quantizer: str = "flat") -> (faiss.Index, float):
+    d = embeddings.shape[1]  # 向量维度
+    qtype = QUANTIZER_TYPES[quantizer]
+    if qtype is None:
+        index = faiss.IndexFlatL2(d)  # 使用L2距离
+        index.add(embeddings)  # 添加向量到索引
+        return index, 0.0
+    index = faiss.IndexScalarQuantizer(d, qtype, faiss.METRIC_L2)
+    index.train(embeddings)  # 统计每个维度的取值范围
+    index.add(embeddings)
+    return index, _calibrate_distance_offset(index, embeddings)
+
+
+def create_vector_indexes(batch_index_dir : str, index_words : list[str], model : SentenceTransformer, worker : int = 0, batch_size : int = 500,
+                          quantizer : str = "flat", progress : Callable[[int], None] | None = None):
+    """
+    :param progress: 进度回调，参数为已向量化的索引词数量
+    """
+    if quantizer not in QUANTIZER_TYPES:
+        raise ValueError(f"Unknown quantizer: {quantizer}, must be one of {list(QUANTIZER_TYPES.keys())}")
     word_embeddings = []
     pinyin_embeddings = []
     if worker == 0:
         worker = psutil.cpu_count(logical=True)
     worker_size = math.ceil(len(index_words)/worker)
     print(f"Creating indexes with {worker} workers, each worker process {worker_size} words")
+    embedded_count = 0
+
+    def on_embedded(count: int):
+        nonlocal embedded_count
+        embedded_count += count
+        progress(embedded_count)
+
     if worker == 1:
-        word_embeddings, pinyin_embeddings = _vector_words_with_model(1, index_words, model, batch_size)
+        word_embeddings, pinyin_embeddings = _vector_words_with_model(1, index_words, model, batch_size, on_embedded if progress else None)
     else:
-        with multiprocessing.Pool(processes=worker) as pool:
-            worker_index = 1
-            results = []
-            for i in range(0, len(index_words), worker_size):
-                batch_words = index_words[i:i + worker_size]
-                result = pool.apply_async(_vector_words_with_model, args=(worker_index, batch_words, model, batch_size))
-                results.append(result)
-                worker_index = worker_index + 1
-
-            for result in results:
-                word_embedding, pinyin_embedding = result.get()
-                word_embeddings.append(word_embedding)
-                pinyin_embeddings.append(pinyin_embedding)
+        # 子进程通过队列汇报每批的向量化数量
+        manager = multiprocessing.Manager() if progress else None
+        progress_queue = manager.Queue() if manager else None
+        try:
+            with multiprocessing.Pool(processes=worker) as pool:
+                worker_index = 1
+                results = []
+                for i in range(0, len(index_words), worker_size):
+                    batch_words = index_words[i:i + worker_size]
+                    result = pool.apply_async(_vector_words_with_model, args=(worker_index, batch_words, model, batch_size,
+                                                                              progress_queue.put if progress_queue is not None else None))
+                    results.append(result)
+                    worker_index = worker_index + 1
+
+                while progress_queue is not None and not all(result.ready() for result in results):
+                    try:
+                        on_embedded(progress_queue.get(timeout=0.5))
+                    except queue.Empty:
+                        pass
+                while progress_queue is not None and not progress_queue.empty():
+                    on_embedded(progress_queue.get())
+
+                for result in results:
+                    word_embedding, pinyin_embedding = result.get()
+                    word_embeddings.append(word_embedding)
+                    pinyin_embeddings.append(pinyin_embedding)
+        finally:
+            if manager:
+                manager.shutdown()
 
     word_embeddings = np.vstack(word_embeddings)
     pinyin_embeddings = np.vstack(pinyin_embeddings)
     # 创建FAISS索引
-    d = word_embeddings.shape[1]  # 向量维度
-    word_index = faiss.IndexFlatL2(d)  # 使用L2距离
-    word_index.add(word_embeddings)    # 添加向量到索引
+    word_index, word_distance_offset = _create_faiss_index(word_embeddings, quantizer)
     word_index_file_path = os.path.join(batch_index_dir, 'word_index.bin')
     faiss.write_index(word_index, word_index_file_path)
     print(f"Word index saved to {word_index_file_path}")
     # 创建FAISS索引
-    d = pinyin_embeddings.shape[1]  # 向量维度
-    pinyin_index = faiss.IndexFlatL2(d)  # 使用L2距离
-    pinyin_index.add(pinyin_embeddings)    # 添加向量到索引
+    pinyin_index, pinyin_distance_offset = _create_faiss_index(pinyin_embeddings, quantizer)
     pinyin_index_file_path = os.path.join(batch_index_dir, 'pinyin_index.bin')
     faiss.write_index(pinyin_index, pinyin_index_file_path)
     print(f"Pinyin index saved to {pinyin_index_file_path}")
+    # 保存量化方式及距离校准参数
+    meta_file_path = os.path.join(batch_index_dir, 'index_meta.json')
+    with open(meta_file_path, 'w', encoding='utf-8') as file:
+        json.dump({
+            "quantizer": quantizer,
+            "wordDistanceOffset": word_distance_offset,
+            "pinyinDistanceOffset": pinyin_distance_offset,
+        }, file, ensure_ascii=False, indent=2)
+    print(f"Index meta saved to {meta_file_path}, quantizer={quantizer}")
+
+
+def _load_index_meta(batch_index_dir: str) -> dict:
+    meta_file_path = os.path.join(batch_index_dir, 'index_meta.json')
+    if not os.path.exists(meta_file_path):
+        return {"quantizer": "flat", "wordDistanceOffset": 0.0, "pinyinDistanceOffset": 0.0}
+    with open(meta_file_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
 
+@functools.cache
+def _mmap_io_flags() -> int:
+    # flat及标量量化索引(IndexFlatCodes)需要 IO_FLAG_MMAP_IFC 才会内存映射，只有 IO_FLAG_MMAP 时向量被复制到进程私有内存
+    if not hasattr(faiss, 'IO_FLAG_MMAP_IFC'):
+        basic.log().warning(f"faiss {faiss.__version__} has no IO_FLAG_MMAP_IFC, flat/fp16/int8 indexes are copied into each process, "
+                            f"upgrade faiss-cpu to the version in requirements.txt")
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
 
-def load_vector_indexes() -> (IndexFlatL2, IndexFlatL2):
+def _read_index(filepath: str, io_flags: int, search_params: str = "") -> faiss.Index:
+    index = faiss.read_index(filepath, io_flags)
+    if search_params:
+        faiss.ParameterSpace().set_index_parameters(index, search_params)
+    return index
+
+
+def load_vector_indexes(mmap: bool = False, batch_index_dir: str | None = None, tuned: bool = True) -> (VectorIndex, VectorIndex):
+    """
+    :param tuned: 索引目录经过 tune 命令调优时，加载调优后的索引及搜索参数
+    """
     log = basic.log()  # 确保log函数正确
-    batch_index_dir = get_latest_directory()
+    batch_index_dir = batch_index_dir or get_latest_directory()
     if not batch_index_dir:
         log.error("Index directory not found")
         return None, None
@@ -108,11 +357,55 @@ def load_vector_indexes() -> (IndexFlatL2, IndexFlatL2):
     if not os.path.exists(word_index_file_path) or not os.path.exists(pinyin_index_file_path):
         log.error(f"Index file not found: {word_index_file_path} or {pinyin_index_file_path}")
         return None, None
-    word_index = faiss.read_index(word_index_file_path)
-    pinyin_index = faiss.read_index(pinyin_index_file_path)
+    meta = _load_index_meta(batch_index_dir)
+    quantizer = meta.get("quantizer", "flat")
+    # 以只读内存映射方式打开，多个进程共享同一份页缓存
+    io_flags = _mmap_io_flags() if mmap else 0
+    tuned_meta = meta.get("tuned") if tuned else None
+    if tuned_meta and all(os.path.exists(os.path.join(batch_index_dir, f)) for f in TUNED_INDEX_FILES):
+        params = tuned_meta.get("params", "")
+        word_index_file_path, pinyin_index_file_path = (os.path.join(batch_index_dir, f) for f in TUNED_INDEX_FILES)
+        word_index = VectorIndex(_read_index(word_index_file_path, io_flags, params),
+                                 tuned_meta["factory"], tuned_meta.get("wordDistanceOffset", 0.0), word_index_file_path)
+        pinyin_index = VectorIndex(_read_index(pinyin_index_file_path, io_flags, params),
+                                   tuned_meta["factory"], tuned_meta.get("pinyinDistanceOffset", 0.0), pinyin_index_file_path)
+        return word_index, pinyin_index
+    word_index = VectorIndex(faiss.read_index(word_index_file_path, io_flags), quantizer, meta.get("wordDistanceOffset", 0.0),
+                             word_index_file_path)
+    pinyin_index = VectorIndex(faiss.read_index(pinyin_index_file_path, io_flags), quantizer, meta.get("pinyinDistanceOffset", 0.0),
+                               pinyin_index_file_path)
     return word_index, pinyin_index
 
 
+def get_shard_directories(batch_index_dir: str) -> list[str]:
+    shard_pattern = re.compile(r'^shard_\d+$')
+    shard_dirs = [d for d in os.listdir(batch_index_dir) if os.path.isdir(os.path.join(batch_index_dir, d)) and shard_pattern.match(d)]
+    if not shard_dirs:
+        return [batch_index_dir]
+    return [os.path.join(batch_index_dir, d) for d in sorted(shard_dirs)]
+
+
+def load_index_shards(mmap: bool = False, batch_index_dir: str | None = None) -> list[IndexShard]:
+    log = basic.log()
+    batch_index_dir = batch_index_dir or get_latest_directory()
+    if not batch_index_dir:
+        log.error("Index directory not found")
+        return []
+    shards = []
+    for shard_dir in get_shard_directories(batch_index_dir):
+        word_index, pinyin_index = load_vector_indexes(mmap=mmap, batch_index_dir=shard_dir)
+        if not word_index or not pinyin_index:
+            return []
+        shards.append(IndexShard(name=os.path.basename(shard_dir),
+                                 dict_words=load_dict_word_set(mmap=mmap, batch_index_dir=shard_dir),
+                                 index_codes=load_index_codes(mmap=mmap, batch_index_dir=shard_dir),
+                                 word_index=word_index, pinyin_index=pinyin_index,
+                                 suggest_index=load_suggest_index(shard_dir) if mmap else None,
+                                 lexical_index=load_lexical_index(shard_dir) if mmap else None))
+    log.info(f"Loaded {len(shards)} index shards from {batch_index_dir}")
+    return shards
+
+
 def calculate_match_score(search_word: str, dictionary_word: str) -> int:
     score = 0
     position_dict = {}
@@ -152,51 +445,89 @@ def calculate_match_score(search_word: str, dictionary_word: str) -> int:
 
     return score
 
-def _search_vector_indexes(key_word: str, pinyin: bool,  model: SentenceTransformer, vector_index: IndexFlatL2,
-                           index_codes: list[set[str]], dict_words: dict[str, DictWord],top_k : int) -> list[IndexWord]:
-    word_vector = model.encode([key_word] if not pinyin else [pinyin_word(key_word)])
-    distances, indices = vector_index.search(word_vector, top_k)
-    results = []
-    for i in range(top_k):
-        word_index = indices[0][i]
-        similar_codes = index_codes[word_index]
-        distance = distances[0][i]
-        for code in similar_codes:
+def _rerank_neighbors(key_word: str, index_name: str, neighbors, index_codes: list[set[str]] | MappedIndexCodes,
+                      dict_words: dict[str, DictWord] | MappedDictWords, results: list[SearchHit], max_codes: int | None = None):
+    for word_index, distance in neighbors:
+        if word_index < 0:
+            break  # 分片中的向量数少于top_k
+        codes = index_codes[word_index]
+        for code in itertools.islice(codes, max_codes) if max_codes else codes:
             similar_word = dict_words[code]
             score = calculate_match_score(key_word, similar_word.word)
-            iw = IndexWord(index="PINYIN" if pinyin else "WORD", code=code, word=similar_word.word, score=score, distance=distance)
-            if iw.isCredible():
-                results.append(iw)
+            if is_credible(index_name, similar_word.word, score, distance):
+                results.append(SearchHit(index_name, similar_word.code, similar_word.word, score, distance))
+
+def _search_vector_indexes(key_word: str, pinyin: bool, word_vector: np.ndarray, vector_index: VectorIndex,
+                           index_codes: list[set[str]] | MappedIndexCodes, dict_words: dict[str, DictWord] | MappedDictWords, top_k : int,
+                           max_codes: int | None = None, timings: StageTimings = NO_TIMINGS) -> list[SearchHit]:
+    stage = "pinyin" if pinyin else "word"
+    with timings.stage(f"{stage}Search"):
+        distances, indices = vector_index.search(word_vector, top_k)
+    results = []
+    with timings.stage(f"{stage}Rerank"):
+        _rerank_neighbors(key_word, "PINYIN" if pinyin else "WORD", zip(indices[0].tolist(), distances[0].tolist()),
+                          index_codes, dict_words, results, max_codes)
     return results
 
-def get_word_index_last_modify_time() -> str:
-    batch_index_dir = get_latest_directory()
-    if not batch_index_dir:
-        return '1900-01-01 00:00:00'
-    filepath = os.path.join(batch_index_dir, 'word_index.bin')
-    return basic.func.get_file_last_modify_time(filepath)
+def _search_vector_indexes_adaptive(key_word: str, word_vector: np.ndarray, vector_index: VectorIndex,
+                                    index_codes: list[set[str]] | MappedIndexCodes, dict_words: dict[str, DictWord] | MappedDictWords,
+                                    top_k: int, top_n: int) -> list[SearchHit]:
+    """
+    自适应搜索词索引：先与固定深度相同重排最近的top_n个近邻，得到top_k个不重复的可信词即停止，结果与固定深度相同；
+    不足时再逐轮加深，最多重排 top_n * ADAPTIVE_MAX_DEPTH_FACTOR 个近邻，候选词只增不减，不会比固定深度差
+    """
+    results = []
+    reranked = set()
 
-def get_pinyin_index_last_modify_time() -> str:
-    batch_index_dir = get_latest_directory()
-    if not batch_index_dir:
-        return '1900-01-01 00:00:00'
-    filepath = os.path.join(batch_index_dir, 'pinyin_index.bin')
-    return basic.func.get_file_last_modify_time(filepath)
+    def rerank(neighbors) -> bool:
+        neighbors = [(i, d) for i, d in neighbors if i not in reranked]
+        _rerank_neighbors(key_word, "WORD", neighbors, index_codes, dict_words, results)
+        reranked.update(i for i, _ in neighbors)
+        return len({hit.word for hit in results}) >= top_k
 
-def search_vector_indexes(word: str, model: SentenceTransformer, word_index: IndexFlatL2, pinyin_index : IndexFlatL2,
-                          index_codes: list[set[str]], dict_words: dict[str, DictWord], top_k: int = 5, pinyin : bool = False) -> list[IndexWord]:
+    distances, indices = vector_index.search(word_vector, top_n)
+    if rerank(zip(indices[0].tolist(), distances[0].tolist())):
+        return results
 
-    key_word = trim_word(word)
+    # 分数较高的词在可信距离之外也可信，继续加深：一次取出最大深度的近邻，逐轮加倍重排
+    max_depth = min(top_n * ADAPTIVE_MAX_DEPTH_FACTOR, vector_index.ntotal)
+    distances, indices = vector_index.search(word_vector, max_depth)
+    neighbors = list(zip(indices[0].tolist(), distances[0].tolist()))
+    depth = top_n
+    while not rerank(neighbors[:depth]) and depth < max_depth:
+        depth *= 2
+    return results
 
-    top_n = max(top_k + 5, top_k * 2)
+def _search_lexical_index(key_word: str, lexical_index: LexicalIndex, dict_words: MappedDictWords, top_n: int) -> list[SearchHit]:
+    # 字面索引的候选词同样按匹配分数重排，距离为 1 - 余弦相似度
+    results = []
+    for row, similarity in lexical_index.search(key_word, top_n):
+        similar_word = dict_words[row]
+        score = calculate_match_score(key_word, similar_word.word)
+        distance = max(1.0 - similarity, 0.0)
+        if is_credible("LEXICAL", similar_word.word, score, distance):
+            results.append(SearchHit("LEXICAL", similar_word.code, similar_word.word, score, distance))
+    return results
 
-    # 搜索拼音和非拼音的向量索引
-    index_words = _search_vector_indexes(key_word, False, model, word_index, index_codes, dict_words, top_n)
-    if pinyin:
-        index_words += _search_vector_indexes(key_word, True, model, pinyin_index, index_codes, dict_words, top_n)
+def _engine_ranks(index_words: list[SearchHit]) -> list[int]:
+    """
+    结果在各自引擎内按分数和距离排序的名次：向量(词、拼音索引，L2平方距离)和字面(1 - 余弦相似度)的距离不可比
+    """
+    ranks = [0] * len(index_words)
+    engines = {}
+    for i, iw in enumerate(index_words):
+        engines.setdefault(iw.index == "LEXICAL", []).append(i)
+    for rows in engines.values():
+        rows.sort(key=lambda i: (-index_words[i].score, index_words[i].distance, len(index_words[i].word)))
+        for rank, i in enumerate(rows):
+            ranks[i] = rank
+    return ranks
 
-    # 按照分数和距离排序
-    sorted_results = sorted(index_words, key=lambda x: (-x.score, x.distance, len(x.word)))
+def _merge_index_words(index_words: list[SearchHit], top_k: int) -> list[SearchHit]:
+    # 按照分数和引擎内的名次排序，只有一种引擎时与按距离排序相同
+    ranks = _engine_ranks(index_words)
+    order = sorted(range(len(index_words)), key=lambda i: (-index_words[i].score, ranks[i], len(index_words[i].word)))
+    sorted_results = [index_words[i] for i in order]
 
     # 去除重复的词
     exist_words = set()
@@ -207,4 +538,100 @@ def search_vector_indexes(word: str, model: SentenceTransformer, word_index: Ind
         exist_words.add(iw.word)
         return_index_words.append(iw)
 
-    return return_index_words[:top_k]
\ No newline at end of file
+    return return_index_words[:top_k]
+
+def search_index_shards(word: str, model: SentenceTransformer | None, shards: list[IndexShard], top_k: int = 5, pinyin : bool = False,
+                        executor: ThreadPoolExecutor | None = None, adaptive: bool = False, engine: str = "vector",
+                        budget: SearchBudget | None = None, timings: StageTimings | None = None) -> list[SearchHit]:
+    """
+    搜索所有分片并合并结果，查询向量只计算一次；提供executor时各分片并行搜索
+
+    :param adaptive: 可信词不足top_k时加深近邻，难搜的词召回更多
+    :param engine: vector / lexical / hybrid，lexical不经过模型，model可以为None
+    :param budget: 延迟预算，各阶段之前检查，超出时逐级降级，降级步骤记录在budget中
+    :param timings: 记录各阶段的耗时
+    """
+    key_word = trim_word(word)
+    budget = budget or SearchBudget()
+    timings = timings or NO_TIMINGS
+
+    top_n = search_depth(top_k)
+    max_codes = None
+
+    use_vector = engine != "lexical"
+    with timings.stage("encode"):
+        word_vector = model.encode([key_word]) if use_vector else None
+    # 拼音向量需要再编码一次，最先降级
+    pinyin = pinyin and use_vector and not budget.degrade("skipPinyin", DEGRADE_SKIP_PINYIN)
+    with timings.stage("pinyinEncode"):
+        pinyin_vector = model.encode([pinyin_word(key_word)]) if pinyin else None
+    if budget.degrade("shrinkTopN", DEGRADE_SHRINK_TOP_N):
+        top_n = top_k
+    if budget.degrade("capCandidates", DEGRADE_CAP_CANDIDATES):
+        adaptive = False
+        max_codes = DEGRADED_MAX_CODES
+
+    # 搜索拼音和非拼音的向量索引，以及字面索引
+    def search_shard(shard: IndexShard) -> list[SearchHit]:
+        results = []
+        # 超出预算时不再搜索剩余的分片，返回已有的结果
+        if budget.degrade("partial", DEGRADE_STOP):
+            return results
+        if engine != "vector" and shard.lexical_index is not None:
+            with timings.stage("lexical"):
+                results += _search_lexical_index(key_word, shard.lexical_index, shard.dict_words, top_n)
+        if not use_vector:
+            return results
+        if adaptive:
+            with timings.stage("wordAdaptive"):
+                results += _search_vector_indexes_adaptive(key_word, word_vector, shard.word_index, shard.index_codes, shard.dict_words, top_k, top_n)
+        else:
+            results += _search_vector_indexes(key_word, False, word_vector, shard.word_index, shard.index_codes, shard.dict_words, top_n,
+                                              max_codes, timings)
+        # 拼音索引的结果都可信，保持固定深度
+        if pinyin and not budget.degrade("skipPinyin", DEGRADE_SKIP_PINYIN):
+            results += _search_vector_indexes(key_word, True, pinyin_vector, shard.pinyin_index, shard.index_codes, shard.dict_words, top_n,
+                                              max_codes, timings)
+        return results
+
+    if executor is None or len(shards) == 1:
+        shard_results = map(search_shard, shards)
+    else:
+        shard_results = executor.map(search_shard, shards)
+    index_words = [iw for results in shard_results for iw in results]
+    with timings.stage("merge"):
+        return _merge_index_words(index_words, top_k)
+
+class SuggestHit(NamedTuple):
+    code: str
+    word: str
+    weight: float
+
+
+def suggest_index_shards(prefix: str, shards: list[IndexShard], top_n: int = 10) -> list[SuggestHit]:
+    """
+    按前缀(词条、全拼或拼音首字母)补全字典词条，不经过模型和向量索引
+    """
+    hits = []
+    for shard in shards:
+        if shard.suggest_index is None:
+            continue
+        for row, weight in shard.suggest_index.suggest(prefix, top_n):
+            dict_word = shard.dict_words[row]
+            hits.append(SuggestHit(dict_word.code, dict_word.word, weight))
+    hits.sort(key=lambda x: (-x.weight, len(x.word)))
+
+    exist_words = set()
+    results = []
+    for hit in hits:
+        if hit.word in exist_words:
+            continue
+        exist_words.add(hit.word)
+        results.append(hit)
+    return results[:top_n]
+
+def search_vector_indexes(word: str, model: SentenceTransformer, word_index: VectorIndex, pinyin_index : VectorIndex,
+                          index_codes: list[set[str]] | MappedIndexCodes, dict_words: dict[str, DictWord] | MappedDictWords, top_k: int = 5, pinyin : bool = False) -> list[IndexWord]:
+    shard = IndexShard(name="", dict_words=dict_words, index_codes=index_codes, word_index=word_index, pinyin_index=pinyin_index)
+    hits = search_index_shards(word=word, model=model, shards=[shard], top_k=top_k, pinyin=pinyin)
+    return [hit.to_index_word() for hit in hits]
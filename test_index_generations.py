@@ -0,0 +1,84 @@
+import csv
+import os
+import shutil
+import tempfile
+
+import faiss
+import numpy as np
+
+import basic.func
+from service import dictWords
+from service import indexManifest
+
+
+def write_generation(base_path: str, name: str, vectors: int = 4, manifest: bool = False, building: bool = False,
+                     skip: str | None = None, truncate: bool = False) -> str:
+    """
+    不经过模型写一个旧版本格式的索引目录：字典、索引词及两个flat向量索引
+    """
+    batch_index_dir = os.path.join(base_path, name)
+    os.makedirs(batch_index_dir)
+    with open(os.path.join(batch_index_dir, 'dict_words.csv'), 'w', newline='', encoding='utf-8') as file:
+        csv.writer(file).writerows([[str(i), f"词条{i}"] for i in range(vectors)])
+    with open(os.path.join(batch_index_dir, 'index_words.csv'), 'w', newline='', encoding='utf-8') as file:
+        csv.writer(file).writerows([[f"词条{i}", str(i)] for i in range(vectors)])
+    for filename in ('word_index.bin', 'pinyin_index.bin'):
+        index = faiss.IndexFlatL2(8)
+        index.add(np.random.rand(vectors, 8).astype(np.float32))
+        filepath = os.path.join(batch_index_dir, filename)
+        faiss.write_index(index, filepath)
+        if truncate:
+            with open(filepath, 'r+b') as file:
+                file.truncate(os.path.getsize(filepath) // 2)
+    if skip:
+        os.remove(os.path.join(batch_index_dir, skip))
+    if building:
+        open(os.path.join(batch_index_dir, dictWords.BUILDING_FILE), 'w').close()
+    if manifest:
+        indexManifest.write_manifest(batch_index_dir, {}, {}, [batch_index_dir])
+    return batch_index_dir
+
+
+if __name__ == '__main__':
+    # 在临时目录中创建索引目录，不影响 index/ 下的索引
+    root = tempfile.mkdtemp()
+    basic.func.get_executable_directory = lambda: root
+    base_path = dictWords.get_index_base_directory()
+    os.makedirs(base_path)
+    try:
+        # 写入清单的目录是完整的，更新的创建中目录不会被加载
+        complete = write_generation(base_path, '20240101000000', manifest=True)
+        write_generation(base_path, '20240102000000', building=True)
+        assert dictWords.get_latest_directory() == complete
+
+        # 旧版本创建、缺少文件或索引文件写了一半的目录不会被加载，也不会被补写清单
+        missing = write_generation(base_path, '20240103000000', skip='pinyin_index.bin')
+        truncated = write_generation(base_path, '20240104000000', truncate=True)
+        mismatched = write_generation(base_path, '20240105000000')
+        with open(os.path.join(mismatched, 'index_words.csv'), 'a', newline='', encoding='utf-8') as file:
+            csv.writer(file).writerow(['多余的索引词', '0'])
+        assert dictWords.get_latest_directory() == complete
+        for directory in (missing, truncated, mismatched):
+            assert indexManifest.load_manifest(directory) is None, directory
+
+        # 旧版本创建的完整目录补写清单后成为最新目录
+        legacy = write_generation(base_path, '20240106000000', vectors=5)
+        assert dictWords.get_latest_directory() == legacy
+        manifest = indexManifest.load_manifest(legacy)
+        assert manifest["options"] == {"legacy": True}
+        assert manifest["shards"][0]["dictWordSize"] == 5 and manifest["shards"][0]["vectorSize"] == 5
+        assert {item["path"] for item in manifest["files"]} == set(dictWords.LEGACY_INDEX_FILES)
+
+        # 比最新完整目录更新的未完成目录可能正在创建，不删除；更早的目录只保留最新的keep个完整目录
+        building = write_generation(base_path, '20240107000000', building=True)
+        removed = indexManifest.gc_generations(keep=2)
+        assert sorted(os.path.basename(d) for d in removed) == ['20240102000000', '20240103000000', '20240104000000', '20240105000000'], removed
+        assert sorted(os.listdir(base_path)) == [os.path.basename(d) for d in (complete, legacy, building)]
+        assert dictWords.get_latest_directory() == legacy
+
+        removed = indexManifest.gc_generations(keep=1)
+        assert [os.path.basename(d) for d in removed] == ['20240101000000'], removed
+        assert sorted(os.listdir(base_path)) == [os.path.basename(d) for d in (legacy, building)]
+        print("index generation tests passed")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import tempfile
+
+from service import dictWords
+from service import vectorIndex
+from service.dictWords import DictWord
+from service.vectorIndex import SearchHit
+
+WORDS = ["北京大学", "北京理工大学", "北京大学医学部", "清华大学", "Peking University", "注射液", "注射用水"]
+# 末尾的词条去掉符号后没有n-gram，矩阵的最后几行全为0
+EMPTY_WORDS = ["！！", "---"]
+
+
+def test_lexical_index(batch_index_dir: str):
+    words = [DictWord(str(i), word) for i, word in enumerate(WORDS + EMPTY_WORDS)]
+    dictWords._save_lexical_index(batch_index_dir, words)
+    lexical_index = dictWords.load_lexical_index(batch_index_dir)
+    with open(os.path.join(batch_index_dir, 'lexical_meta.json'), 'r', encoding='utf-8') as file:
+        shape = json.load(file)["shape"]
+    # 行数来自保存的形状，包含末尾没有n-gram的词条
+    assert len(lexical_index) == len(words) and list(lexical_index.matrix.shape) == shape
+    assert lexical_index.matrix[len(WORDS):].nnz == 0
+
+    # 词表按字节序排序，每个词条的非零列就是它的n-gram所在的列
+    vocabulary = [gram.decode('utf-8') for gram in lexical_index.vocabulary.tolist()]
+    assert vocabulary == sorted(vocabulary, key=lambda gram: gram.encode('utf-8'))
+    for row, word in enumerate(WORDS):
+        grams = sorted(set(dictWords.char_ngrams(dictWords.suggest_key(word))))
+        columns = lexical_index.columns(grams)
+        assert (columns >= 0).all() and [vocabulary[column] for column in columns] == grams
+        assert sorted(lexical_index.matrix[row].nonzero()[1].tolist()) == sorted(columns.tolist())
+    # 不在词表中的n-gram，包括比最长的键还长、截断后会与词表中的键相同的n-gram
+    longest = max(vocabulary, key=lambda gram: len(gram.encode('utf-8')))
+    assert lexical_index.columns(["火星", "zzz", longest + "学", longest]).tolist()[:3] == [-1, -1, -1]
+    assert lexical_index.columns([longest])[0] >= 0
+
+    # 相同的词相似度为1，漏字、大小写和符号不同的词排在最前
+    rows = lexical_index.search("北京大学", top_n=3)
+    assert rows[0][0] == 0 and abs(rows[0][1] - 1) < 1e-5
+    assert [row for row, _ in rows] == [0, 2, 1], rows
+    assert lexical_index.search("北京大学医学", top_n=1)[0][0] == 2
+    assert lexical_index.search("peking-university", top_n=1)[0][0] == 4
+    similarities = [similarity for _, similarity in lexical_index.search("注射", top_n=10)]
+    assert similarities == sorted(similarities, reverse=True) and len(similarities) == 2
+    assert lexical_index.search("火星", top_n=3) == [] and lexical_index.search("！！", top_n=3) == []
+
+
+def test_hybrid_merge():
+    # 向量和字面结果的距离不可比：同分时按各自引擎内的名次，再按词长排序
+    index_words = [
+        SearchHit("WORD", "1", "北京大学", 2, 0.2),
+        SearchHit("WORD", "2", "北京理工大学", 1, 0.1),
+        SearchHit("PINYIN", "3", "北京医科大学", 1, 0.3),
+        SearchHit("LEXICAL", "1", "北京大学", 2, 0.0),
+        SearchHit("LEXICAL", "4", "北京大学医学部", 1, 0.45),
+        SearchHit("LEXICAL", "5", "北大", 1, 0.2),
+    ]
+    assert vectorIndex._engine_ranks(index_words) == [0, 1, 2, 0, 2, 1]
+    merged = vectorIndex._merge_index_words(index_words, top_k=10)
+    assert [iw.word for iw in merged] == ["北京大学", "北大", "北京理工大学", "北京医科大学", "北京大学医学部"], merged
+    # 重复的词只保留排在前面的结果
+    assert merged[0].index == "WORD"
+    assert len(vectorIndex._merge_index_words(index_words, top_k=2)) == 2
+
+    # 只有一种引擎时与按分数、距离排序相同
+    vector_words = [iw for iw in index_words if iw.index != "LEXICAL"]
+    merged = vectorIndex._merge_index_words(list(reversed(vector_words)), top_k=10)
+    assert merged == sorted(vector_words, key=lambda iw: (-iw.score, iw.distance))
+
+
+if __name__ == '__main__':
+    # 在临时目录中创建字面索引，不影响 index/ 下的索引
+    batch_index_dir = tempfile.mkdtemp()
+    try:
+        test_lexical_index(batch_index_dir)
+        test_hybrid_merge()
+        print("lexical index tests passed")
+    finally:
+        shutil.rmtree(batch_index_dir, ignore_errors=True)
@@ -0,0 +1,87 @@
+import csv
+import os
+import random
+import shutil
+import tempfile
+
+import basic.func
+from service import dictWords
+
+
+def write_txt(directory: str, filename: str, lines: list[str]):
+    with open(os.path.join(directory, filename), 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def read_csv(filepath: str) -> list[list[str]]:
+    with open(filepath, 'r', newline='', encoding='utf-8') as file:
+        return list(csv.reader(file))
+
+
+def test_external_sort(temp_dir: str):
+    # 多个分块归并后与内存排序相同，按第一列去重保留排序最前的行
+    rows = [[f"词{random.randint(0, 200):03d}", str(i)] for i in range(1000)]
+    expected = {}
+    for row in sorted(rows):
+        expected.setdefault(row[0], row)
+    for chunk_size in (7, 100, 5000):
+        run_dir = tempfile.mkdtemp(dir=temp_dir)
+        assert list(dictWords.external_sort(iter(rows), run_dir, chunk_size)) == list(expected.values()), chunk_size
+    assert list(dictWords.external_sort(iter([]), temp_dir, 10)) == []
+
+
+def test_prepare_dict_words(directory: str):
+    dict_words_path = dictWords.get_dict_words_path()
+    codes_path = os.path.join(directory, dictWords.DICT_CODES_FILE)
+
+    # 第一次整理：去掉符号、去重并按词条排序，代码从0开始
+    write_txt(directory, 'a.txt', ["阿莫西林胶囊", "头孢克肟片", "", "阿莫西林胶囊！"])
+    write_txt(directory, 'b.txt', ["维生素C片", "头孢克肟片"])
+    stats = dictWords.prepare_dict_words(chunk_size=2)
+    assert stats["lines"] == 6 and stats["words"] == 3 and stats["newWords"] == 3 and stats["retiredWords"] == 0, stats
+    rows = read_csv(dict_words_path)
+    assert [row[1] for row in rows] == sorted(["阿莫西林胶囊", "头孢克肟片", "维生素C片"])
+    codes = {row[1]: row[0] for row in rows}
+    assert sorted(codes.values()) == ['0', '1', '2']
+
+    # 在字典文件中给词条设置权重(可选的第三列)
+    with open(dict_words_path, 'w', newline='', encoding='utf-8') as file:
+        csv.writer(file).writerows([row + ['5'] if row[1] == "头孢克肟片" else row for row in rows])
+
+    # 删除一个词条、加入新词条：已有词条的代码和权重不变，删除的词条保留在映射中，新词条从最大代码之后分配
+    write_txt(directory, 'b.txt', ["布洛芬缓释胶囊", "头孢克肟片"])
+    stats = dictWords.prepare_dict_words(chunk_size=2)
+    assert stats["words"] == 3 and stats["newWords"] == 1 and stats["retiredWords"] == 1, stats
+    rows = read_csv(dict_words_path)
+    assert {row[1]: row[0] for row in rows} == {"阿莫西林胶囊": codes["阿莫西林胶囊"], "头孢克肟片": codes["头孢克肟片"], "布洛芬缓释胶囊": '3'}
+    assert {row[1]: row[2:] for row in rows} == {"阿莫西林胶囊": [], "头孢克肟片": ['5'], "布洛芬缓释胶囊": []}
+    assert read_csv(codes_path) == sorted(read_csv(codes_path)) and len(read_csv(codes_path)) == 4
+    words = dictWords._copy_and_read_dict_words(tempfile.mkdtemp(dir=directory))
+    assert {word.word: word.weight for word in words}["头孢克肟片"] == 5.0
+
+    # 删除后再加入的词条恢复原代码
+    write_txt(directory, 'b.txt', ["维生素C片", "头孢克肟片"])
+    stats = dictWords.prepare_dict_words()
+    assert stats["newWords"] == 0 and stats["retiredWords"] == 1, stats
+    rows = read_csv(dict_words_path)
+    assert {row[1]: row[0] for row in rows} == {key: codes[key] for key in codes}
+    assert {row[1]: row[2:] for row in rows}["头孢克肟片"] == ['5']
+
+    # 没有映射文件时沿用当前字典文件的代码和权重
+    os.remove(codes_path)
+    stats = dictWords.prepare_dict_words()
+    assert stats["newWords"] == 0 and read_csv(dict_words_path) == rows
+
+
+if __name__ == '__main__':
+    # 在临时目录中整理字典，不影响 dict/ 下的字典
+    root = tempfile.mkdtemp()
+    basic.func.get_executable_directory = lambda: root
+    directory = os.path.join(root, 'dict')
+    os.makedirs(directory)
+    try:
+        test_external_sort(root)
+        test_prepare_dict_words(directory)
+        print("prepare dict tests passed")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
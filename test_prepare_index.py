@@ -1,11 +1,10 @@
 import multiprocessing
-import os.path
 from datetime import datetime
 
 import basic.func
 from service import dictWords
 from service import aiModel
-from service import vectorIndex
+from service import indexJob
 
 if __name__ == '__main__':
     multiprocessing.freeze_support()  # 对于 Windows 上的可执行文件打包是必要的
@@ -13,12 +12,8 @@ if __name__ == '__main__':
     # 收集txt，生成搜索词字典
     # dictWords.prepare_dict_words()
 
-    # 根据字典，生成索引词词条ID的关系
-    batch_index_dir = os.path.join(basic.func.get_executable_directory(), 'index', start_time.strftime("%Y%m%d%H%M%S"))
-    words = dictWords.prepare_index_words(batch_index_dir, 3, 5)
-
-    # 生成向量索引
+    # 根据字典生成索引词及向量索引，完成后写入清单
     model = aiModel.load_sentence_transformer_model()
-    vectorIndex.create_vector_indexes(batch_index_dir, words, model)
+    indexJob.build_index(model, ngram_min=3, ngram_max=5)
 
     print(f"cost {basic.func.get_duration(start_time)}")
\ No newline at end of file
@@ -0,0 +1,56 @@
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+from datetime import datetime
+
+import basic.func
+from service import aiModel
+from service import dictWords
+from service import indexJob
+
+# 剪枝后的搜索召回率下限，与 tune 的默认召回率目标相同
+RECALL_TARGET = 0.95
+# 测试使用的命名字典，测试结束后删除其字典文件和索引目录
+TEST_COLLECTION = 'prune_test'
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()  # 对于 Windows 上的可执行文件打包是必要的
+    start_time = datetime.now()
+    # 按建索引的方式切分 dict/dict_words.csv，检查剪枝掉的冗余索引词都能由倒排表完全相同的较短子串代替
+    filepath = dictWords.get_dict_words_path()
+    with open(filepath, 'r', newline='', encoding='utf-8') as file:
+        words = [dictWords.DictWord(row[0], row[1]) for row in csv.reader(file)]
+    index_words = dictWords.build_index_words(words, ngram_min=3, ngram_max=5)
+    pruned, report = dictWords.prune_index_words(index_words, {word.word for word in words}, redundant=True)
+    print(report)
+
+    def has_equal_sub_key(key: str) -> bool:
+        # 逐字缩短，沿倒排表相同的子串找到一个保留的索引词
+        for sub_key in (key[1:], key[:-1]):
+            if index_words.get(sub_key) == index_words[key] and (sub_key in pruned or has_equal_sub_key(sub_key)):
+                return True
+        return False
+
+    missing = [key for key in index_words if key not in pruned and not has_equal_sub_key(key)]
+    for key in missing[:10]:
+        print(f"{key}: {index_words[key]}, {key[1:]}: {index_words.get(key[1:])}, {key[:-1]}: {index_words.get(key[:-1])}")
+    assert not missing, f"{len(missing)} pruned index words have no kept sub key with the same codes"
+    print(f"{report['redundant']} pruned index words checked, cost {basic.func.get_duration(start_time)}")
+
+    # 字面覆盖不能反映搜索结果：用模型创建剪枝后的索引，与未剪枝的flat索引比较 validate_keywords.txt 的 recall@3
+    model = aiModel.load_sentence_transformer_model()
+    assert model is not None, "Failed to load sentence transformer model"
+    test_dict_path = dictWords.get_dict_words_path(TEST_COLLECTION)
+    shutil.copy(filepath, test_dict_path)
+    try:
+        batch_index_dir = indexJob.build_index(model, collection=TEST_COLLECTION, prune=True)
+        with open(os.path.join(batch_index_dir, dictWords.PRUNE_REPORT_FILE), 'r', encoding='utf-8') as file:
+            recall = json.load(file)["searchRecall"]
+        print(recall)
+        assert recall["recall"] >= RECALL_TARGET, f"pruned search recall {recall['recall']} is below {RECALL_TARGET}"
+    finally:
+        os.remove(test_dict_path)
+        shutil.rmtree(dictWords.get_index_base_directory(TEST_COLLECTION), ignore_errors=True)
+    print(f"cost {basic.func.get_duration(start_time)}")
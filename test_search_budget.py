@@ -0,0 +1,114 @@
+import hashlib
+import time
+
+import faiss
+import numpy as np
+
+from service import vectorIndex
+from service.dictWords import DictWord, pinyin_word
+from service.vectorIndex import IndexShard, SearchBudget, VectorIndex
+
+WORDS = ["北京大学", "北京理工大学", "清华大学", "复旦大学", "浙江大学", "南京大学", "武汉大学", "中山大学"]
+
+
+class CountingModel:
+    """
+    不加载模型：按字符哈希生成向量，记录编码次数
+    """
+    def __init__(self, dim: int = 32):
+        self.dim = dim
+        self.encoded: list[str] = []
+
+    def encode(self, sentences: list[str]) -> np.ndarray:
+        self.encoded += sentences
+        vectors = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        for row, sentence in enumerate(sentences):
+            for char in sentence:
+                vectors[row, hashlib.md5(char.encode('utf-8')).digest()[0] % self.dim] += 1
+            vectors[row] /= max(np.linalg.norm(vectors[row]), 1)
+        return vectors
+
+
+def build_shard(model: CountingModel) -> IndexShard:
+    dict_words = {str(i): DictWord(str(i), word) for i, word in enumerate(WORDS)}
+    index_codes = [{str(i)} for i in range(len(WORDS))]
+
+    def vector_index(words: list[str]) -> VectorIndex:
+        index = faiss.IndexFlatL2(model.dim)
+        index.add(model.encode(words))
+        return VectorIndex(index)
+
+    shard = IndexShard("0", dict_words, index_codes, vector_index(WORDS), vector_index([pinyin_word(word) for word in WORDS]))
+    model.encoded.clear()
+    return shard
+
+
+def budget_at(ratio: float, budget_millis: float = 1000) -> SearchBudget:
+    # 请求在 ratio * 预算 之前到达
+    return SearchBudget(budget_millis=budget_millis, start=time.perf_counter() - ratio * budget_millis / 1000)
+
+
+if __name__ == '__main__':
+    # 不限制预算时不降级
+    assert budget_at(5, budget_millis=0).check() == 0
+    # 已用时间达到预算的比例时升到对应级别
+    for ratio, level in ((0.2, 0), (0.55, 1), (0.75, 2), (0.9, 3), (1.2, 4)):
+        assert budget_at(ratio).check() == level, (ratio, level)
+    # 级别只升不降：排队数给出的初始级别不会因为预算充足而降低
+    assert SearchBudget(budget_millis=1000, level=2).check() == 2
+
+    # 降级步骤只在达到级别时记录，重复的步骤只记录一次并保持顺序
+    budget = SearchBudget(level=vectorIndex.DEGRADE_SHRINK_TOP_N)
+    assert not budget.degrade("capCandidates", vectorIndex.DEGRADE_CAP_CANDIDATES) and not budget.degraded
+    assert budget.degrade("skipPinyin", vectorIndex.DEGRADE_SKIP_PINYIN)
+    assert budget.degrade("shrinkTopN", vectorIndex.DEGRADE_SHRINK_TOP_N)
+    assert budget.degrade("skipPinyin", vectorIndex.DEGRADE_SKIP_PINYIN)
+    assert budget.degraded and budget.steps == ["skipPinyin", "shrinkTopN"]
+
+    # 排队数的降级默认关闭；开启后每超过一倍降一级，最多降到限制候选扩展，超过拒绝阈值时停止
+    assert vectorIndex.queue_degrade_level(1000) == 0
+    assert vectorIndex.queue_degrade_level(16, queue_degrade=16, queue_reject=64) == 0
+    assert vectorIndex.queue_degrade_level(17, queue_degrade=16, queue_reject=64) == 1
+    assert vectorIndex.queue_degrade_level(40, queue_degrade=16, queue_reject=64) == 2
+    assert vectorIndex.queue_degrade_level(64, queue_degrade=16, queue_reject=64) == vectorIndex.DEGRADE_CAP_CANDIDATES
+    assert vectorIndex.queue_degrade_level(65, queue_degrade=16, queue_reject=64) == vectorIndex.DEGRADE_STOP
+    assert vectorIndex.queue_degrade_level(65, queue_reject=64) == vectorIndex.DEGRADE_STOP
+
+    # 各级别实际跳过的搜索步骤
+    model = CountingModel()
+    shard = build_shard(model)
+    top_k = 2
+
+    def search(level: int) -> (list, SearchBudget):
+        model.encoded.clear()
+        budget = SearchBudget(level=level)
+        return vectorIndex.search_index_shards("北京大学", model, [shard], top_k=top_k, pinyin=True, budget=budget), budget
+
+    hits, budget = search(0)
+    assert not budget.degraded and len(model.encoded) == 2
+    assert hits[0].word == "北京大学" and any(hit.index == "PINYIN" for hit in hits)
+
+    # 跳过拼音：不再编码拼音，也不搜索拼音索引
+    hits, budget = search(vectorIndex.DEGRADE_SKIP_PINYIN)
+    assert budget.steps == ["skipPinyin"] and model.encoded == ["北京大学"]
+    assert hits and all(hit.index == "WORD" for hit in hits)
+
+    # 近邻数缩小为top_k
+    searched = []
+    search_vectors = shard.word_index.search
+    shard.word_index.search = lambda vectors, k: searched.append(k) or search_vectors(vectors, k)
+    hits, budget = search(vectorIndex.DEGRADE_SHRINK_TOP_N)
+    assert budget.steps == ["skipPinyin", "shrinkTopN"] and searched == [top_k]
+    assert hits[0].word == "北京大学"
+    searched.clear()
+    search(0)
+    assert searched == [vectorIndex.search_depth(top_k)]
+    del shard.word_index.search
+
+    hits, budget = search(vectorIndex.DEGRADE_CAP_CANDIDATES)
+    assert budget.steps == ["skipPinyin", "shrinkTopN", "capCandidates"] and hits[0].word == "北京大学"
+
+    # 停止搜索分片，只编码查询词，返回空结果
+    hits, budget = search(vectorIndex.DEGRADE_STOP)
+    assert hits == [] and budget.steps[-1] == "partial" and model.encoded == ["北京大学"]
+    print("search budget tests passed")
@@ -0,0 +1,72 @@
+import shutil
+import tempfile
+
+from service import dictWords
+from service.dictWords import DictWord
+
+WORDS = [("注射液", 1), ("注射用水", 3), ("注射用头孢曲松钠", 3), ("葡萄糖注射液", 2), ("阿莫西林胶囊", 5), ("阿莫西林颗粒", 0),
+         ("阿司匹林肠溶片", 0), ("阿奇霉素片", 4), ("维生素C片", 0), ("维生素B1片", 0), ("Vitamin C", 1)]
+
+
+def expected_suggest(words: list[DictWord], prefix: str, top_n: int) -> list[tuple[int, float]]:
+    # 逐个词条检查输入提示键，按 权重降序、词长升序、匹配的键的字节序 排序
+    key = dictWords.suggest_key(prefix)
+    matches = {}
+    for row, word in enumerate(words):
+        keys = [k.encode('utf-8') for k in dictWords.suggest_keys(word.word) if k.startswith(key)]
+        if keys:
+            matches[row] = (-word.weight, len(word.word), min(keys))
+    rows = sorted(matches, key=matches.get)
+    return [(row, words[row].weight) for row in rows[:top_n]]
+
+
+def test_suggest(batch_index_dir: str):
+    words = [DictWord(str(i), word, weight) for i, (word, weight) in enumerate(WORDS)]
+    dictWords._save_suggest_index(batch_index_dir, words)
+    suggest_index = dictWords.load_suggest_index(batch_index_dir)
+    assert suggest_index.hot_top is not None and len(suggest_index.hot_top) == 0
+
+    def suggest_words(prefix: str, top_n: int = 10) -> list[str]:
+        return [words[row].word for row, _ in suggest_index.suggest(prefix, top_n)]
+
+    # 词条前缀，按权重降序、同权重时词长升序
+    assert suggest_words("注射") == ["注射用水", "注射用头孢曲松钠", "注射液"]
+    assert suggest_words("阿莫西林") == ["阿莫西林胶囊", "阿莫西林颗粒"]
+    # 全拼与拼音首字母，大小写和符号不影响
+    assert suggest_words("zhusheye") == ["注射液"]
+    assert suggest_words("zs") == ["注射用水", "注射用头孢曲松钠", "注射液"]
+    assert suggest_words("A-M") == ["阿莫西林胶囊", "阿莫西林颗粒"]
+    assert suggest_words("wss", top_n=1) == ["维生素C片"]
+    assert suggest_words("vitamin c") == ["Vitamin C"]
+    # 同一词条的多个键都匹配时只返回一次
+    assert suggest_words("a") == ["阿莫西林胶囊", "阿奇霉素片", "阿莫西林颗粒", "阿司匹林肠溶片"]
+    assert suggest_words("火星") == [] and suggest_words("！") == []
+
+
+def test_hot_prefixes(batch_index_dir: str):
+    # 生成大量共享前缀的词条，热门前缀的预先排序结果与逐个检查的结果相同
+    words = [DictWord(str(i), f"{'注射' if i % 3 else '阿莫'}{'用' if i % 5 else ''}{i}号", float(i % 7)) for i in range(600)]
+    dictWords._save_suggest_index(batch_index_dir, words)
+    suggest_index = dictWords.load_suggest_index(batch_index_dir)
+    hot = [suggest_index.hot_blob[int(start):int(end)].tobytes().decode('utf-8')
+           for start, end in zip(suggest_index.hot_offsets[:-1], suggest_index.hot_offsets[1:])]
+    assert {"注", "注射", "z", "zs", "zhu", "zhushe"} <= set(hot) and "注射用11" not in hot, hot
+    # 热门前缀不扫描区间，top超过预先保存的键数时扫描区间
+    assert suggest_index._hot_positions("注".encode('utf-8'), 10) is not None
+    assert suggest_index._hot_positions("注".encode('utf-8'), dictWords.SUGGEST_TOP_N + 1) is None
+    for prefix in ["注", "注射", "注射用", "阿莫", "z", "zs", "zsy", "zhushe", "a", "amo", "注射用1", "zs1", "zhusheyong12", "火星"]:
+        for top_n in (1, 10, dictWords.SUGGEST_TOP_N, dictWords.SUGGEST_TOP_N + 10):
+            assert suggest_index.suggest(prefix, top_n) == expected_suggest(words, prefix, top_n), (prefix, top_n)
+
+
+if __name__ == '__main__':
+    # 在临时目录中创建输入提示索引，不影响 index/ 下的索引；缩小热门前缀的阈值，少量词条即可覆盖预先排序的前缀
+    dictWords.SUGGEST_SCAN_LIMIT = 32
+    dictWords.SUGGEST_TOP_N = 20
+    batch_index_dir = tempfile.mkdtemp()
+    try:
+        test_suggest(batch_index_dir)
+        test_hot_prefixes(batch_index_dir)
+        print("suggest index tests passed")
+    finally:
+        shutil.rmtree(batch_index_dir, ignore_errors=True)
@@ -18,6 +18,7 @@ a = Analysis(
         'scipy',
         'sentence_transformers',
         'faiss',
+        'orjson',
         'pydantic',
         'psutil',
         'multipart'